@@ -1,106 +1,302 @@
 import os
+import math
 import asyncio
 import json
 import time
-from datetime import datetime
-from typing import Union, List, Dict
-from asyncio import Semaphore
-from uuid import UUID, uuid4
+import socket
+import signal
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Union, List, Dict, Tuple, Optional
+from uuid import UUID, uuid4, uuid5
 from asyncpg.pool import Pool
 from asynch import connect, create_pool
 from asynch.pool import Pool as ClickPool
 
 from .db_connectors.connection import create_psql_pool
-from .db_connectors.clickhouse_connector import ClickhouseTable
+from .db_connectors.clickhouse_connector import ClickhouseTable, ClickhouseCatalog, PART_MIN_BLOCK_EXPRESSION
 from .db_connectors.postgresql_connector import PsQLTable
-from .types import InfoMessages, TablesShemaEntity, S3FunctionParameters
-from .types import DBLevelLog,  BackupHistoryEntity, BackupLogEntity
+from .db_connectors.exceptions import ErrorClusterShard, ErrorBackupSchemaNotFound
+from .db_connectors.psql_writer import PsQLWriter
+from .concurrency import ConcurrencyController
+from .metrics import REGISTRY, MetricsServer, JOBS, ROWS, BYTES
+from .retry import can_retry, get_retry_delay, is_retryable
+from .scheduler import Scheduler
+from .tracker import QueryTracker
+from .types import InfoMessages, TablesShemaEntity, S3FunctionParameters, TableConfig, BackupFileFormat
+from .types import ChangeDetection, Discovery, TableMetadata, ExportMode, TableSchema, BackupSchemaEntity
+from .types import DBLevelLog,  BackupHistoryEntity, BackupLogEntity, QueryStatsEntity, BackupJobEntity
 from settings.db import DbConfig
 from settings.app import AppConfig
 from settings.s3 import S3Config
 from settings.clickhouse import ClHouseConfig
-from settings.log import app_log
+from settings.log import app_log, log_context, setup_logging
+
+
+def create_scheduler() -> Scheduler:
+    if AppConfig.ADAPTIVE_CONCURRENCY:
+        return Scheduler(workers=AppConfig.COUNT_THREADS, max_workers=AppConfig.CONCURRENCY_MAX)
+    return Scheduler(workers=AppConfig.COUNT_THREADS)
 
 
 class App:
     psql_pool: Pool = None
+    click_connect: ClickPool = None
+    export_connect: ClickPool = None
+    psql_writer: PsQLWriter = None
+    scheduler: Scheduler = None
+    controller: ConcurrencyController = None
+    tracker: QueryTracker = None
+    metrics_server: MetricsServer = None
     
-    async def _init(self):
-        self.psql_pool = await create_psql_pool(**DbConfig.CONNECTION_SETTINGS)
-        self.click_connect = await create_pool(maxsize=ClHouseConfig.POOL_MAXSIZE, **ClHouseConfig.get_connection_data())
+    @property
+    def concurrency(self) -> int:
+        """Наибольшее число одновременных выгрузок (восстановлений)"""
+        if AppConfig.ADAPTIVE_CONCURRENCY:
+            return max(AppConfig.CONCURRENCY_MAX, AppConfig.COUNT_THREADS)
+        return AppConfig.COUNT_THREADS
+    
+    @property
+    def export_pool_size(self) -> int:
+        """Каждой выгрузке свое соединение: задание не ждет соединения, заняв место в планировщике"""
+        return ClHouseConfig.EXPORT_POOL_MAXSIZE or self.concurrency
+    
+    @property
+    def psql_pool_size(self) -> int:
+        return DbConfig.CONNECTION_SETTINGS['max_size']
         
+    async def _init(self):
+        self.psql_pool = await create_psql_pool(
+            **{**DbConfig.CONNECTION_SETTINGS, 'max_size': self.psql_pool_size}
+        )
+        # запросы метаданных и метрик идут через свой пул и не ждут освобождения соединений долгих выгрузок
+        self.click_connect = await create_pool(
+            maxsize=ClHouseConfig.POOL_MAXSIZE, **ClHouseConfig.get_connection_data()
+        )
+        self.export_connect = await create_pool(maxsize=self.export_pool_size, **ClHouseConfig.get_connection_data())
+        await self.check_connections()
+        self.psql_writer = PsQLWriter(
+            psql_pool=self.psql_pool,
+            batch_size=DbConfig.WRITER_BATCH_SIZE,
+            flush_interval=DbConfig.WRITER_FLUSH_INTERVAL,
+            spool_path=DbConfig.SPOOL_PATH,
+            max_replays=DbConfig.SPOOL_MAX_REPLAYS
+        )
+        await self.psql_writer.start()
+        try:
+            await PsQLTable(psql_pool=self.psql_pool).create_monthly_partitions()
+        except Exception:
+            app_log.warning(InfoMessages.PSQL_ERROR.value, exc_info=True)
+        if AppConfig.METRICS_PORT:
+            self.metrics_server = MetricsServer(REGISTRY, AppConfig.METRICS_PORT)
+            await self.metrics_server.start()
+        if self.scheduler is not None and AppConfig.ADAPTIVE_CONCURRENCY:
+            self.controller = ConcurrencyController(self.scheduler, ClickhouseCatalog(self.click_connect))
+            self.controller.start()
+        if self.tracker is not None:
+            self.tracker.start()
         
     async def _close(self):
+        if self.controller is not None:
+            await self.controller.close()
+        if self.tracker is not None:
+            await self.tracker.close()
+        if AppConfig.METRICS_TEXTFILE:
+            try:
+                REGISTRY.write_textfile(AppConfig.METRICS_TEXTFILE)
+            except Exception:
+                app_log.warning(
+                    InfoMessages.ERROR_METRICS_TEXTFILE.value.format(path=AppConfig.METRICS_TEXTFILE), exc_info=True
+                )
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.psql_writer is not None:
+            await self.psql_writer.close()
         await self.psql_pool.close()
-        self.click_connect.close()
-        await self.click_connect.wait_closed()
+        for pool in (self.click_connect, self.export_connect):
+            pool.close()
+            await pool.wait_closed()
+    
+    async def check_connections(self):
+        """
+        Проверка clickhouse и postgresql до начала работы и прогрев пулов: соединения
+        для начального числа выгрузок открываются заранее, а не при первых заданиях
+        """
+        try:
+            await PsQLTable(psql_pool=self.psql_pool).ping()
+            catalog = ClickhouseCatalog(self.click_connect, self.export_connect)
+            await catalog.ping()
+            await catalog.warm_up(min(AppConfig.COUNT_THREADS, self.export_pool_size), export=True)
+        except Exception:
+            app_log.error(InfoMessages.CONNECTIONS_ERROR.value, exc_info=True)
+            raise
+        app_log.info(
+            InfoMessages.CONNECTIONS_READY.value.format(
+                metadata=ClHouseConfig.POOL_MAXSIZE, export=self.export_pool_size, psql=self.psql_pool_size
+            )
+        )
         
     async def _execute(self, **kwargs):
         raise NotImplementedError("The _execute method must be defined")
         
     async def run(self, **kwargs):
+        setup_logging()
         await self._init()
-        await self._execute(**kwargs)
-        await self._close()
+        try:
+            return await self._execute(**kwargs)
+        finally:
+            # накопленные записи сбрасываются в postgresql и при ошибке
+            await self._close()
         
         
+def normalize_expression(expression: str) -> str:
+    return "".join(expression.split()).replace("`", "")
+
+
+def split_count(count: int, chunks: int, chunk: int) -> int:
+    """Оценка количества записей в части chunk партиции, сумма по всем частям равна count"""
+    return count // chunks + (1 if chunk < count % chunks else 0)
+
+
+def make_file_s3_parameters(record: BackupHistoryEntity, schema: Dict, settings: Dict) -> S3FunctionParameters:
+    """Параметры s3 функции для чтения файла бэкапа record со схемой schema"""
+    file_format = BackupFileFormat(format_file=record.file_format, compression=record.compression)
+    return S3FunctionParameters(
+        path_to_file=ClHouseConfig.get_path_to_s3_function(file_name=record.file_name, extension=file_format.extension),
+        s3_access_key=S3Config.ACCESS_KEY,
+        s3_secret_key=S3Config.SECRET_KEY,
+        format_file=file_format.format_file,
+        fields=', '.join([f"{key} {val}" for key, val in schema.items()]),
+        compression=file_format.s3_compression,
+        settings=settings
+    )
+    
+    
 class Table:
     click_connect: connect = None
+    export_connect: connect = None
     table_schema = None
+    schema: TableSchema = None
+    metadata: TableMetadata = None
+    scheduler: Scheduler = None
+    tracker: QueryTracker = None
     
     def __init__(
             self, 
-            table_name: str, 
-            partition_key: Union[str, None], 
-            semaphore: Semaphore, 
+            config: TableConfig, 
             psql: Pool,
+            psql_writer: PsQLWriter,
             click_pool: ClickPool,
-            datetime_backup: str
+            datetime_backup: str,
+            shard: int = 0,
+            source_table: str = None,
+            written_schemas: set = None,
+            export_pool: ClickPool = None,
+            tracker: QueryTracker = None
         ):
-        self.table_name = table_name
-        self.partition_key = partition_key
-        self.semaphore = semaphore
+        """
+        В режиме кластера (CLICK_CLUSTER) на каждый шард создается свой Table:
+        shard - номер шарда, source_table - локальная таблица шарда, из которой
+        идет выгрузка, click_pool и export_pool - соединения с выбранной репликой шарда
+        """
+        self.table_name = config.table_name
+        self.partition_key = config.partition_key
+        self.file_format = config.file_format
+        self.max_threads = config.max_threads
+        self.change_detection = config.change_detection
+        self.discovery = config.discovery
+        self.max_rows_per_file = config.max_rows_per_file or AppConfig.MAX_ROWS_PER_FILE
+        self.max_bytes_per_file = config.max_bytes_per_file or AppConfig.MAX_BYTES_PER_FILE
+        self.split_key = config.split_key
+        self.export_mode = config.export_mode
         self.psql = psql
+        self.psql_writer = psql_writer
         self.click_connect = click_pool
+        self.export_connect = export_pool
+        self.tracker = tracker
         self.datetime_backup = datetime_backup
+        self.shard = shard
+        self.source_table = source_table or config.table_name
+        self.written_schemas = set() if written_schemas is None else written_schemas
+        self.queries: List[Dict] = []
+        # все партиции таблицы на момент бэкапа (для манифеста) и признак выгрузки в этом бэкапе
+        self.partition_values: List[str] = None
+        self.scheduled = False
         
     async def _init(self):
-        self.click_table = ClickhouseTable(self.table_name, self.click_connect)
+        self.click_table = ClickhouseTable(self.source_table, self.click_connect, self.export_connect)
         self.psql_table = PsQLTable(psql_pool=self.psql)
     
     async def _close(self):
         del self.click_table
         del self.psql_table
         
-    async def create_backup_schema(self, backup_guid: UUID):
-        data = [
-            TablesShemaEntity(
+    @property
+    def job_name(self) -> str:
+        """Имя таблицы в планировщике и метриках: у шардов свои лимиты параллельности"""
+        return self.table_name if not self.shard else f"{self.table_name}:s{self.shard}"
+    
+    def create_backup_schema(self, backup_guid: UUID):
+        """
+        Отпечаток схемы таблицы в backup_schema. Поля схемы записываются в tables_schema,
+        только если схема изменилась с последнего бэкапа, иначе бэкап ссылается на ранее записанные
+        """
+        if (str(backup_guid), self.table_name) in self.written_schemas:
+            return
+        self.written_schemas.add((str(backup_guid), self.table_name))
+        schema_guid = backup_guid
+        if self.schema is not None and self.schema.is_relevant:
+            schema_guid = self.schema.last_schema_guid
+        self.psql_writer.add(
+            BackupSchemaEntity(
                 backup_guid=backup_guid,
                 table_name=self.table_name,
-                field_name=key,
-                field_type=value
-            )for key, value in self.table_schema.items()
-        ]
-        try:
-            await self.psql_table.insert_schema_table(data)
-        except Exception as err:
-            app_log.error(err, exc_info=True) 
-            raise
+                schema_hash=TableSchema.get_hash(self.table_schema),
+                schema_guid=schema_guid
+            )
+        )
+        if str(schema_guid) != str(backup_guid):
+            return
+        for position, (key, value) in enumerate(self.table_schema.items()):
+            self.psql_writer.add(
+                TablesShemaEntity(
+                    backup_guid=backup_guid,
+                    table_name=self.table_name,
+                    field_name=key,
+                    field_type=value,
+                    field_position=position
+                )
+            )
+    
+    async def load_schema(self, schema: TableSchema = None) -> TableSchema:
+        """
+        Схема таблицы и отпечаток схемы последнего бэкапа: получены заранее для всех таблиц
+        (см. Backup.get_schemas) или запрашиваются для одной таблицы
+        """
+        if schema is None:
+            fields = await self.click_table.get_schema_table()
+            last_schemas = await self.psql_table.get_last_backup_schemas([self.table_name])
+            schema = TableSchema(fields=fields, **last_schemas.get(self.table_name, {}))
+        self.schema = schema
+        self.table_schema = schema.fields
+        return schema
     
-    async def check_relevance_backup_schema(self, backup_guid: UUID) -> bool:
+    async def check_relevance_backup_schema(self, schema: TableSchema = None) -> bool:
         try:
-            self.table_schema = await self.click_table.get_schema_table()
-            backup_schema = await self.psql_table.get_last_backup_schema(self.table_name)
+            schema = await self.load_schema(schema)
         except Exception as err:
             app_log.error(err, exc_info=True)
             raise
-        if self.table_schema == backup_schema:
+        if schema.is_relevant:
             return True
         else:
             app_log.info(InfoMessages.NOT_RELEVANTE_SCHEMA.value.format(table_name=self.table_name))
             return False
         
-    async def make_keys_list_for_backup(self, force: bool, key_name: str) -> Union[List[Dict], None]:
+    async def make_keys_list_for_backup(
+        self, force: bool, key_name: str, deltas: bool = True
+    ) -> Union[List[Dict], None]:
         """
         если Partition_key = None, то смотрим count() по всей таблице и сверяем с
         psql.backup_history count послежнего бэкапа,
@@ -112,108 +308,802 @@ class Table:
                             count() которых не соответствует соответствующему count 
                             в psql.backup_history
         Для случая, когда self.partition_key = None метод вернет [{'-': count()}]
+        Если для таблицы задан change_detection = checksum, дополнительно
+        считается отпечаток содержимого партиции sum(cityHash64(*)), и партиция
+        бэкапится также при несовпадении отпечатка с сохраненным в psql.backup_history
+        Если возможно, партиции и количество записей берутся из system.parts
+        без сканирования таблицы (см. use_parts_discovery)
+        Для change_detection = parts у партиций отслеживаются номера блоков кусков,
+        при deltas = True для измененной партиции по возможности выгружаются
+        только новые куски (см. get_delta)
         
         """
+        with_checksum = self.change_detection == ChangeDetection.CHECKSUM
+        parts_discovery = self.use_parts_discovery(key_name)
+        blocks = {}
         try:
-            if self.partition_key is None or key_name=='-':
-                parts = [{key_name: "-", 'count': await self.click_table.get_count_records()}]
-                # parts = {'-': await self.click_table.get_count_records()}
+            if parts_discovery:
+                parts = self.get_parts_from_metadata(key_name)
+            elif self.partition_key is None or key_name=='-':
+                if with_checksum:
+                    parts = [{key_name: "-", **await self.click_table.get_checksum_records()}]
+                else:
+                    parts = [{key_name: "-", 'count': await self.click_table.get_count_records()}]
+            elif with_checksum:
+                parts = await self.click_table.get_checksum_records_by_pkey(self.partition_key)
             else:
                 parts = await self.click_table.get_count_records_by_pkey(self.partition_key)
+            if parts_discovery and self.track_blocks:
+                blocks = await self.get_partition_blocks(key_name)
         except Exception as err:
             app_log.error(err, exc_info=True)
             raise
+        self.estimate_parts_size(parts)
+        for item in parts:
+            self.set_blocks(item, blocks.get(str(item[key_name])))
+        self.partition_values = [str(item[key_name]) for item in parts]
         if force:
             return parts
         try:
-            last_parts = await self.psql_table.get_count_records_in_last_backup(self.table_name)
+            last_parts = await self.psql_table.get_last_backup_state(self.table_name, self.shard)
         except Exception as err:
             app_log.error(err, exc_info=True)
             raise
-        return [item for item in parts if item['count'] != last_parts.get(str(item[key_name]), 0)]
+        parts = [item for item in parts if self.is_changed(item, last_parts.get(str(item[key_name])))]
+        if deltas:
+            for item in parts:
+                key_value = str(item[key_name])
+                if key_value in blocks:
+                    item.update(self.get_delta(blocks[key_value], last_parts.get(key_value)) or {})
+        return parts
+    
+    def is_changed(self, part: Dict, last_part: Union[Dict, None]) -> bool:
+        if last_part is None:
+            return part['count'] != 0
+        if part['count'] != last_part['count']:
+            return True
+        if self.change_detection == ChangeDetection.CHECKSUM and part['checksum'] != last_part['checksum']:
+            return True
+        if part.get('max_block') is not None:
+            # слияния кусков меняют modification_time, но не номера блоков
+            return part['max_block'] != last_part.get('max_block') or part['mutation'] != last_part.get('mutation')
+        if part.get('modification_time') is None or last_part.get('modification_time') is None:
+            return False
+        return part['modification_time'] != last_part['modification_time']
+    
+    def use_parts_discovery(self, key_name: str) -> bool:
+        """
+        Метаданные system.parts можно использовать для MergeTree таблиц, если
+        partition_key совпадает с выражением PARTITION BY таблицы
+        (или бэкап делается по всей таблице) и не нужен отпечаток содержимого.
+        """
+        if self.discovery != Discovery.PARTS:
+            return False
+        usable = (
+            self.metadata is not None
+            and self.metadata.engine.endswith("MergeTree")
+            and self.change_detection != ChangeDetection.CHECKSUM
+            and (
+                key_name == '-' 
+                or normalize_expression(key_name) == normalize_expression(self.metadata.partition_key)
+            )
+        )
+        if not usable:
+            app_log.info(InfoMessages.PARTS_DISCOVERY_FALLBACK.value.format(table_name=self.table_name))
+        return usable
+    
+    def get_parts_from_metadata(self, key_name: str) -> List[Dict]:
+        if key_name != '-':
+            return [
+                {
+                    key_name: item['partition'], 
+                    'count': item['count'], 
+                    'bytes': item['bytes'], 
+                    'modification_time': item['modification_time']
+                } for item in self.metadata.partitions
+            ]
+        return [
+            {
+                key_name: '-',
+                'count': sum([item['count'] for item in self.metadata.partitions]),
+                'bytes': sum([item['bytes'] for item in self.metadata.partitions]),
+                'modification_time': max(
+                    [item['modification_time'] for item in self.metadata.partitions], default=None
+                )
+            }
+        ]
+    
+    @property
+    def track_blocks(self) -> bool:
+        """
+        Номера блоков нужны только для change_detection = parts; в режиме partition_by
+        партиции выгружаются одним запросом без границ блоков, поэтому всегда целиком
+        """
+        return self.change_detection == ChangeDetection.PARTS and self.export_mode != ExportMode.PARTITION_BY
+    
+    async def get_partition_blocks(self, key_name: str) -> Dict[str, List[Dict]]:
+        """
+        Активные куски таблицы по значениям партиций. При бэкапе всей таблицы ('-')
+        куски можно сравнивать по номерам блоков, только если партиция одна:
+        в каждой партиции своя нумерация блоков
+        """
+        active_parts = await self.click_table.get_active_parts()
+        if key_name == '-':
+            if len({item['partition'] for item in active_parts}) > 1:
+                return {}
+            return {'-': active_parts} if active_parts else {}
+        blocks = {}
+        for item in active_parts:
+            blocks.setdefault(item['partition'], []).append(item)
+        return blocks
+    
+    @staticmethod
+    def set_blocks(part: Dict, blocks: List[Dict] = None):
+        """Количество записей, размер, последний блок и мутация партиции по ее активным кускам"""
+        if not blocks:
+            return
+        part['count'] = sum([item['count'] for item in blocks])
+        part['bytes'] = sum([item['bytes'] for item in blocks])
+        part['max_block'] = max([item['max_block'] for item in blocks])
+        part['mutation'] = max([item['mutation'] for item in blocks])
+    
+    @staticmethod
+    def get_delta(blocks: List[Dict], last_part: Union[Dict, None]) -> Union[Dict, None]:
+        """
+        Новые куски партиции - с первым блоком после max_block последнего бэкапа.
+        None, если партицию нужно выгрузить целиком: номера блоков прошлого бэкапа неизвестны,
+        к старым кускам применена мутация, старый кусок слит с новым
+        или в старых кусках изменилось количество записей (TTL, схлопывание при слиянии)
+        """
+        if last_part is None or last_part.get('max_block') is None:
+            return None
+        base_block = last_part['max_block']
+        old_count, new_blocks = 0, []
+        for item in blocks:
+            if item['mutation'] > (last_part.get('mutation') or 0):
+                return None
+            if item['min_block'] > base_block:
+                new_blocks.append(item)
+            elif item['max_block'] <= base_block:
+                old_count += item['count']
+            else:
+                return None
+        if not new_blocks or old_count != last_part['count']:
+            return None
+        return {
+            'count': sum([item['count'] for item in new_blocks]),
+            'bytes': sum([item['bytes'] for item in new_blocks]),
+            'base_block': base_block
+        }
+    
+    def estimate_parts_size(self, parts: List[Dict]):
+        bytes_per_row = None if self.metadata is None else self.metadata.bytes_per_row
+        for item in parts:
+            if 'bytes' not in item and bytes_per_row is not None:
+                item['bytes'] = int(item['count'] * bytes_per_row)
         
-    def generate_backup_file_name(self, pkey_value: str) -> str:
+    def get_chunks_count(self, part: Dict) -> int:
+        """
+        Количество файлов, на которое делится партиция: так, чтобы в файл
+        попадало не больше max_rows_per_file записей и max_bytes_per_file байт
+        """
+        chunks = 1
+        if self.max_rows_per_file:
+            chunks = max(chunks, math.ceil(part['count'] / self.max_rows_per_file))
+        if self.max_bytes_per_file and part.get('bytes'):
+            chunks = max(chunks, math.ceil(part['bytes'] / self.max_bytes_per_file))
+        return chunks
+    
+    def get_split_expression(self) -> str:
+        """
+        Выражение, по остатку от деления которого партиция делится на части:
+        split_key из schema.json, ключ сэмплирования или хэш первичного ключа таблицы
+        """
+        if self.split_key:
+            return self.split_key
+        if self.metadata is not None and self.metadata.sampling_key:
+            return self.metadata.sampling_key
+        if self.metadata is not None and self.metadata.primary_key:
+            return f"cityHash64({self.metadata.primary_key})"
+        return "cityHash64(*)"
+    
+    def get_export_filter(
+        self, chunk: int = 0, chunks: int = 1, base_block: int = None, max_block: int = None
+    ) -> Union[str, None]:
+        """
+        Условие выгрузки части партиции: остаток от деления split выражения для chunk
+        и диапазон блоков кусков (base_block, max_block]. Верхняя граница отсекает куски,
+        вставленные после определения партиций: они попадут в следующий бэкап
+        """
+        conditions = []
+        if chunks > 1:
+            conditions.append(f"{self.get_split_expression()} % {chunks} = {chunk}")
+        if base_block is not None:
+            conditions.append(f"{PART_MIN_BLOCK_EXPRESSION} > {base_block}")
+        if max_block is not None:
+            conditions.append(f"{PART_MIN_BLOCK_EXPRESSION} <= {max_block}")
+        return " and ".join(conditions) or None
+    
+    def generate_backup_file_name(
+        self, pkey_value: str, chunk: int = 0, chunks: int = 1, delta: bool = False
+    ) -> str:
         table_label = self.table_name.replace("_", "-")
+        if self.shard:
+            table_label += f"-s{self.shard}"
         pkey_label = pkey_value.replace("-", "")
-        return f"{table_label}-{pkey_label}-{self.datetime_backup}"
-    
-    async def backup_record(self, key_value: str, count: int, backup_guid: str):
-        app_log.info(InfoMessages.START_TASK.value.format(table_name=self.table_name, key_value=key_value))
-        file_name=self.generate_backup_file_name(key_value)
-        path_to_file = ClHouseConfig.get_path_to_s3_function(file_name=file_name)
-        s3_parameters = S3FunctionParameters(
-            path_to_file=path_to_file, 
+        file_name = f"{table_label}-{pkey_label}-{self.datetime_backup}"
+        if chunks > 1:
+            file_name += f"-{chunk + 1}of{chunks}"
+        if delta:
+            file_name += "-delta"
+        return file_name
+    
+    def generate_partitioned_file_name(self, partition_id: str) -> str:
+        """
+        Имя файла в режиме partition_by: значение партиции подставляет clickhouse
+        как есть, поэтому в отличие от generate_backup_file_name оно не изменяется
+        """
+        table_label = self.table_name.replace("_", "-")
+        if self.shard:
+            table_label += f"-s{self.shard}"
+        return f"{table_label}-{partition_id}-{self.datetime_backup}"
+    
+    def make_s3_parameters(self, file_name: str) -> S3FunctionParameters:
+        return S3FunctionParameters(
+            path_to_file=ClHouseConfig.get_path_to_s3_function(
+                file_name=file_name, extension=self.file_format.extension
+            ), 
             s3_access_key=S3Config.ACCESS_KEY, 
             s3_secret_key=S3Config.SECRET_KEY, 
-            format_file=ClHouseConfig.FORMAT_BACKUP_FILE, 
+            format_file=self.file_format.format_file, 
             fields=', '.join([f"{key} {val}" for key, val in self.table_schema.items()]),
-            compression=ClHouseConfig.COMPRESSION_BACKUP
+            compression=self.file_format.s3_compression,
+            settings=self.file_format.get_output_settings()
+        )
+    
+    @staticmethod
+    def get_export_deadline(count: int) -> Union[float, None]:
+        """Предельное время выгрузки файла из count записей, None - без ограничения"""
+        if not AppConfig.EXPORT_DEADLINE:
+            return None
+        if AppConfig.EXPORT_DEADLINE_ROWS_PER_SECOND:
+            return AppConfig.EXPORT_DEADLINE + (count or 0) / AppConfig.EXPORT_DEADLINE_ROWS_PER_SECOND
+        return AppConfig.EXPORT_DEADLINE
+    
+    def track_export(self, query_id: str, count: int, backup_guid: str, key_value: str = None, **fields):
+        """Выгрузка отслеживается в QueryTracker: прогресс, deadline и kill query при ошибке клиента"""
+        if self.tracker is None:
+            return nullcontext()
+        return self.tracker.track(
+            query_id, 
+            ClickhouseCatalog(self.click_connect), 
+            self.get_export_deadline(count), 
+            **log_context(backup_guid, self.table_name, key_value, **fields)
+        )
+    
+    def make_query_id(self, backup_guid: str, key_value: str, chunk: int, attempt: int) -> str:
+        """Детерминированный query_id запроса выгрузки: по нему ищется статистика в system.query_log"""
+        shard_label = f"/{self.shard}" if self.shard else ""
+        return str(uuid5(UUID(str(backup_guid)), f"{self.table_name}{shard_label}/{key_value}/{chunk}/{attempt}"))
+    
+    def retry(self, action: partial, weight: int, attempt: int, partition_value: str) -> None:
+        """Повторная постановка задания в очередь с экспоненциальной задержкой"""
+        delay = get_retry_delay(attempt)
+        app_log.warning(
+            InfoMessages.RETRY_TASK.value.format(
+                attempt=attempt, table_name=self.table_name, partition_value=partition_value, delay=round(delay)
+            ),
+            exc_info=True,
+            extra=log_context(table=self.table_name, partition=partition_value, attempt=attempt)
+        )
+        self.scheduler.put(
+            table_name=self.job_name,
+            weight=weight,
+            action=partial(action, attempt=attempt + 1),
+            delay=delay
         )
-        await self.semaphore.acquire()
+    
+    def schedule_record(self, key_value: str, backup_guid: str):
+        """Отметка в backup_log о том, что партиция поставлена в очередь: по ней работает backup --resume"""
+        self.psql_writer.add(
+            BackupLogEntity(
+                backup_guid=backup_guid,
+                table_name=self.table_name,
+                partition_key=key_value,
+                event=InfoMessages.TASK_SCHEDULED.value,
+                level=DBLevelLog.INFO,
+                shard=self.shard
+            )
+        )
+    
+    def put_record(self, part: Dict, key_name: str, backup_guid: str, chunks: int, chunk: int):
+        self.scheduler.put(
+            table_name=self.job_name,
+            weight=part.get('bytes', part['count']) // chunks,
+            action=partial(
+                self.backup_record,
+                key_value=str(part[key_name]),
+                count=split_count(part['count'], chunks, chunk), 
+                backup_guid=backup_guid,
+                checksum=part.get('checksum'),
+                modification_time=part.get('modification_time'),
+                chunk=chunk,
+                chunks=chunks,
+                base_block=part.get('base_block'),
+                max_block=part.get('max_block'),
+                mutation=part.get('mutation')
+            )
+        )
+    
+    async def export_record(
+        self, 
+        key_value: str, 
+        count: int, 
+        backup_guid: str, 
+        checksum: str = None, 
+        modification_time: int = None,
+        chunk: int = 0,
+        chunks: int = 1,
+        base_block: int = None,
+        max_block: int = None,
+        mutation: int = None,
+        attempt: int = 1
+    ) -> BackupHistoryEntity:
+        """
+        Выгрузка части chunk партиции в s3, ошибка выгрузки пробрасывается.
+        Если задан base_block, выгружаются только куски с блоками после него (delta).
+        Куски могут слиться между определением партиций и выгрузкой: слитый кусок начинается
+        с блока до base_block, и его новые записи в delta не попадают. Тогда партиция
+        из одного файла выгружается заново целиком, а у разбитой на части не продвигается max_block
+        """
+        t_start = time.time()
+        file_name=self.generate_backup_file_name(key_value, chunk, chunks, delta=base_block is not None)
+        written = await self.export_file(
+            file_name, key_value, count, backup_guid, chunk, attempt,
+            chunk_filter=self.get_export_filter(chunk, chunks, base_block, max_block),
+            query_id=self.make_query_id(backup_guid, key_value, chunk, attempt)
+        )
+        if base_block is not None and not await self.delta_complete(key_value, count, written, base_block, chunks):
+            context = log_context(backup_guid, self.table_name, key_value, chunk=chunk, attempt=attempt)
+            action = "the partition is exported in full" if chunks == 1 else "the next backup exports it in full"
+            app_log.warning(
+                InfoMessages.DELTA_INCOMPLETE.value.format(
+                    table_name=self.table_name, partition_value=key_value, written=written, expected=count,
+                    action=action
+                ),
+                extra=context
+            )
+            if chunks == 1:
+                base_block = None
+                file_name = self.generate_backup_file_name(key_value, chunk, chunks)
+                written = await self.export_file(
+                    file_name, key_value, count, backup_guid, chunk, attempt,
+                    chunk_filter=self.get_export_filter(chunk, chunks, max_block=max_block),
+                    query_id=self.make_query_id(backup_guid, f"{key_value}/full", chunk, attempt)
+                )
+                count = count if written is None else written
+            else:
+                # части delta выгружаются независимыми заданиями, и переделать целиком одну часть нельзя
+                max_block = None
+        return BackupHistoryEntity(
+            backup_guid=backup_guid, 
+            table_name=self.table_name, 
+            partition_key=key_value, 
+            count=count, 
+            file_name=file_name,
+            execution_time = time.time() - t_start,
+            file_format=self.file_format.format_file,
+            compression=self.file_format.compression,
+            checksum=checksum,
+            modification_time=modification_time,
+            chunk=chunk,
+            chunks=chunks,
+            shard=self.shard,
+            base_block=base_block,
+            max_block=max_block,
+            mutation=mutation
+        )
+    
+    async def export_file(
+        self,
+        file_name: str,
+        key_value: str,
+        count: int,
+        backup_guid: str,
+        chunk: int,
+        attempt: int,
+        chunk_filter: str = None,
+        query_id: str = None
+    ) -> Optional[int]:
+        """Выгрузка одного файла партиции, возвращает число записанных строк (None, если сервер его не передал)"""
         t_start = time.time()
+        async with self.track_export(query_id, count, backup_guid, key_value, chunk=chunk, attempt=attempt):
+            written = await self.click_table.create_backup(
+                self.partition_key, key_value, self.make_s3_parameters(file_name), chunk_filter, query_id=query_id
+            )
+        self.queries.append(
+            {
+                'query_id': query_id, 'backup_guid': backup_guid, 'partition_key': key_value, 'chunk': chunk,
+                'started': t_start
+            }
+        )
+        return written
+    
+    async def delta_complete(
+        self, key_value: str, count: int, written: Optional[int], base_block: int, chunks: int
+    ) -> bool:
+        """
+        Все ли новые записи партиции попали в delta. Для одного файла сравнивается число записанных
+        строк; части делятся по хешу, и их размер заранее неизвестен - тогда, как и без данных
+        о записанных строках, проверяется, что ни один активный кусок не пересекает base_block
+        """
+        if chunks == 1 and written is not None:
+            return written == count
+        blocks = await self.get_partition_blocks('-' if key_value == '-' else self.partition_key)
+        return all(
+            [item['min_block'] > base_block or item['max_block'] <= base_block for item in blocks.get(key_value, [])]
+        )
+    
+    async def backup_record(
+        self, 
+        key_value: str, 
+        count: int, 
+        backup_guid: str, 
+        checksum: str = None, 
+        modification_time: int = None,
+        chunk: int = 0,
+        chunks: int = 1,
+        base_block: int = None,
+        max_block: int = None,
+        mutation: int = None,
+        attempt: int = 1
+    ):
+        context = log_context(backup_guid, self.table_name, key_value, chunk=chunk, attempt=attempt)
+        app_log.info(
+            InfoMessages.START_TASK.value.format(table_name=self.table_name, key_value=key_value), extra=context
+        )
         try:
-            await self.click_table.create_backup(self.partition_key, key_value, s3_parameters)
+            data = await self.export_record(
+                key_value, count, backup_guid, checksum, modification_time, chunk, chunks, 
+                base_block, max_block, mutation, attempt
+            )
         except Exception as err:
-            event_error = True
+            if can_retry(err, attempt):
+                JOBS.inc(table=self.table_name, status="retry")
+                self.retry(
+                    partial(
+                        self.backup_record, key_value=key_value, count=count, backup_guid=backup_guid, 
+                        checksum=checksum, modification_time=modification_time, chunk=chunk, chunks=chunks,
+                        base_block=base_block, max_block=max_block, mutation=mutation
+                    ),
+                    weight=count, attempt=attempt, partition_value=key_value
+                )
+                return
+            JOBS.inc(table=self.table_name, status="error")
             app_log.error(
                 InfoMessages.TASK_ERROR.value.format(table_name=self.table_name, partition_value=key_value),
-                exc_info=True
+                exc_info=True,
+                extra=context
             )
-            error_message = err.__str__()
-        else:
-            event_error = False           
-        self.semaphore.release()
-        
-        if event_error:
             data = BackupLogEntity(
                 backup_guid=backup_guid,
                 table_name=self.table_name, 
                 partition_key=key_value, 
-                event=error_message,
-                level=DBLevelLog.ERROR
+                event=err.__str__(),
+                level=DBLevelLog.ERROR,
+                shard=self.shard
             )
-            coro = self.psql_table.insert_backup_log
         else:
-            data = BackupHistoryEntity(
-                backup_guid=backup_guid, 
-                table_name=self.table_name, 
-                partition_key=key_value, 
-                count=count, 
-                file_name=file_name,
-                execution_time = time.time() - t_start
+            app_log.info(
+                InfoMessages.TASK_COMPLETE.value.format(
+                    table_name=self.table_name, partition_value=key_value, file_name=data.file_name
+                ),
+                extra={**context, 'duration': round(data.execution_time, 3)}
             )
-            coro = self.psql_table.insert_backup_history
-        
+            self.scheduler.add_processed_rows(count)
+            JOBS.inc(table=self.table_name, status="success")
+            ROWS.inc(count, table=self.table_name)
+        self.psql_writer.add(data)
+    
+    async def backup_partitions(self, parts: List[Dict], key_name: str, backup_guid: str, attempt: int = 1):
+        """
+        Режим partition_by: все партиции выгружаются одним запросом
+        insert into function s3(...) partition by, после чего на каждый
+        полученный файл записывается своя строка в backup_history
+        """
+        context = log_context(backup_guid, self.table_name, attempt=attempt)
+        app_log.info(
+            InfoMessages.START_PARTITIONED_TASK.value.format(table_name=self.table_name, count=len(parts)), 
+            extra=context
+        )
+        s3_parameters = self.make_s3_parameters(self.generate_partitioned_file_name("{_partition_id}"))
+        query_id = self.make_query_id(backup_guid, "*", 0, attempt)
+        t_start = time.time()
         try:
-            await coro(data)
-        except:
-            app_log.warning(InfoMessages.PSQL_ERROR.value, exc_info=True)
+            async with self.track_export(query_id, sum([part['count'] for part in parts]), backup_guid, attempt=attempt):
+                await self.click_table.create_partitioned_backup(
+                    self.partition_key, [str(part[key_name]) for part in parts], s3_parameters, query_id=query_id
+                )
+        except Exception as err:
+            if can_retry(err, attempt):
+                JOBS.inc(table=self.table_name, status="retry")
+                self.retry(
+                    partial(self.backup_partitions, parts=parts, key_name=key_name, backup_guid=backup_guid),
+                    weight=sum([part.get('bytes', part['count']) for part in parts]), 
+                    attempt=attempt, 
+                    partition_value=self.partition_key
+                )
+                return
+            JOBS.inc(table=self.table_name, status="error")
+            app_log.error(
+                InfoMessages.TASK_ERROR.value.format(table_name=self.table_name, partition_value=self.partition_key),
+                exc_info=True,
+                extra=context
+            )
+            for part in parts:
+                self.psql_writer.add(
+                    BackupLogEntity(
+                        backup_guid=backup_guid,
+                        table_name=self.table_name, 
+                        partition_key=str(part[key_name]), 
+                        event=err.__str__(),
+                        level=DBLevelLog.ERROR,
+                        shard=self.shard
+                    )
+                )
+            return
+        execution_time = time.time() - t_start
+        total_count = sum([part['count'] for part in parts]) or 1
+        self.scheduler.add_processed_rows(total_count)
+        JOBS.inc(table=self.table_name, status="success")
+        ROWS.inc(total_count, table=self.table_name)
+        # один запрос на все партиции: статистика сохраняется с partition_key = '*'
+        self.queries.append(
+            {'query_id': query_id, 'backup_guid': backup_guid, 'partition_key': "*", 'chunk': 0, 'started': t_start}
+        )
+        for part in parts:
+            self.psql_writer.add(
+                BackupHistoryEntity(
+                    backup_guid=backup_guid, 
+                    table_name=self.table_name, 
+                    partition_key=str(part[key_name]), 
+                    count=part['count'], 
+                    file_name=self.generate_partitioned_file_name(str(part[key_name])),
+                    execution_time=execution_time * part['count'] / total_count,
+                    file_format=self.file_format.format_file,
+                    compression=self.file_format.compression,
+                    checksum=part.get('checksum'),
+                    modification_time=part.get('modification_time'),
+                    shard=self.shard
+                )
+            )
+    
+    @property
+    def key_name(self) -> str:
+        return '-' if self.partition_key is None else self.partition_key
     
-    async def backup(self, backup_guid: UUID, force: bool = None):
+    async def prepare(
+        self, force: bool = None, metadata: TableMetadata = None, deltas: bool = True, schema: TableSchema = None
+    ) -> List[Dict]:
+        """
+        Схема таблицы и список партиций для бэкапа (см. make_keys_list_for_backup),
+        для каждой партиции определяется число файлов chunks.
+        Новые куски партиции (delta) выгружаются одним файлом: так незавершенная
+        delta не остается частично выгруженной
+        """
         await self._init()
+        self.metadata = metadata
         if not force:
-            check = await self.check_relevance_backup_schema(backup_guid)
+            check = await self.check_relevance_backup_schema(schema)
             if check == False:
                 force = True
         else:
-            self.table_schema = await self.click_table.get_schema_table()
+            await self.load_schema(schema)
+        parts_to_backup = await self.make_keys_list_for_backup(force, self.key_name, deltas)
+        partitioned = self.export_mode == ExportMode.PARTITION_BY and self.key_name != '-'
+        for part in parts_to_backup:
+            single = partitioned or part.get('base_block') is not None
+            part['chunks'] = 1 if single else self.get_chunks_count(part)
+        return parts_to_backup
+    
+    def schedule(self, backup_guid: UUID, scheduler: Scheduler, parts_to_backup: List[Dict]):
+        """Постановка заданий на выгрузку партиций в общую очередь scheduler"""
+        self.scheduler = scheduler
+        if not parts_to_backup:
+            return
+        self.scheduled = True
+        key_name = self.key_name
+        self.create_backup_schema(backup_guid)
+        scheduler.set_table_limit(self.job_name, self.max_threads)
+        for part in parts_to_backup:
+            self.schedule_record(str(part[key_name]), str(backup_guid))
+        if self.export_mode == ExportMode.PARTITION_BY and key_name != '-':
+            scheduler.put(
+                table_name=self.job_name,
+                weight=sum([part.get('bytes', part['count']) for part in parts_to_backup]),
+                action=partial(
+                    self.backup_partitions, 
+                    parts=parts_to_backup, 
+                    key_name=key_name, 
+                    backup_guid=str(backup_guid)
+                )
+            )
+            return
+        for part in parts_to_backup:
+            for chunk in range(part['chunks']):
+                self.put_record(part, key_name, str(backup_guid), part['chunks'], chunk)
+    
+    async def enqueue(
+        self, backup_guid: UUID, force: bool = None, metadata: TableMetadata = None, schema: TableSchema = None
+    ) -> List[BackupJobEntity]:
+        """
+        Вместо выгрузки партиции записываются заданиями в backup_jobs,
+        их выполняют процессы manage.py worker. Режим partition_by в очереди
+        не используется: каждая партиция выгружается отдельным заданием.
+        Задания не содержат номеров блоков, поэтому партиции выгружаются целиком.
+        Схема и backup_log записываются сразу, а задания возвращаются: их записывают
+        только после сброса схемы, иначе worker может взять задание раньше, чем она появится
+        """
+        parts_to_backup = await self.prepare(force, metadata, deltas=False, schema=schema)
+        if not parts_to_backup:
+            return []
+        self.create_backup_schema(backup_guid)
+        jobs = []
+        for part in parts_to_backup:
+            self.schedule_record(str(part[self.key_name]), str(backup_guid))
+            chunks = self.get_chunks_count(part)
+            for chunk in range(chunks):
+                jobs.append(
+                    BackupJobEntity(
+                        backup_guid=backup_guid,
+                        table_name=self.table_name,
+                        partition_key=str(part[self.key_name]),
+                        chunk=chunk,
+                        chunks=chunks,
+                        count=split_count(part['count'], chunks, chunk),
+                        bytes=None if part.get('bytes') is None else part['bytes'] // chunks,
+                        checksum=part.get('checksum'),
+                        modification_time=part.get('modification_time'),
+                        datetime_backup=self.datetime_backup
+                    )
+                )
+        return jobs
+    
+    async def backup(
+        self, 
+        backup_guid: UUID, 
+        scheduler: Scheduler, 
+        force: bool = None, 
+        metadata: TableMetadata = None, 
+        schema: TableSchema = None
+    ):
+        """
+        Определяет партиции для бэкапа и ставит задания на их выгрузку
+        в общую очередь scheduler. Сами выгрузки выполняются воркерами планировщика.
+        """
+        self.schedule(backup_guid, scheduler, await self.prepare(force, metadata, schema=schema))
+    
+    async def plan(
+        self, 
+        force: bool = None, 
+        metadata: TableMetadata = None, 
+        rows_per_second: float = None, 
+        schema: TableSchema = None
+    ) -> Dict:
+        """
+        План бэкапа таблицы без выгрузки: партиции, оценка записей, байт (system.parts)
+        и времени выгрузки по средней скорости прошлых бэкапов rows_per_second
+        """
+        parts_to_backup = await self.prepare(force, metadata, schema=schema)
+        partitions = [
+            {
+                'partition': str(part[self.key_name]),
+                'count': part['count'],
+                'bytes': part.get('bytes'),
+                'checksum': part.get('checksum'),
+                'modification_time': part.get('modification_time'),
+                'chunks': part['chunks'],
+                'base_block': part.get('base_block'),
+                'max_block': part.get('max_block'),
+                'mutation': part.get('mutation'),
+                'estimated_seconds': round(part['count'] / rows_per_second, 1) if rows_per_second else None
+            } for part in parts_to_backup
+        ]
+        return {
+            'table_name': self.table_name,
+            'partition_key': self.partition_key,
+            'export_mode': self.export_mode.value,
+            'schema': self.table_schema,
+            'rows_per_second': rows_per_second,
+            'count': sum([part['count'] for part in partitions]),
+            'bytes': sum([part['bytes'] or 0 for part in partitions]),
+            'estimated_seconds': sum([part['estimated_seconds'] or 0 for part in partitions]),
+            'partitions': partitions
+        }
+    
+    async def execute_plan(
+        self, 
+        backup_guid: UUID, 
+        scheduler: Scheduler, 
+        table_plan: Dict, 
+        metadata: TableMetadata = None, 
+        schema: TableSchema = None
+    ):
+        """
+        Выгрузка партиций из сохраненного плана как есть, без повторной сверки.
+        Если схема таблицы изменилась после составления плана, таблица пропускается.
+        """
+        await self._init()
+        self.metadata = metadata
+        await self.load_schema(schema)
+        if self.table_schema != table_plan['schema']:
+            app_log.error(InfoMessages.PLAN_OUTDATED.value.format(table_name=self.table_name))
+            return
+        parts_to_backup = [
+            {
+                self.key_name: item['partition'],
+                'count': item['count'],
+                'bytes': item['bytes'],
+                'checksum': item['checksum'],
+                'modification_time': item['modification_time'],
+                'chunks': item['chunks'],
+                'base_block': item.get('base_block'),
+                'max_block': item.get('max_block'),
+                'mutation': item.get('mutation')
+            } for item in table_plan['partitions']
+        ]
+        for part in parts_to_backup:
+            if part['bytes'] is None:
+                del part['bytes']
+        self.schedule(backup_guid, scheduler, parts_to_backup)
+    
+    async def resume(
+        self, backup_guid: UUID, scheduler: Scheduler, partitions: List[Dict], metadata: TableMetadata = None
+    ):
+        """
+        Досоздание бэкапа backup_guid: для незавершенных партиций заново считаются
+        записи и в очередь ставятся только недостающие части (chunk),
+        либо партиция целиком, если ни одна ее часть не выгружена.
+        Используется схема таблицы, сохраненная при создании бэкапа.
+        Номера блоков при досоздании не сохраняются: следующий бэкап
+        выгрузит эти партиции целиком.
+        """
+        await self._init()
+        self.metadata = metadata
+        self.scheduler = scheduler
+        with_checksum = self.change_detection == ChangeDetection.CHECKSUM
         key_name = '-' if self.partition_key is None else self.partition_key
-        parts_to_backup = await self.make_keys_list_for_backup(force, key_name)
-        if parts_to_backup:
-            await self.create_backup_schema(backup_guid)
-            tasks = [
-                asyncio.create_task(
-                    self.backup_record(
-                        key_value=str(part[key_name]),
-                        count=part['count'], 
-                        backup_guid=str(backup_guid)
-                    ),
-                    name=f"{self.table_name}-{part[key_name]}"
-                ) for part in parts_to_backup
-            ]
-            done, pending = await asyncio.wait(tasks)
-        
-        await self._close()
+        try:
+            self.table_schema = await self.psql_table.get_backup_schema(backup_guid, self.table_name)
+            if not self.table_schema:
+                self.table_schema = await self.click_table.get_schema_table()
+                self.create_backup_schema(backup_guid)
+            known_parts = {}
+            if self.use_parts_discovery(key_name):
+                known_parts = {str(part[key_name]): part for part in self.get_parts_from_metadata(key_name)}
+            parts = []
+            for item in partitions:
+                part = known_parts.get(item['partition_key'])
+                if part is None:
+                    part = await self.click_table.get_partition_records(
+                        self.partition_key, item['partition_key'], with_checksum
+                    )
+                parts.append({**part, key_name: item['partition_key']})
+        except Exception as err:
+            app_log.error(err, exc_info=True)
+            raise
+        self.estimate_parts_size(parts)
+        self.scheduled = bool(parts)
+        scheduler.set_table_limit(self.job_name, self.max_threads)
+        for part, item in zip(parts, partitions):
+            if item['chunks'] is None:
+                chunks = self.get_chunks_count(part)
+                missing_chunks = range(chunks)
+            else:
+                chunks = item['chunks']
+                missing_chunks = sorted(set(range(chunks)) - set(item['chunks_done']))
+            for chunk in missing_chunks:
+                self.put_record(part, key_name, str(backup_guid), chunks, chunk)
         
         
 class Backup(App):
@@ -221,63 +1111,995 @@ class Backup(App):
     
     def __init__(self):
         self.backup_guid = uuid4()
+        self.shards: List[Dict] = []
+        self.tracker = QueryTracker()
+        self.stopped: int = None
         with open(self.path_to_schema, "r") as f:
             self.tables_for_backup = json.load(f)
-        self.semaphore = asyncio.Semaphore(value=AppConfig.COUNT_THREADS)
+        self.scheduler = create_scheduler()
+        self.default_format = BackupFileFormat(
+            format_file=ClHouseConfig.FORMAT_BACKUP_FILE,
+            compression=ClHouseConfig.COMPRESSION_BACKUP,
+            compression_level=ClHouseConfig.COMPRESSION_LEVEL_BACKUP
+        )
         
-    def find_partition_key(self, table_name: str) -> Union[str, None]:
+    def find_table_config(self, table_name: str) -> TableConfig:
         for item in self.tables_for_backup:
             if table_name == item['table_name']:
-                return item['partition_key']
-        return None
+                return TableConfig.from_dict(item, self.default_format)
+        return TableConfig(table_name=table_name, partition_key=None, file_format=self.default_format)
     
-    async def _execute(self, table: str = None, force: bool = None):
-        app_log.info(InfoMessages.START_BACKUP.value.format(backup_guid=self.backup_guid))
-        datetime_backup = datetime.now().strftime("%Y%m%d%H%M%S")
+    async def connect_shards(self) -> List[Dict]:
+        """
+        Для кластера CLICK_CLUSTER на каждый шард выбирается первая отвечающая реплика
+        (в порядке возрастания errors_count из system.clusters) и создается пул соединений с ней
+        """
+        replicas = await ClickhouseCatalog(self.click_connect).get_cluster_replicas(ClHouseConfig.CLUSTER)
+        shards = {}
+        for replica in replicas:
+            shards.setdefault(replica['shard_num'], []).append(replica)
+        self.shards = []
+        for shard_num, shard_replicas in sorted(shards.items()):
+            for replica in shard_replicas:
+                pools = []
+                connection_data = ClHouseConfig.get_connection_data()
+                connection_data.update(host=replica['host_address'], port=replica['port'])
+                try:
+                    pools.append(await create_pool(maxsize=ClHouseConfig.POOL_MAXSIZE, **connection_data))
+                    pools.append(await create_pool(maxsize=self.export_pool_size, **connection_data))
+                    catalog = ClickhouseCatalog(*pools)
+                    await catalog.ping()
+                    await catalog.warm_up(min(AppConfig.COUNT_THREADS, self.export_pool_size), export=True)
+                except Exception:
+                    app_log.warning(
+                        InfoMessages.REPLICA_UNAVAILABLE.value.format(shard=shard_num, host=replica['host_name']),
+                        exc_info=True
+                    )
+                    for pool in pools:
+                        pool.close()
+                        await pool.wait_closed()
+                    continue
+                app_log.info(InfoMessages.SHARD_REPLICA.value.format(shard=shard_num, host=replica['host_name']))
+                self.shards.append(
+                    {'shard': shard_num, 'host': replica['host_name'], 'pool': pools[0], 'export_pool': pools[1]}
+                )
+                break
+            else:
+                raise ErrorClusterShard(InfoMessages.NO_SHARD_REPLICA.value.format(shard=shard_num))
+        return self.shards
+    
+    async def make_cluster_tables(
+        self, table_names: List[str], datetime_backup: str
+    ) -> Tuple[List[Table], Dict[Tuple[str, int], TableMetadata], Dict[Tuple[str, int], TableSchema]]:
+        """
+        Таблицы для бэкапа по шардам: для Distributed таблицы выгружается ее локальная
+        таблица (local_table из schema.json или таблица из описания движка) на каждом шарде
+        """
+        shards = await self.connect_shards()
+        distributed = await self.get_metadata(self.make_tables(table_names, datetime_backup))
+        written_schemas = set()
+        tables, metadata, schemas = [], {}, {}
+        for shard in shards:
+            shard_tables = []
+            for table_name in table_names:
+                config = self.find_table_config(table_name=table_name)
+                source_table = config.local_table
+                if source_table is None and table_name in distributed:
+                    source_table = distributed[table_name].distributed_table
+                shard_tables.append(
+                    Table(
+                        config=config,
+                        psql=self.psql_pool,
+                        psql_writer=self.psql_writer,
+                        click_pool=shard['pool'],
+                        datetime_backup=datetime_backup,
+                        shard=shard['shard'],
+                        source_table=source_table,
+                        written_schemas=written_schemas,
+                        export_pool=shard['export_pool'],
+                        tracker=self.tracker
+                    )
+                )
+            try:
+                shard_metadata = await ClickhouseCatalog(shard['pool']).get_tables_metadata(
+                    [table.source_table for table in shard_tables]
+                )
+            except Exception:
+                app_log.warning(InfoMessages.ERROR_METADATA.value, exc_info=True)
+                shard_metadata = {}
+            shard_schemas = await self.get_schemas(shard_tables, shard['pool'])
+            for table in shard_tables:
+                metadata[(table.table_name, table.shard)] = shard_metadata.get(table.source_table)
+                schemas[(table.table_name, table.shard)] = shard_schemas.get(table.table_name)
+            tables += shard_tables
+        # воркеров хватает на верхнюю границу регулятора по всем шардам, вначале COUNT_THREADS выгрузок на шард
+        self.scheduler.set_workers(self.concurrency * len(shards))
+        await self.scheduler.set_concurrency(AppConfig.COUNT_THREADS * len(shards))
+        if self.controller is not None:
+            self.controller.set_shards({shard['shard']: ClickhouseCatalog(shard['pool']) for shard in shards})
+        return tables, metadata, schemas
+    
+    async def _close(self):
+        for shard in self.shards:
+            for pool in (shard['pool'], shard['export_pool']):
+                pool.close()
+                await pool.wait_closed()
+        await super()._close()
+    
+    def make_tables(self, table_names: List[str], datetime_backup: str) -> List[Table]:
+        return [
+            Table(
+                config=self.find_table_config(table_name=table_name),
+                psql=self.psql_pool,
+                psql_writer=self.psql_writer,
+                click_pool=self.click_connect,
+                datetime_backup=datetime_backup,
+                export_pool=self.export_connect,
+                tracker=self.tracker
+            ) for table_name in table_names
+        ]
+    
+    def get_table_names(self, table: str = None) -> List[str]:
         if table is None:
-            tables = [
-                Table(
-                    table_name=item['table_name'],
-                    partition_key=item['partition_key'],
-                    semaphore=self.semaphore,
-                    psql=self.psql_pool,
-                    click_pool=self.click_connect,
-                    datetime_backup=datetime_backup
-                ) for item in self.tables_for_backup
+            return [item['table_name'] for item in self.tables_for_backup]
+        return [table]
+    
+    async def get_metadata(self, tables: List[Table]) -> Dict[str, TableMetadata]:
+        try:
+            return await ClickhouseCatalog(self.click_connect).get_tables_metadata(
+                [table.table_name for table in tables]
+            )
+        except Exception:
+            app_log.warning(InfoMessages.ERROR_METADATA.value, exc_info=True)
+            return {}
+    
+    async def get_schemas(self, tables: List[Table], click_pool: ClickPool = None) -> Dict[str, TableSchema]:
+        """
+        Схемы всех таблиц одним запросом к system.columns и отпечатки схем их последних
+        бэкапов одним запросом к postgresql. При ошибке схемы запрашиваются по каждой таблице
+        """
+        try:
+            fields = await ClickhouseCatalog(click_pool or self.click_connect).get_tables_schema(
+                [table.source_table for table in tables]
+            )
+            last_schemas = await PsQLTable(psql_pool=self.psql_pool).get_last_backup_schemas(
+                [table.table_name for table in tables]
+            )
+        except Exception:
+            app_log.warning(InfoMessages.ERROR_TABLES_SCHEMA.value, exc_info=True)
+            return {}
+        return {
+            table.table_name: TableSchema(fields=fields[table.source_table], **last_schemas.get(table.table_name, {}))
+            for table in tables if table.source_table in fields
+        }
+    
+    async def _execute(
+        self, table: str = None, force: bool = None, resume: UUID = None, plan: Dict = None, queue: bool = False
+    ):
+        """
+        Если указан resume, новый бэкап не создается: дозагружаются
+        незавершенные партиции бэкапа resume (или только таблицы table).
+        Если указан plan, выгружаются партиции сохраненного плана (см. BackupPlan).
+        Если queue = True, партиции только ставятся в очередь backup_jobs (см. Worker)
+        """
+        datetime_backup = datetime.now().strftime("%Y%m%d%H%M%S")
+        if plan is not None:
+            self.backup_guid = UUID(plan['backup_guid'])
+            # повторное выполнение плана записало бы вторую копию файлов под тем же guid
+            if await PsQLTable(psql_pool=self.psql_pool).backup_exists(self.backup_guid):
+                raise ValueError(InfoMessages.PLAN_ALREADY_EXECUTED.value.format(backup_guid=self.backup_guid))
+            app_log.info(InfoMessages.START_PLAN_EXECUTION.value.format(backup_guid=self.backup_guid))
+            table_plans = {
+                item['table_name']: item for item in plan['tables'] if table is None or item['table_name'] == table
+            }
+            tables = self.make_tables(list(table_plans), datetime_backup)
+            metadata = await self.get_metadata(tables)
+            schemas = await self.get_schemas(tables)
+            tasks = [
+                asyncio.create_task(
+                    table.execute_plan(
+                        self.backup_guid, self.scheduler, table_plans[table.table_name], 
+                        metadata.get(table.table_name), schemas.get(table.table_name)
+                    ),
+                    name=table.table_name
+                ) for table in tables
             ]
-        else:
-            partition_key = self.find_partition_key(table_name=table)
-            tables = [
-                Table(
-                    table_name=table,
-                    partition_key=partition_key, 
-                    semaphore=self.semaphore, 
-                    psql=self.psql_pool,
-                    click_pool=self.click_connect,
-                    datetime_backup=datetime_backup
+        elif resume is not None:
+            self.backup_guid = resume
+            unfinished = {}
+            for item in await PsQLTable(psql_pool=self.psql_pool).get_unfinished_partitions(resume, table):
+                unfinished.setdefault((item['table_name'], item['shard']), []).append(item)
+            app_log.info(
+                InfoMessages.START_RESUME.value.format(
+                    backup_guid=resume, count=sum([len(items) for items in unfinished.values()])
                 )
+            )
+            table_names = list(dict.fromkeys([table_name for table_name, _ in unfinished]))
+            if ClHouseConfig.CLUSTER:
+                # партиции каждого шарда дозагружаются с его реплики, а не через Distributed таблицу
+                tables, metadata, _ = await self.make_cluster_tables(table_names, datetime_backup)
+            else:
+                tables = self.make_tables(table_names, datetime_backup)
+                metadata = {(name, 0): value for name, value in (await self.get_metadata(tables)).items()}
+            tables = [table for table in tables if (table.table_name, table.shard) in unfinished]
+            tasks = [
+                asyncio.create_task(
+                    table.resume(
+                        self.backup_guid, self.scheduler, unfinished[(table.table_name, table.shard)],
+                        metadata.get((table.table_name, table.shard))
+                    ),
+                    name=table.job_name
+                ) for table in tables
+            ]
+        elif queue and ClHouseConfig.CLUSTER:
+            raise ValueError(InfoMessages.QUEUE_CLUSTER.value)
+        elif ClHouseConfig.CLUSTER:
+            app_log.info(InfoMessages.START_BACKUP.value.format(backup_guid=self.backup_guid))
+            tables, metadata, schemas = await self.make_cluster_tables(self.get_table_names(table), datetime_backup)
+            tasks = [
+                asyncio.create_task(
+                    table.backup(
+                        self.backup_guid, self.scheduler, force, 
+                        metadata[(table.table_name, table.shard)], schemas[(table.table_name, table.shard)]
+                    ),
+                    name=table.job_name
+                ) for table in tables
+            ]
+        elif queue:
+            tables = self.make_tables(self.get_table_names(table), datetime_backup)
+            metadata = await self.get_metadata(tables)
+            schemas = await self.get_schemas(tables)
+            try:
+                table_jobs = await asyncio.gather(
+                    *[
+                        table.enqueue(
+                            self.backup_guid, force, metadata.get(table.table_name), schemas.get(table.table_name)
+                        ) for table in tables
+                    ]
+                )
+            finally:
+                for table in tables:
+                    await table._close()
+            jobs = [job for items in table_jobs for job in items]
+            # задания становятся видны worker только после записи схемы и backup_log
+            await self.psql_writer.flush()
+            for job in jobs:
+                self.psql_writer.add(job)
+            app_log.info(InfoMessages.BACKUP_QUEUED.value.format(backup_guid=self.backup_guid, count=len(jobs)))
+            return
+        else:
+            app_log.info(InfoMessages.START_BACKUP.value.format(backup_guid=self.backup_guid))
+            tables = self.make_tables(self.get_table_names(table), datetime_backup)
+            metadata = await self.get_metadata(tables)
+            schemas = await self.get_schemas(tables)
+            tasks = [
+                asyncio.create_task(
+                    table.backup(
+                        self.backup_guid, self.scheduler, force, metadata.get(table.table_name), 
+                        schemas.get(table.table_name)
+                    ), 
+                    name=table.table_name
+                ) for table in tables
             ]
-            
-        tasks = [
-            asyncio.create_task(table.backup(self.backup_guid, force), name=table.table_name) for table in tables
-        ]
         
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop, signum)
         try:
             done, _ = await asyncio.wait(tasks)
+            await self.scheduler.run()
+            if not self.stopped:
+                await self.save_manifest(tables)
+            if AppConfig.QUERY_STATS:
+                await self.save_query_stats(tables)
         except Exception:
             app_log.error(InfoMessages.ERROR_BACKUP.value.format(backup_guid=self.backup_guid), exc_info=True)
             raise
         else:
-            app_log.info(InfoMessages.COMPLETE_BACKUP.value.format(backup_guid=self.backup_guid))   
+            if self.stopped:
+                app_log.warning(InfoMessages.STOPPED_BACKUP.value.format(backup_guid=self.backup_guid))
+            else:
+                app_log.info(InfoMessages.COMPLETE_BACKUP.value.format(backup_guid=self.backup_guid))   
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            for table in tables:
+                await table._close()
+    
+    def stop(self, signum: int):
+        """
+        SIGINT/SIGTERM: задания из очереди больше не запускаются, выполняемые выгрузки
+        останавливаются на сервере kill query, после чего бэкап завершается как обычно
+        (записи в postgresql сбрасываются, соединения закрываются).
+        Повторный сигнал обрабатывается по умолчанию и прерывает процесс сразу
+        """
+        asyncio.get_running_loop().remove_signal_handler(signum)
+        if self.stopped:
+            return
+        self.stopped = signum
+        app_log.warning(
+            InfoMessages.STOP_BACKUP.value.format(signal=signal.Signals(signum).name, backup_guid=self.backup_guid)
+        )
+        self.scheduler.stop()
+        self.tracker.cancel()
+
+    async def save_manifest(self, tables: List[Table]):
+        """
+        Манифест бэкапа: для каждой партиции выгруженных таблиц цепочка файлов -
+        последняя полная выгрузка и следующие за ней delta, из которых восстанавливается
+        состояние партиции. Сохраняется в backup_manifest и файлом manifest-{backup_guid}.json в s3
+        """
+        # цепочки строит триггер backup_history, поэтому сначала дописываются все записи
+        await self.psql_writer.flush()
+        psql_table = PsQLTable(psql_pool=self.psql_pool)
+        manifest = []
+        for table in tables:
+            if not table.scheduled:
+                continue
+            try:
+                files = await psql_table.save_manifest(
+                    self.backup_guid, table.table_name, table.shard, table.partition_values
+                )
+            except Exception:
+                app_log.warning(InfoMessages.ERROR_MANIFEST.value.format(backup_guid=self.backup_guid), exc_info=True)
+                return
+            partitions = {}
+            for item in files:
+                partitions.setdefault(item.pop('partition_key'), []).append(
+                    {**item, 'backup_guid': str(item['backup_guid'])}
+                )
+            manifest.append({'table_name': table.table_name, 'shard': table.shard, 'partitions': partitions})
+        if not manifest:
+            return
+        content = json.dumps(
+            {'backup_guid': str(self.backup_guid), 'created': datetime.utcnow().isoformat(), 'tables': manifest}
+        )
+        path = ClHouseConfig.get_path_to_s3_function(file_name=f"manifest-{self.backup_guid}", extension="json")
+        try:
+            await ClickhouseCatalog(self.click_connect).write_s3_file(
+                content,
+                S3FunctionParameters(
+                    path_to_file=path,
+                    s3_access_key=S3Config.ACCESS_KEY,
+                    s3_secret_key=S3Config.SECRET_KEY,
+                    format_file="RawBLOB",
+                    fields="data String",
+                    compression="none"
+                )
+            )
+        except Exception:
+            app_log.warning(InfoMessages.ERROR_MANIFEST.value.format(backup_guid=self.backup_guid), exc_info=True)
+            return
+        app_log.info(
+            InfoMessages.MANIFEST_SAVED.value.format(
+                backup_guid=self.backup_guid, path=path,
+                count=sum([len(item['partitions']) for item in manifest])
+            )
+        )
+    
+    async def save_query_stats(self, tables: List[Table]):
+        """
+        Статистика запросов выгрузки из system.query_log в query_stats и метрики байт по таблицам.
+        query_log читается на том сервере, где выполнялась выгрузка (шард кластера), начиная с даты
+        самой ранней выгрузки
+        """
+        queries = {item['query_id']: (table, item) for table in tables for item in table.queries}
+        servers: Dict[int, Tuple[ClickPool, List[Dict]]] = {}
+        for table in tables:
+            if table.queries:
+                servers.setdefault(id(table.click_connect), (table.click_connect, []))[1].extend(table.queries)
+        stats = {}
+        for click_pool, items in servers.values():
+            try:
+                stats.update(
+                    await ClickhouseCatalog(click_pool).get_query_stats(
+                        [item['query_id'] for item in items], 
+                        datetime.utcfromtimestamp(min([item['started'] for item in items]))
+                    )
+                )
+            except Exception:
+                app_log.warning(InfoMessages.ERROR_QUERY_STATS.value, exc_info=True)
+        for query_id, item in stats.items():
+            table, query = queries[query_id]
+            BYTES.inc(item['written_bytes'], table=table.table_name)
+            self.psql_writer.add(
+                QueryStatsEntity(
+                    backup_guid=query['backup_guid'],
+                    table_name=table.table_name,
+                    partition_key=query['partition_key'],
+                    chunk=query['chunk'],
+                    query_id=query_id,
+                    **item
+                )
+            )
+
+    
+class BackupPlan(Backup):
+    """Сухой прогон бэкапа: план выгрузки с оценками, без выгрузки и записи в postgresql"""
+    
+    @property
+    def export_pool_size(self) -> int:
+        # план не выгружает данные, соединение пула выгрузок только проверяется
+        return 1
+    
+    async def _init(self):
+        """
+        Только соединения: без писателя в postgresql (и повтора записей из spool файла),
+        создания месячных партиций, сервера метрик и регулятора числа выгрузок
+        """
+        self.psql_pool = await create_psql_pool(**DbConfig.CONNECTION_SETTINGS)
+        self.click_connect = await create_pool(
+            maxsize=ClHouseConfig.POOL_MAXSIZE, **ClHouseConfig.get_connection_data()
+        )
+        self.export_connect = await create_pool(maxsize=self.export_pool_size, **ClHouseConfig.get_connection_data())
+        await self.check_connections()
+    
+    async def _execute(self, table: str = None, force: bool = None) -> Dict:
+        tables = self.make_tables(self.get_table_names(table), datetime.now().strftime("%Y%m%d%H%M%S"))
+        metadata = await self.get_metadata(tables)
+        schemas = await self.get_schemas(tables)
+        throughput = await PsQLTable(psql_pool=self.psql_pool).get_throughput(
+            [table.table_name for table in tables]
+        )
+        default_throughput = throughput.pop(None, None)
+        try:
+            table_plans = await asyncio.gather(
+                *[
+                    table.plan(
+                        force, metadata.get(table.table_name), throughput.get(table.table_name, default_throughput),
+                        schemas.get(table.table_name)
+                    ) for table in tables
+                ]
+            )
+        finally:
+            for table in tables:
+                await table._close()
+        table_plans = [item for item in table_plans if item['partitions']]
+        estimated_seconds = sum([item['estimated_seconds'] for item in table_plans])
+        return {
+            'backup_guid': str(self.backup_guid),
+            'created': datetime.utcnow().isoformat(),
+            'force': bool(force),
+            'count': sum([item['count'] for item in table_plans]),
+            'bytes': sum([item['bytes'] for item in table_plans]),
+            'estimated_seconds': estimated_seconds,
+            'estimated_wall_seconds': round(estimated_seconds / max(self.scheduler.concurrency, 1), 1),
+            'tables': table_plans
+        }
+
 
+class Worker(Backup):
+    """
+    Процесс выполнения заданий из backup_jobs (см. backup --queue).
+    Задание захватывается через for update skip locked с арендой на JOB_LEASE секунд,
+    аренда продлевается, пока идет выгрузка. Задание упавшего процесса
+    после истечения аренды забирает другой worker, а выгрузка, потерявшая аренду, отменяется.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.workers = AppConfig.COUNT_THREADS
+        self.tables: Dict[tuple, Table] = {}
+        self.tables_lock = asyncio.Lock()
+        self.stopping = asyncio.Event()
+        # задачи выполняемых выгрузок: отменяются при остановке worker
+        self.exports = set()
+        
+    @property
+    def concurrency(self) -> int:
+        return self.workers
+    
+    @property
+    def psql_pool_size(self) -> int:
+        # захват, продление аренды и завершение заданий идут из каждой выгрузки, плюс запись backup_log
+        return max(super().psql_pool_size, self.workers + 1)
+    
+    async def run(self, workers: int = None, **kwargs):
+        self.workers = workers or AppConfig.COUNT_THREADS
+        return await super().run(workers=self.workers, **kwargs)
+        
+    async def _execute(self, workers: int = None, backup_guid: UUID = None, exit_when_empty: bool = False):
+        app_log.info(InfoMessages.START_WORKER.value.format(worker=self.name))
+        self.psql_table = PsQLTable(psql_pool=self.psql_pool)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop, signum)
+        try:
+            await asyncio.gather(
+                *[self.work(backup_guid, exit_when_empty) for _ in range(workers or AppConfig.COUNT_THREADS)]
+            )
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            for table in self.tables.values():
+                await table._close()
+        if AppConfig.QUERY_STATS:
+            await self.save_query_stats(list(self.tables.values()))
+            
+    def stop(self, signum: int):
+        """
+        SIGINT/SIGTERM: новые задания не захватываются, выполняемые выгрузки отменяются
+        (kill query выполняет QueryTracker), а их задания возвращаются в очередь.
+        Затем worker завершается как обычно: записи сбрасываются в postgresql, соединения закрываются.
+        Повторный сигнал обрабатывается по умолчанию и прерывает процесс сразу
+        """
+        asyncio.get_running_loop().remove_signal_handler(signum)
+        if self.stopped:
+            return
+        self.stopped = signum
+        app_log.warning(InfoMessages.STOP_WORKER.value.format(signal=signal.Signals(signum).name, worker=self.name))
+        self.stopping.set()
+        for export in self.exports:
+            export.cancel()
+    
+    async def work(self, backup_guid: UUID = None, exit_when_empty: bool = False):
+        while not self.stopped:
+            try:
+                job = await self.psql_table.claim_job(
+                    self.name, AppConfig.JOB_LEASE, AppConfig.RETRY_ATTEMPTS, backup_guid
+                )
+                if job is None:
+                    await self.psql_table.expire_jobs(AppConfig.RETRY_ATTEMPTS)
+            except Exception:
+                app_log.error(InfoMessages.PSQL_ERROR.value, exc_info=True)
+                job = None
+            if job is not None:
+                await self.run_job(job)
+            elif exit_when_empty:
+                return
+            else:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), AppConfig.JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def get_table(self, job: Dict) -> Table:
+        key = (job['table_name'], job['backup_guid'])
+        async with self.tables_lock:
+            if key not in self.tables:
+                table = self.make_tables([job['table_name']], job['datetime_backup'])[0]
+                await table._init()
+                table.table_schema = await table.psql_table.get_backup_schema(job['backup_guid'], table.table_name)
+                if not table.table_schema:
+                    # схема еще не записана: таблица не кэшируется, задание повторяется позже
+                    await table._close()
+                    raise ErrorBackupSchemaNotFound(
+                        InfoMessages.BACKUP_SCHEMA_NOT_FOUND.value.format(
+                            table_name=table.table_name, backup_guid=job['backup_guid']
+                        )
+                    )
+                table.metadata = (await self.get_metadata([table])).get(table.table_name)
+                self.tables[key] = table
+        return self.tables[key]
     
+    async def heartbeat(self, job: Dict, export: asyncio.Task):
+        """
+        Продление аренды задания, пока идет выгрузка export. Аренда потеряна, если ее забрал
+        другой worker или postgresql недоступен дольше JOB_LEASE: тогда выгрузка отменяется,
+        чтобы она не шла параллельно с выгрузкой нового владельца задания
+        """
+        extended_at = time.monotonic()
+        while True:
+            await asyncio.sleep(AppConfig.JOB_HEARTBEAT)
+            try:
+                extended = await self.psql_table.extend_job_lease(job['id'], self.name, AppConfig.JOB_LEASE)
+            except Exception:
+                app_log.warning(InfoMessages.PSQL_ERROR.value, exc_info=True)
+                extended = time.monotonic() - extended_at < AppConfig.JOB_LEASE
+            else:
+                if extended:
+                    extended_at = time.monotonic()
+            if not extended:
+                app_log.warning(InfoMessages.JOB_LEASE_LOST.value.format(job_id=job['id'], worker=self.name))
+                export.cancel()
+                return
+    
+    async def export_job(self, job: Dict) -> BackupHistoryEntity:
+        table = await self.get_table(job)
+        return await table.export_record(
+            job['partition_key'], job['count'], str(job['backup_guid']), job['checksum'], 
+            job['modification_time'], job['chunk'], job['chunks'], attempt=job['attempts']
+        )
+                
+    async def run_job(self, job: Dict):
+        context = log_context(
+            job['backup_guid'], job['table_name'], job['partition_key'], chunk=job['chunk'], attempt=job['attempts']
+        )
+        app_log.info(
+            InfoMessages.START_TASK.value.format(table_name=job['table_name'], key_value=job['partition_key']), 
+            extra=context
+        )
+        export = asyncio.create_task(self.export_job(job))
+        self.exports.add(export)
+        if self.stopped:
+            export.cancel()
+        heartbeat = asyncio.create_task(self.heartbeat(job, export))
+        try:
+            record = await export
+        except asyncio.CancelledError:
+            # выгрузку отменяют только остановка worker и потеря аренды (heartbeat завершается)
+            if not (self.stopped or heartbeat.done()):
+                raise
+            # при потере аренды задание уже принадлежит другому worker и release_job его не изменит
+            if self.stopped:
+                try:
+                    await self.psql_table.release_job(job['id'], self.name)
+                except Exception:
+                    app_log.error(InfoMessages.PSQL_ERROR.value, exc_info=True)
+        except Exception as err:
+            retry = (
+                (is_retryable(err) or isinstance(err, ErrorBackupSchemaNotFound)) 
+                and job['attempts'] < AppConfig.RETRY_ATTEMPTS
+            )
+            delay = get_retry_delay(job['attempts']) if retry else 0
+            JOBS.inc(table=job['table_name'], status="retry" if retry else "error")
+            app_log.error(
+                InfoMessages.TASK_ERROR.value.format(table_name=job['table_name'], partition_value=job['partition_key']),
+                exc_info=True,
+                extra=context
+            )
+            try:
+                await self.psql_table.fail_job(job['id'], self.name, err.__str__(), retry, delay)
+            except Exception:
+                app_log.error(InfoMessages.PSQL_ERROR.value, exc_info=True)
+            if not retry:
+                self.psql_writer.add(
+                    BackupLogEntity(
+                        backup_guid=job['backup_guid'],
+                        table_name=job['table_name'],
+                        partition_key=job['partition_key'],
+                        event=err.__str__(),
+                        level=DBLevelLog.ERROR
+                    )
+                )
+        else:
+            JOBS.inc(table=job['table_name'], status="success")
+            ROWS.inc(job['count'], table=job['table_name'])
+            try:
+                await self.psql_table.complete_job(job['id'], self.name, record)
+            except Exception:
+                # задание останется в работе и после истечения аренды будет выполнено повторно
+                app_log.error(InfoMessages.PSQL_ERROR.value, exc_info=True)
+        finally:
+            self.exports.discard(export)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+
+class RestoreTable:
+    scheduler: Scheduler = None
+    
+    def __init__(
+            self, table_name: str, psql: Pool, psql_writer: PsQLWriter, click_pool: ClickPool, export_pool: ClickPool
+        ):
+        self.table_name = table_name
+        self.psql_writer = psql_writer
+        self.click_table = ClickhouseTable(table_name, click_pool, export_pool)
+        self.psql_table = PsQLTable(psql_pool=psql)
+        
+    async def restore_record(self, record: BackupHistoryEntity, schema: Dict, attempt: int = 1):
+        context = log_context(
+            record.backup_guid, self.table_name, record.partition_key, chunk=record.chunk, attempt=attempt
+        )
+        app_log.info(
+            InfoMessages.START_RESTORE_TASK.value.format(table_name=self.table_name, key_value=record.partition_key),
+            extra=context
+        )
+        s3_parameters = make_file_s3_parameters(record, schema, ClHouseConfig.RESTORE_SETTINGS)
+        try:
+            await self.click_table.restore_backup(list(schema.keys()), s3_parameters)
+        except Exception as err:
+            if can_retry(err, attempt):
+                JOBS.inc(table=self.table_name, status="retry")
+                delay = get_retry_delay(attempt)
+                app_log.warning(
+                    InfoMessages.RETRY_TASK.value.format(
+                        attempt=attempt, table_name=self.table_name, 
+                        partition_value=record.partition_key, delay=round(delay)
+                    ),
+                    exc_info=True,
+                    extra=context
+                )
+                self.scheduler.put(
+                    table_name=self.table_name,
+                    weight=record.count,
+                    action=partial(self.restore_record, record, schema, attempt=attempt + 1),
+                    delay=delay
+                )
+                return
+            JOBS.inc(table=self.table_name, status="error")
+            app_log.error(
+                InfoMessages.RESTORE_TASK_ERROR.value.format(
+                    table_name=self.table_name, partition_value=record.partition_key
+                ),
+                exc_info=True,
+                extra=context
+            )
+            event, level = err.__str__(), DBLevelLog.ERROR
+        else:
+            self.scheduler.add_processed_rows(record.count)
+            JOBS.inc(table=self.table_name, status="success")
+            ROWS.inc(record.count, table=self.table_name)
+            event = InfoMessages.RESTORE_TASK_COMPLETE.value.format(
+                table_name=self.table_name, partition_value=record.partition_key, file_name=record.file_name
+            )
+            level = DBLevelLog.INFO
+        
+        self.psql_writer.add(
+            BackupLogEntity(
+                backup_guid=record.backup_guid,
+                table_name=self.table_name,
+                partition_key=record.partition_key,
+                event=event,
+                level=level
+            )
+        )
+            
+    async def restore(
+            self,
+            backup_guid: UUID,
+            scheduler: Scheduler,
+            records: List[BackupHistoryEntity] = None,
+            at: datetime = None
+        ):
+        """
+        Восстановление файлов records, а если они не переданы - файлов на момент at
+        или файлов манифеста (или самого бэкапа) backup_guid.
+        Файлы на момент at могут быть из разных бэкапов: каждый восстанавливается со схемой
+        своего бэкапа, если она совместима со схемой backup_guid, иначе файл пропускается.
+        Партиции без полной выгрузки со всеми частями до at не восстанавливаются и пишутся в backup_log
+        """
+        app_log.info(InfoMessages.START_RESTORE.value.format(table_name=self.table_name, backup_guid=backup_guid))
+        self.scheduler = scheduler
+        try:
+            if records is None and at is not None:
+                records, missing = await self.psql_table.get_restore_files(self.table_name, at)
+                self.report_missing_partitions(backup_guid, missing)
+            elif records is None:
+                # по манифесту восстанавливаются все партиции: полные выгрузки и delta после них
+                records = await self.psql_table.get_manifest_files(backup_guid, self.table_name)
+            if not records and at is None:
+                records = await self.psql_table.get_backup_files(backup_guid, self.table_name)
+            schemas = await self.psql_table.get_backup_schemas(
+                self.table_name, list({str(backup_guid)} | {str(record.backup_guid) for record in records})
+            )
+        except Exception as err:
+            app_log.error(err, exc_info=True)
+            raise
+        schema = TableSchema(fields=schemas.get(str(backup_guid), {}))
+        for record in records:
+            fields = schemas.get(str(record.backup_guid), schema.fields)
+            if not schema.is_compatible(fields):
+                app_log.error(
+                    InfoMessages.INCOMPATIBLE_SCHEMA.value.format(
+                        file_name=record.file_name, table_name=self.table_name, backup_guid=backup_guid
+                    )
+                )
+                continue
+            scheduler.put(
+                table_name=self.table_name,
+                weight=record.count,
+                action=partial(self.restore_record, record, fields)
+            )
+    
+    def report_missing_partitions(self, backup_guid: UUID, missing: List[BackupHistoryEntity]):
+        for record in missing:
+            message = InfoMessages.NO_RESTORE_BASE.value.format(
+                table_name=self.table_name, partition_value=record.partition_key, shard=record.shard
+            )
+            app_log.error(message, extra=log_context(backup_guid, self.table_name, record.partition_key))
+            self.psql_writer.add(
+                BackupLogEntity(
+                    backup_guid=backup_guid,
+                    table_name=self.table_name,
+                    partition_key=record.partition_key,
+                    event=message,
+                    level=DBLevelLog.ERROR,
+                    shard=record.shard
+                )
+            )
+        
+
 class Restore(App):
     
-    async def _execute(self, table: str = None, backup_guid: UUID = None):
-        ...
+    def __init__(self):
+        self.scheduler = create_scheduler()
+    
+    async def _execute(self, table: str = None, backup_guid: UUID = None, at: datetime = None):
+        """
+        Если указан backup_guid, восстанавливаются все файлы этого бэкапа
+        (или только файлы таблицы table), а для таблиц с манифестом -
+        все файлы из цепочек манифеста.
+        Иначе каждая таблица восстанавливается в состояние на момент at
+        (по умолчанию - текущий момент, время в UTC): для каждой партиции берется
+        последняя полная выгрузка до at и delta после нее, схема сверяется
+        со схемой последнего бэкапа таблицы до at.
+        """
+        psql_table = PsQLTable(psql_pool=self.psql_pool)
+        records = {}
+        if backup_guid is not None:
+            for record in await psql_table.get_backup_files(backup_guid, table):
+                records.setdefault(record.table_name, []).append(record)
+            manifest = {}
+            for record in await psql_table.get_manifest_files(backup_guid, table):
+                manifest.setdefault(record.table_name, []).append(record)
+            records.update(manifest)
+            backups = {table_name: backup_guid for table_name in records}
+        else:
+            at = datetime.utcnow() if at is None else at
+            backups = await psql_table.get_backup_guids_at(at, table)
+        if not backups:
+            app_log.warning(InfoMessages.NO_BACKUP_FILES.value)
+            return
+        
+        tasks = [
+            asyncio.create_task(
+                RestoreTable(
+                    table_name=table_name,
+                    psql=self.psql_pool,
+                    psql_writer=self.psql_writer,
+                    click_pool=self.click_connect,
+                    export_pool=self.export_connect
+                ).restore(guid, self.scheduler, records.get(table_name), at),
+                name=table_name
+            ) for table_name, guid in backups.items()
+        ]
+        await asyncio.wait(tasks)
+        await self.scheduler.run()
+        for table_name, guid in backups.items():
+            app_log.info(InfoMessages.COMPLETE_RESTORE.value.format(table_name=table_name, backup_guid=guid))
+    
     
+class Verify(App):
+    """
+    Проверка файлов бэкапов: clickhouse читает каждый файл из s3 и считает записи (и отпечаток),
+    результат сверяется с backup_history по партициям, расхождения пишутся в backup_log
+    """
     
-class Listing(App):
+    def __init__(self):
+        self.scheduler = create_scheduler()
+        self.results: Dict[str, Union[Dict, None]] = {}
     
-    async def _execute(self, table: str = None, gt: str = None):
-        print(table, gt)
+    async def verify_file(self, record: BackupHistoryEntity, schema: Dict, with_checksum: bool, attempt: int = 1):
+        click_table = ClickhouseTable(record.table_name, self.click_connect, self.export_connect)
+        s3_parameters = make_file_s3_parameters(record, schema, ClHouseConfig.VERIFY_SETTINGS)
+        context = log_context(
+            record.backup_guid, record.table_name, record.partition_key, chunk=record.chunk, attempt=attempt
+        )
+        try:
+            self.results[record.file_name] = await click_table.get_backup_file_records(s3_parameters, with_checksum)
+        except Exception as err:
+            if can_retry(err, attempt):
+                delay = get_retry_delay(attempt)
+                app_log.warning(
+                    InfoMessages.RETRY_TASK.value.format(
+                        attempt=attempt, table_name=record.table_name, 
+                        partition_value=record.partition_key, delay=round(delay)
+                    ),
+                    exc_info=True,
+                    extra=context
+                )
+                self.scheduler.put(
+                    table_name=record.table_name,
+                    weight=record.count,
+                    action=partial(self.verify_file, record, schema, with_checksum, attempt=attempt + 1),
+                    delay=delay
+                )
+                return
+            app_log.error(
+                InfoMessages.VERIFY_FILE_ERROR.value.format(file_name=record.file_name, table_name=record.table_name),
+                exc_info=True,
+                extra=context
+            )
+            self.results[record.file_name] = None
+            self.psql_writer.add(
+                BackupLogEntity(
+                    backup_guid=record.backup_guid,
+                    table_name=record.table_name,
+                    partition_key=record.partition_key,
+                    event=f"{record.file_name}: {err}",
+                    level=DBLevelLog.ERROR,
+                    shard=record.shard
+                )
+            )
+    
+    def check_partition(self, records: List[BackupHistoryEntity], with_checksum: bool) -> bool:
+        """
+        Сверка файлов одной партиции бэкапа: части (chunk) партиции суммируются,
+        отпечаток сверяется только у полной выгрузки, для delta он не сохраняется.
+        Число записей в backup_history получено до выгрузки: файл выгрузки без верхней
+        границы блоков (max_block) может содержать и записи, вставленные после этого,
+        поэтому большее число записей в таком файле - предупреждение, а не расхождение
+        """
+        results = [self.results.get(record.file_name) for record in records]
+        if None in results:
+            # нечитаемый файл уже записан в backup_log
+            return False
+        record = records[0]
+        messages = []
+        actual, expected = sum([item['count'] for item in results]), sum([item.count for item in records])
+        grown = actual > expected and any([item.max_block is None for item in records])
+        if grown:
+            message = InfoMessages.VERIFY_COUNT_GROWN.value.format(
+                partition_value=record.partition_key, table_name=record.table_name, actual=actual, expected=expected
+            )
+            app_log.warning(message)
+            self.psql_writer.add(
+                BackupLogEntity(
+                    backup_guid=record.backup_guid,
+                    table_name=record.table_name,
+                    partition_key=record.partition_key,
+                    event=message,
+                    level=DBLevelLog.WARNING,
+                    shard=record.shard
+                )
+            )
+        elif actual != expected:
+            messages.append(
+                InfoMessages.VERIFY_COUNT_MISMATCH.value.format(
+                    partition_value=record.partition_key, table_name=record.table_name, 
+                    actual=actual, expected=expected
+                )
+            )
+        # отпечаток файла с новыми записями не совпадет с отпечатком, полученным до выгрузки
+        if (
+            with_checksum and not grown and record.checksum is not None 
+            and all([item.base_block is None for item in records])
+        ):
+            # сумма cityHash64 по частям равна сумме по партиции (UInt64 с переполнением)
+            checksum = str(sum([int(item['checksum']) for item in results]) % 2 ** 64)
+            if checksum != record.checksum:
+                messages.append(
+                    InfoMessages.VERIFY_CHECKSUM_MISMATCH.value.format(
+                        partition_value=record.partition_key, table_name=record.table_name, 
+                        actual=checksum, expected=record.checksum
+                    )
+                )
+        for message in messages:
+            app_log.error(message)
+            self.psql_writer.add(
+                BackupLogEntity(
+                    backup_guid=record.backup_guid,
+                    table_name=record.table_name,
+                    partition_key=record.partition_key,
+                    event=message,
+                    level=DBLevelLog.ERROR,
+                    shard=record.shard
+                )
+            )
+        return not messages
+    
+    async def _execute(
+            self, table: str = None, backup_guid: UUID = None, days: int = 7, with_checksum: bool = False
+        ) -> Dict:
+        """
+        Проверяются файлы бэкапа backup_guid, а если он не указан - всех бэкапов за последние days дней.
+        Файл читается со схемой своего бэкапа, запросы идут с пониженным приоритетом (VERIFY_SETTINGS)
+        """
+        psql_table = PsQLTable(psql_pool=self.psql_pool)
+        since = None if backup_guid is not None else datetime.utcnow() - timedelta(days=days)
+        records = await psql_table.get_files_to_verify(backup_guid, table, since)
+        partitions: Dict[tuple, List[BackupHistoryEntity]] = {}
+        tables: Dict[str, List[BackupHistoryEntity]] = {}
+        for record in records:
+            key = (record.table_name, str(record.backup_guid), record.shard, record.partition_key)
+            partitions.setdefault(key, []).append(record)
+            tables.setdefault(record.table_name, []).append(record)
+        app_log.info(InfoMessages.START_VERIFY.value.format(files=len(records)))
+        for table_name, items in tables.items():
+            schemas = await psql_table.get_backup_schemas(table_name, list({str(item.backup_guid) for item in items}))
+            for record in items:
+                self.scheduler.put(
+                    table_name=table_name,
+                    weight=record.count,
+                    action=partial(self.verify_file, record, schemas.get(str(record.backup_guid), {}), with_checksum)
+                )
+        await self.scheduler.run()
+        mismatches = len([key for key, items in partitions.items() if not self.check_partition(items, with_checksum)])
+        app_log.info(
+            InfoMessages.COMPLETE_VERIFY.value.format(
+                files=len(records), partitions=len(partitions), mismatches=mismatches
+            )
+        )
+        return {'files': len(records), 'partitions': len(partitions), 'mismatches': mismatches}
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from .db_connectors.clickhouse_connector import ClickhouseCatalog
+from .scheduler import Scheduler
+from .types import InfoMessages
+from settings.app import AppConfig
+from settings.log import app_log
+
+
+class ConcurrencyController:
+    """
+    AIMD регулятор числа параллельных выгрузок планировщика.
+    Раз в interval секунд читает нагрузку clickhouse (system.metrics, system.events)
+    и пропускную способность (rows/s выгруженных за интервал записей):
+    - при перегрузке clickhouse число выгрузок уменьшается вдвое (не ниже min_limit);
+    - если после прошлого увеличения rows/s упали больше чем на throughput_drop,
+      увеличение откатывается;
+    - иначе, если в очереди есть задания, число выгрузок увеличивается на 1 (не выше max_limit).
+    В кластере нагрузка читается с каждого шарда, решение принимается по самому нагруженному,
+    а max_limit растет пропорционально числу шардов (см. set_shards).
+    Каждое изменение пишется в лог.
+    """
+    
+    def __init__(
+            self,
+            scheduler: Scheduler,
+            catalog: ClickhouseCatalog,
+            min_limit: int = AppConfig.CONCURRENCY_MIN,
+            max_limit: int = AppConfig.CONCURRENCY_MAX,
+            interval: float = AppConfig.CONCURRENCY_INTERVAL
+        ):
+        self.scheduler = scheduler
+        # каталоги по номерам шардов, 0 - сервер CLICK_HOST без кластера
+        self.catalogs: Dict[int, ClickhouseCatalog] = {0: catalog}
+        self.min_limit = min_limit
+        self.shard_limit = max_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._last_rows = 0
+        self._last_time = time.monotonic()
+        self._last_throughput: Optional[float] = None
+        self._last_memory_errors: Dict[int, int] = {}
+        self._increased = False
+    
+    def set_shards(self, catalogs: Dict[int, ClickhouseCatalog]):
+        """Метрики читаются с реплик шардов кластера, на каждый шард до shard_limit выгрузок"""
+        self.catalogs = catalogs
+        self.max_limit = self.shard_limit * len(catalogs)
+        self._last_memory_errors = {}
+        
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="concurrency-controller")
+        
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            
+    async def _run(self):
+        await self.scheduler.set_concurrency(
+            min(max(self.scheduler.concurrency, self.min_limit), self.max_limit)
+        )
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.adjust()
+            except Exception:
+                app_log.warning(InfoMessages.ERROR_LOAD_METRICS.value, exc_info=True)
+    
+    def get_throughput(self) -> float:
+        now = time.monotonic()
+        rows = self.scheduler.processed_rows
+        throughput = (rows - self._last_rows) / max(now - self._last_time, 1e-6)
+        self._last_rows, self._last_time = rows, now
+        return throughput
+    
+    def get_overload_reason(self, metrics: Dict[str, int], shard: int = 0) -> Optional[str]:
+        # запросы самого бэкапа не считаются нагрузкой; по шардам они считаются распределенными поровну
+        queries = metrics.get('Query', 0) - self.scheduler.active // len(self.catalogs)
+        if queries > AppConfig.CONCURRENCY_MAX_QUERIES:
+            return "too many running queries"
+        if metrics.get('Merge', 0) > AppConfig.CONCURRENCY_MAX_MERGES:
+            return "too many running merges"
+        if AppConfig.CONCURRENCY_MAX_MEMORY and metrics.get('MemoryTracking', 0) > AppConfig.CONCURRENCY_MAX_MEMORY:
+            return "memory usage is too high"
+        memory_errors = metrics.get('QueryMemoryLimitExceeded', 0)
+        last_memory_errors = self._last_memory_errors.get(shard)
+        self._last_memory_errors[shard] = memory_errors
+        if last_memory_errors is not None and memory_errors > last_memory_errors:
+            return "queries exceeded the memory limit"
+        return None
+    
+    async def get_load(self) -> Tuple[Dict[str, int], Optional[str]]:
+        """
+        Метрики самого нагруженного шарда и причина перегрузки: первый перегруженный шард,
+        а если перегрузки нет - шард с наибольшим числом запросов
+        """
+        shards_metrics = dict(
+            zip(
+                self.catalogs.keys(),
+                await asyncio.gather(*[catalog.get_load_metrics() for catalog in self.catalogs.values()])
+            )
+        )
+        # причины считаются по всем шардам: get_overload_reason запоминает счетчики ошибок каждого
+        reasons = {shard: self.get_overload_reason(metrics, shard) for shard, metrics in shards_metrics.items()}
+        for shard, reason in reasons.items():
+            if reason is not None:
+                return shards_metrics[shard], reason if len(reasons) == 1 else f"shard {shard}: {reason}"
+        return max(shards_metrics.values(), key=lambda metrics: metrics.get('Query', 0)), None
+    
+    async def adjust(self):
+        metrics, reason = await self.get_load()
+        throughput = self.get_throughput()
+        current = self.scheduler.concurrency
+        if reason is not None:
+            new = max(self.min_limit, current // 2)
+        elif (
+            self._increased
+            and self._last_throughput
+            and throughput < self._last_throughput * (1 - AppConfig.CONCURRENCY_THROUGHPUT_DROP)
+        ):
+            new, reason = max(self.min_limit, current - 1), "throughput dropped after increase"
+        elif self.scheduler.waiting:
+            new, reason = min(self.max_limit, current + 1), "no overload, jobs are waiting"
+        else:
+            new = current
+        self._increased = new > current
+        self._last_throughput = throughput
+        if new == current:
+            return
+        app_log.info(
+            InfoMessages.CONCURRENCY_CHANGED.value.format(
+                old=current,
+                new=new,
+                reason=reason,
+                throughput=round(throughput),
+                queries=metrics.get('Query'),
+                merges=metrics.get('Merge'),
+                memory=metrics.get('MemoryTracking')
+            )
+        )
+        await self.scheduler.set_concurrency(new)
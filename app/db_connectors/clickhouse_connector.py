@@ -1,26 +1,57 @@
-from typing import Dict, List, Union
+import time
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import Dict, List, Optional, Union
 from asynch.proto.connection import Connection
 from asynch.pool import Pool
 from asynch.cursors import DictCursor
 
-from .exceptions import ErrorGettingTableDescription, ErrorGettingDataCount, ErrorBackup
-from ..types import S3FunctionParameters
+from .exceptions import ErrorGettingTableDescription, ErrorGettingDataCount, ErrorBackup, ErrorRestore
+from .exceptions import ErrorGettingMetadata, ErrorKillingQuery
+from ..metrics import POOL_WAIT
+from ..types import S3FunctionParameters, TableMetadata
+
+
+CHECKSUM_EXPRESSION = "toString(sum(cityHash64(*)))"
+# номер первого блока куска, в котором лежит запись: имя куска {partition_id}_{min_block}_{max_block}_{level}
+PART_MIN_BLOCK_EXPRESSION = "toUInt64(splitByChar('_', _part)[2])"
 
 
 class ClickhouseConnector:
     
-    def __init__(self, click_connect: Pool):
+    def __init__(self, click_connect: Pool, export_connect: Pool = None):
+        """
+        click_connect - пул запросов метаданных, export_connect - пул долгих запросов выгрузки,
+        восстановления и чтения файлов s3, чтобы они не занимали соединения быстрых запросов
+        """
         self.click_connect = click_connect
+        self.export_connect = export_connect or click_connect
+    
+    @asynccontextmanager
+    async def connection(self, export: bool = False):
+        t_start = time.monotonic()
+        async with (self.export_connect if export else self.click_connect).acquire() as conn:
+            POOL_WAIT.observe(time.monotonic() - t_start, pool="export" if export else "metadata")
+            yield conn
+    
+    async def warm_up(self, connections: int, export: bool = False):
+        """
+        Открытие connections соединений заранее: они берутся из пула одновременно и возвращаются в него,
+        при выдаче из пула каждое соединение проверяется запросом select 1
+        """
+        async with AsyncExitStack() as stack:
+            for _ in range(connections):
+                await stack.enter_async_context(self.connection(export))
         
-    async def fetchall(self, sql) -> List[Dict]:
-        async with self.click_connect.acquire() as conn:
+    async def fetchall(self, sql, export: bool = False) -> List[Dict]:
+        async with self.connection(export) as conn:
             async with conn.cursor(cursor=DictCursor) as cursor:
                 await cursor.execute(sql)
                 result = await cursor.fetchall()
         return result
     
-    async def fetchone(self, sql) -> Dict:
-        async with self.click_connect.acquire() as conn:
+    async def fetchone(self, sql, export: bool = False) -> Dict:
+        async with self.connection(export) as conn:
             async with conn.cursor(cursor=DictCursor) as cursor:
                 await cursor.execute(sql)
                 result = await cursor.fetchone()
@@ -30,16 +61,39 @@ class ClickhouseConnector:
         result = await self.fetchone(sql)
         return list(result.values())[0]
     
-    async def execute(self, sql) -> int:
-        async with self.click_connect.acquire() as conn:
+    async def execute(self, sql, query_id: str = None, export: bool = False) -> Optional[int]:
+        """
+        Выполнение запроса без результата. Возвращает число записанных запросом строк
+        из пакетов Progress сервера (insert ... select), None - если драйвер его не получил
+        """
+        async with self.connection(export) as conn:
             async with conn.cursor(cursor=DictCursor) as cursor:
+                if query_id is not None:
+                    cursor.set_query_id(query_id)
                 await cursor.execute(sql)
+                return self.get_written_rows(cursor)
+    
+    @staticmethod
+    def get_written_rows(cursor) -> Optional[int]:
+        last_query = getattr(cursor.connection._connection, 'last_query', None)
+        if last_query is None or not last_query.progress:
+            return None
+        return last_query.progress.written_rows
+    
+    async def write_s3_file(self, content: str, s3_parameters: S3FunctionParameters):
+        """Запись строки content в s3 одним файлом (формат RawBLOB)"""
+        value = content.replace("\\", "\\\\").replace("'", "\\'")
+        sql = f"insert into function s3{s3_parameters.compile_param()} select '{value}'"
+        try:
+            await self.execute(sql)
+        except Exception as e:
+            raise ErrorBackup(e.__str__()) from e
             
 
 class ClickhouseTable(ClickhouseConnector):
     
-    def __init__(self, table_name: str, click_connect: Pool):
-        super().__init__(click_connect)
+    def __init__(self, table_name: str, click_connect: Pool, export_connect: Pool = None):
+        super().__init__(click_connect, export_connect)
         self.table_name = table_name
         
     async def get_schema_table(self) -> Dict:
@@ -66,15 +120,251 @@ class ClickhouseTable(ClickhouseConnector):
             raise ErrorGettingDataCount(e.__str__()) from e
         return result
     
+    async def get_partition_records(self, partition_key: str, pkey_value: str, with_checksum: bool) -> Dict:
+        sql = f"select count() as count"
+        if with_checksum:
+            sql += f", {CHECKSUM_EXPRESSION} as checksum"
+        sql += f" from {self.table_name}"
+        if partition_key not in (None, "-"):
+            sql += f" where {partition_key} = '{pkey_value}'"
+        try:
+            result = await self.fetchone(sql)
+        except Exception as e:
+            raise ErrorGettingDataCount(e.__str__()) from e
+        return result
+    
+    async def get_active_parts(self) -> List[Dict]:
+        """
+        Активные куски таблицы с диапазонами номеров блоков.
+        mutation - версия последней примененной к куску мутации (0, если мутаций не было)
+        """
+        sql = f"""select partition, name, min_block_number as min_block, max_block_number as max_block, 
+                         if(data_version != min_block_number, data_version, 0) as mutation, 
+                         rows as count, bytes_on_disk as bytes
+                  from system.parts 
+                  where active and database = currentDatabase() and table = '{self.table_name}';"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        for item in result:
+            item['partition'] = ClickhouseCatalog.parse_partition(item['partition'])
+        return result
+    
+    async def get_checksum_records(self) -> Dict:
+        sql = f"select count() as count, {CHECKSUM_EXPRESSION} as checksum from {self.table_name}"
+        try:
+            result = await self.fetchone(sql)
+        except Exception as e:
+            raise ErrorGettingDataCount(e.__str__()) from e
+        return result
+    
+    async def get_checksum_records_by_pkey(self, partition_key: str) -> List[Dict]:
+        sql = f"""select {partition_key}, count() as count, {CHECKSUM_EXPRESSION} as checksum 
+                  from {self.table_name} group by {partition_key};"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingDataCount(e.__str__()) from e
+        return result
+    
     async def create_backup(
-        self, partition_key: str, pkey_value: Union[str, int, float], s3_parameters: S3FunctionParameters
-    ):
+        self, 
+        partition_key: str, 
+        pkey_value: Union[str, int, float], 
+        s3_parameters: S3FunctionParameters,
+        chunk_filter: str = None,
+        query_id: str = None
+    ) -> Optional[int]:
+        """Выгрузка партиции в s3, возвращает число записанных строк (None, если сервер его не передал)"""
         sql = f"insert into function s3{s3_parameters.compile_param()} select * from {self.table_name}"
-        if partition_key != "-":
-            sql += f" where {partition_key} = '{pkey_value}';"
+        conditions = [] if partition_key in (None, "-") else [f"{partition_key} = '{pkey_value}'"]
+        if chunk_filter is not None:
+            conditions.append(chunk_filter)
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+        sql += s3_parameters.compile_settings()
         try:
-            await self.execute(sql)
+            return await self.execute(sql, query_id, export=True)
         except Exception as e:
             raise ErrorBackup(e.__str__()) from e
-            
 
+    async def create_partitioned_backup(
+        self, partition_key: str, pkey_values: List[str], s3_parameters: S3FunctionParameters, query_id: str = None
+    ):
+        """
+        Выгрузка нескольких партиций одним запросом: clickhouse сам раскладывает
+        записи по файлам, подставляя значение partition_key в {_partition_id} пути
+        """
+        values = ", ".join([f"'{value}'" for value in pkey_values])
+        sql = f"""insert into function s3{s3_parameters.compile_param()} partition by {partition_key} 
+                  select * from {self.table_name} where {partition_key} in ({values})"""
+        sql += s3_parameters.compile_settings()
+        try:
+            await self.execute(sql, query_id, export=True)
+        except Exception as e:
+            raise ErrorBackup(e.__str__()) from e
+    
+    async def get_backup_file_records(self, s3_parameters: S3FunctionParameters, with_checksum: bool) -> Dict:
+        """Количество записей (и отпечаток) файла бэкапа, файл читается в s3 функции без загрузки в таблицу"""
+        sql = f"select count() as count"
+        if with_checksum:
+            sql += f", {CHECKSUM_EXPRESSION} as checksum"
+        sql += f" from s3{s3_parameters.compile_param()}"
+        sql += s3_parameters.compile_settings()
+        try:
+            result = await self.fetchone(sql, export=True)
+        except Exception as e:
+            raise ErrorGettingDataCount(e.__str__()) from e
+        return result
+    
+    async def restore_backup(self, columns: List[str], s3_parameters: S3FunctionParameters):
+        fields = ", ".join(columns)
+        sql = f"insert into {self.table_name} ({fields}) select {fields} from s3{s3_parameters.compile_param()}"
+        sql += s3_parameters.compile_settings()
+        try:
+            await self.execute(sql, export=True)
+        except Exception as e:
+            raise ErrorRestore(e.__str__()) from e
+
+
+class ClickhouseCatalog(ClickhouseConnector):
+    """Метаданные сразу всех таблиц бэкапа из системных таблиц clickhouse"""
+    
+    @staticmethod
+    def parse_partition(partition: str) -> str:
+        if len(partition) > 1 and partition[0] == partition[-1] == "'":
+            return partition[1:-1].replace("\\'", "'")
+        return partition
+    
+    async def ping(self):
+        await self.fetchone("select 1")
+    
+    async def get_cluster_replicas(self, cluster: str) -> List[Dict]:
+        """Реплики шардов кластера, на каждом шарде сначала реплики с меньшим числом ошибок"""
+        sql = f"""select shard_num, replica_num, host_name, host_address, port, errors_count
+                  from system.clusters 
+                  where cluster = '{cluster}'
+                  order by shard_num, errors_count, replica_num;"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        if not result:
+            raise ErrorGettingMetadata(f"Cluster {cluster} is not found in system.clusters")
+        return result
+    
+    async def get_tables_schema(self, tables: List[str]) -> Dict[str, Dict]:
+        """Схемы таблиц одним запросом к system.columns: {table: {поле: тип}} в порядке describe table"""
+        names = ", ".join([f"'{table}'" for table in tables])
+        sql = f"""select table, name, type 
+                  from system.columns 
+                  where database = currentDatabase() and table in ({names})
+                  order by table, position;"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingTableDescription(e.__str__()) from e
+        schemas = {}
+        for item in result:
+            schemas.setdefault(item['table'], {})[item['name']] = item['type']
+        return schemas
+    
+    async def get_load_metrics(self) -> Dict[str, int]:
+        """
+        Текущие значения system.metrics (запросы, мержи, память) и
+        накопленные счетчики system.events (ошибки нехватки памяти)
+        """
+        sql = """select metric, toInt64(value) as value from system.metrics 
+                 where metric in ('Query', 'Merge', 'MemoryTracking')
+                 union all
+                 select event as metric, toInt64(value) as value from system.events 
+                 where event in ('QueryMemoryLimitExceeded');"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        return {item['metric']: item['value'] for item in result}
+    
+    async def get_query_stats(self, query_ids: List[str], since: datetime) -> Dict[str, Dict]:
+        """
+        Статистика завершенных запросов из system.query_log, запущенных не раньше since (UTC).
+        event_date в часовом поясе сервера, поэтому граница берется с запасом в сутки
+        """
+        date_from = (since - timedelta(days=1)).strftime("%Y-%m-%d")
+        try:
+            try:
+                await self.execute("system flush logs")
+            except Exception:
+                # без прав на flush logs статистика появится с задержкой flush_interval_milliseconds
+                pass
+            result = []
+            for start in range(0, len(query_ids), 1000):
+                ids = ", ".join([f"'{query_id}'" for query_id in query_ids[start:start + 1000]])
+                result += await self.fetchall(
+                    f"""select query_id, read_rows, read_bytes, written_rows, written_bytes, memory_usage, 
+                               query_duration_ms as duration_ms
+                        from system.query_log
+                        where type = 'QueryFinish' and event_date >= '{date_from}' and query_id in ({ids});"""
+                )
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        return {item.pop('query_id'): item for item in result}
+    
+    async def get_queries_progress(self, query_ids: List[str]) -> Dict[str, Dict]:
+        """Прогресс выполняемых запросов из system.processes: {query_id: {read_rows, read_bytes, ..., elapsed}}"""
+        ids = ", ".join([f"'{query_id}'" for query_id in query_ids])
+        sql = f"""select query_id, read_rows, read_bytes, written_rows, written_bytes, total_rows_approx, elapsed
+                  from system.processes 
+                  where query_id in ({ids});"""
+        try:
+            result = await self.fetchall(sql)
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        return {item.pop('query_id'): item for item in result}
+    
+    async def kill_queries(self, query_ids: List[str]):
+        """Остановка запросов на сервере: kill query не ждет их завершения (async)"""
+        ids = ", ".join([f"'{query_id}'" for query_id in query_ids])
+        try:
+            await self.fetchall(f"kill query where query_id in ({ids}) async")
+        except Exception as e:
+            raise ErrorKillingQuery(e.__str__()) from e
+    
+    async def get_tables_metadata(self, tables: List[str]) -> Dict[str, TableMetadata]:
+        names = ", ".join([f"'{table}'" for table in tables])
+        tables_sql = f"""select name, engine, engine_full, partition_key, primary_key, sampling_key, 
+                                total_rows, total_bytes 
+                         from system.tables 
+                         where database = currentDatabase() and name in ({names});"""
+        parts_sql = f"""select table, partition, sum(rows) as count, sum(bytes_on_disk) as bytes, 
+                               toUnixTimestamp(max(modification_time)) as modification_time
+                        from system.parts 
+                        where active and database = currentDatabase() and table in ({names})
+                        group by table, partition;"""
+        try:
+            tables_info = await self.fetchall(tables_sql)
+            parts_info = await self.fetchall(parts_sql)
+        except Exception as e:
+            raise ErrorGettingMetadata(e.__str__()) from e
+        result = {
+            item['name']: TableMetadata(
+                engine=item['engine'],
+                engine_full=item['engine_full'],
+                partition_key=item['partition_key'],
+                primary_key=item['primary_key'],
+                sampling_key=item['sampling_key'],
+                total_rows=item['total_rows'],
+                total_bytes=item['total_bytes']
+            ) for item in tables_info
+        }
+        for item in parts_info:
+            result[item['table']].partitions.append(
+                {
+                    'partition': self.parse_partition(item['partition']),
+                    'count': item['count'],
+                    'bytes': item['bytes'],
+                    'modification_time': item['modification_time']
+                }
+            )
+        return result
@@ -11,19 +11,48 @@ class ErrorBackup(Exception):
     pass
 
 
+class ErrorRestore(Exception):
+    pass
+
+
+class ErrorGettingMetadata(Exception):
+    pass
+
+
+class ErrorKillingQuery(Exception):
+    pass
+
+
 # Exceptions for postgresql connetor
 class ErrorGettingBackupSchema(Exception):
     pass
 
 
-class ErrorInsertingSchemaBackup(Exception):
+class ErrorCopyingRecords(Exception):
     pass
 
 
-class ErrorInsertingBackupHistory(Exception):
+class ErrorGettingBackupFiles(Exception):
     pass
 
 
-class ErrorInsertingBackupLog(Exception):
+class ErrorCreatingPartitions(Exception):
     pass
 
+
+
+class ErrorBackupJobs(Exception):
+    pass
+
+
+class ErrorBackupSchemaNotFound(Exception):
+    pass
+
+
+class ErrorBackupManifest(Exception):
+    pass
+
+
+# Exceptions for clickhouse cluster
+class ErrorClusterShard(Exception):
+    pass
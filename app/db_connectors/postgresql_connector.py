@@ -1,107 +1,459 @@
-from typing import Dict, List, Union
-import json
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple, Union, Sequence
+from datetime import datetime
+from uuid import UUID
 from asyncpg.pool import Pool
 
-from .exceptions import ErrorGettingBackupSchema, ErrorInsertingSchemaBackup, ErrorGettingDataCount
-from .exceptions import ErrorInsertingBackupHistory, ErrorInsertingBackupLog
-from ..types import TablesShemaEntity, BackupHistoryEntity, BackupLogEntity
+from .exceptions import ErrorGettingBackupSchema, ErrorGettingDataCount, ErrorCopyingRecords
+from .exceptions import ErrorGettingBackupFiles, ErrorCreatingPartitions, ErrorBackupJobs, ErrorBackupManifest
+from ..metrics import POOL_WAIT
+from ..types import BackupHistoryEntity
 
+SCHEMA_NAME = "clickhouse_backup"
 
-def get_last_backup_guid(table_name: str):
-    return f"""
-    with last_backup as 
-    (
-    	select backup_guid
+
+# Тексты запросов неизменны, значения передаются параметрами: так asyncpg
+# подготавливает каждый запрос один раз на соединение и берет его из statement cache
+GET_LAST_BACKUP_SCHEMAS_QUERY = """
+    select lb.table_name, bs.schema_hash as last_hash, bs.schema_guid as last_schema_guid
+    from clickhouse_backup.latest_backup lb
+    join clickhouse_backup.backup_schema bs on bs.backup_guid = lb.backup_guid and bs.table_name = lb.table_name
+    where lb.table_name = any($1::varchar[]);
+    """
+
+GET_LAST_BACKUP_STATE_QUERY = """
+    select partition_key, count, checksum, modification_time, max_block, mutation
+    from clickhouse_backup.latest_partition_backup
+    where table_name = $1 and shard = $2;
+    """
+
+CREATE_MONTHLY_PARTITIONS_QUERY = """
+    select clickhouse_backup.create_monthly_partitions(
+    	timezone('utc'::text, now()), timezone('utc'::text, now()) + interval '2 months'
+    );
+    """
+
+GET_BACKUP_FILES_QUERY = """
+    select backup_guid, table_name, partition_key, count, file_name, execution_time, file_format, compression,
+    	checksum, modification_time, chunk, chunks, shard, base_block, max_block, mutation
+    from clickhouse_backup.backup_history
+    where backup_guid = $1 and ($2::varchar is null or table_name = $2);
+    """
+
+# файлы бэкапа backup_guid или всех бэкапов, созданных после $3
+GET_FILES_TO_VERIFY_QUERY = """
+    select backup_guid, table_name, partition_key, count, file_name, execution_time, file_format, compression,
+    	checksum, modification_time, chunk, chunks, shard, base_block, max_block, mutation
+    from clickhouse_backup.backup_history
+    where ($1::uuid is null or backup_guid = $1) and ($2::varchar is null or table_name = $2)
+    	and ($3::timestamp is null or created >= $3)
+    order by table_name, backup_guid, shard, partition_key, chunk;
+    """
+
+# манифест бэкапа - снимок цепочек файлов (полная выгрузка и delta) партиций таблицы
+SAVE_MANIFEST_QUERY = """
+    with manifest as (
+    	insert into clickhouse_backup.backup_manifest (backup_guid, table_name, shard, partition_key, chain)
+    	select $1, table_name, shard, partition_key, chain
+    	from clickhouse_backup.latest_partition_backup
+    	where table_name = $2 and shard = $3 and ($4::varchar[] is null or partition_key = any($4::varchar[]))
+    	on conflict (backup_guid, table_name, shard, partition_key) do update set chain = excluded.chain
+    	returning table_name, shard, partition_key, chain
+    )
+    select m.partition_key, h.backup_guid, h.file_name, h.file_format, h.compression, h.count, h.chunk, h.chunks,
+    	h.base_block, h.max_block
+    from manifest m
+    join clickhouse_backup.backup_history h on h.backup_guid = any(m.chain) and h.table_name = m.table_name
+    	and h.shard = m.shard and h.partition_key = m.partition_key
+    order by m.partition_key, array_position(m.chain, h.backup_guid), h.chunk;
+    """
+
+GET_MANIFEST_FILES_QUERY = """
+    select h.backup_guid, h.table_name, h.partition_key, h.count, h.file_name, h.execution_time, h.file_format,
+    	h.compression, h.checksum, h.modification_time, h.chunk, h.chunks, h.shard, h.base_block, h.max_block,
+    	h.mutation
+    from clickhouse_backup.backup_manifest m
+    join clickhouse_backup.backup_history h on h.backup_guid = any(m.chain) and h.table_name = m.table_name
+    	and h.shard = m.shard and h.partition_key = m.partition_key
+    where m.backup_guid = $1 and ($2::varchar is null or m.table_name = $2)
+    order by h.table_name, h.shard, h.partition_key, array_position(m.chain, h.backup_guid), h.chunk;
+    """
+
+# бэкап уже запускался: есть выгруженные или запланированные партиции
+BACKUP_EXISTS_QUERY = """
+    select exists (select 1 from clickhouse_backup.backup_history where backup_guid = $1)
+    	or exists (select 1 from clickhouse_backup.backup_log where backup_guid = $1);
+    """
+
+GET_BACKUP_GUIDS_AT_QUERY = """
+    select distinct on (table_name) table_name, backup_guid
+    from clickhouse_backup.backup_history
+    where created <= $1 and ($2::varchar is null or table_name = $2)
+    order by table_name, created desc;
+    """
+
+# Состояние таблицы на момент $2: для каждой партиции (шарда) последняя полная выгрузка,
+# у которой есть все части (chunk), и выгруженные после нее delta.
+# Партиция без полной выгрузки со всеми частями не восстанавливается: по ней возвращается
+# одна строка с has_base = false, чтобы сообщить о ней, а не загружать часть данных.
+# Строки читаются по индексу (table_name, shard, partition_key, created), один проход окнами
+GET_RESTORE_FILES_QUERY = """
+    select f.backup_guid, f.table_name, f.partition_key, f.count, f.file_name, f.execution_time, f.file_format,
+    	f.compression, f.checksum, f.modification_time, f.chunk, f.chunks, f.shard, f.base_block, f.max_block,
+    	f.mutation, f.has_base
+    from (
+    	select c.*,
+    		first_value(c.backup_guid) over w as base_guid,
+    		first_value(c.base_block is null and c.complete) over w as has_base,
+    		max(c.created) filter (where c.base_block is null and c.complete) over w as base_created,
+    		row_number() over w as position
+    	from (
+    		select h.*, count(*) over (partition by h.shard, h.partition_key, h.backup_guid) >= h.chunks as complete
+    		from clickhouse_backup.backup_history h
+    		where h.table_name = $1 and h.created <= $2
+    	) c
+    	window w as (
+    		partition by c.shard, c.partition_key
+    		order by (c.base_block is null and c.complete) desc, c.created desc
+    		rows between unbounded preceding and unbounded following
+    	)
+    ) f
+    where (f.has_base and (f.backup_guid = f.base_guid or (f.base_block is not null and f.created > f.base_created)))
+    	or (not f.has_base and f.position = 1)
+    order by f.shard, f.partition_key, f.created, f.chunk;
+    """
+
+# неизменная схема не записывается повторно: поля берутся из бэкапа schema_guid
+GET_BACKUP_SCHEMA_QUERY = """
+    select field_name, field_type from clickhouse_backup.tables_schema
+    where table_name = $2 and backup_guid = coalesce(
+    	(select schema_guid from clickhouse_backup.backup_schema where backup_guid = $1 and table_name = $2), $1
+    )
+    order by field_position;
+    """
+
+GET_BACKUP_SCHEMAS_QUERY = """
+    select g.backup_guid, ts.field_name, ts.field_type
+    from unnest($2::uuid[]) as g (backup_guid)
+    left join clickhouse_backup.backup_schema bs on bs.backup_guid = g.backup_guid and bs.table_name = $1
+    join clickhouse_backup.tables_schema ts 
+    	on ts.table_name = $1 and ts.backup_guid = coalesce(bs.schema_guid, g.backup_guid)
+    order by g.backup_guid, ts.field_position;
+    """
+
+GET_UNFINISHED_PARTITIONS_QUERY = """
+    with scheduled as (
+    	select distinct table_name, shard, partition_key
+    	from clickhouse_backup.backup_log
+    	where backup_guid = $1 and ($2::varchar is null or table_name = $2)
+    ), finished as (
+    	select table_name, shard, partition_key, max(chunks) as chunks, array_agg(chunk) as chunks_done
     	from clickhouse_backup.backup_history
-    	where table_name='{table_name}'
-    	group by backup_guid, created 
-    	order by created desc
-    	limit 1 
-    )"""
+    	where backup_guid = $1 and ($2::varchar is null or table_name = $2)
+    	group by table_name, shard, partition_key
+    )
+    select s.table_name, s.shard, s.partition_key, f.chunks, f.chunks_done
+    from scheduled s
+    left join finished f on f.table_name = s.table_name and f.shard = s.shard and f.partition_key = s.partition_key
+    where f.chunks is null or cardinality(f.chunks_done) < f.chunks;
+    """
 
+GET_THROUGHPUT_QUERY = """
+    select table_name, sum(count)::float8 as count, sum(execution_time)::float8 as execution_time
+    from clickhouse_backup.backup_history
+    where created >= timezone('utc'::text, now()) - make_interval(days => $2) and table_name = any($1::varchar[])
+    group by table_name;
+    """
 
-def get_last_backup_sqhema_query(table_name: str):
-    return f"""{get_last_backup_guid(table_name)}
-    select json_agg(json_build_object(field_name, field_type)) as schema 
-    from clickhouse_backup.tables_schema ts
-    right join last_backup on ts.backup_guid  = last_backup.backup_guid
-    where ts.table_name='{table_name}';
+# задание берется самым большим первым; задания с истекшей арендой (упавший worker) берутся повторно;
+# lease_until ожидающего задания - время, до которого отложен его повтор
+CLAIM_JOB_QUERY = """
+    update clickhouse_backup.backup_jobs j
+    set status = 'running', worker = $1, attempts = j.attempts + 1, 
+    	lease_until = timezone('utc'::text, now()) + make_interval(secs => $2),
+    	updated = timezone('utc'::text, now())
+    where j.id = (
+    	select id from clickhouse_backup.backup_jobs
+    	where (
+    			(status = 'pending' and (lease_until is null or lease_until < timezone('utc'::text, now())))
+    			or (status = 'running' and lease_until < timezone('utc'::text, now()))
+    		)
+    		and attempts < $3 and ($4::uuid is null or backup_guid = $4)
+    	order by coalesce(bytes, count) desc
+    	limit 1
+    	for update skip locked
+    )
+    returning j.id, j.backup_guid, j.table_name, j.partition_key, j.chunk, j.chunks, j.count, j.checksum,
+    	j.modification_time, j.datetime_backup, j.attempts;
     """
-    
 
-def get_count_records_in_last_backup_query(table_name: str):
-    return f"""{get_last_backup_guid(table_name)}
-    select bh.partition_key, bh.count from clickhouse_backup.backup_history bh
-    right join last_backup on bh.backup_guid  = last_backup.backup_guid
-    where bh.table_name = '{table_name}';
+EXTEND_JOB_LEASE_QUERY = """
+    update clickhouse_backup.backup_jobs
+    set lease_until = timezone('utc'::text, now()) + make_interval(secs => $3)
+    where id = $1 and worker = $2 and status = 'running'
+    returning id;
     """
-    
 
-def insert_schema_table_query(data: List[TablesShemaEntity]):
-    sql = "INSERT INTO clickhouse_backup.tables_schema (backup_guid, table_name, field_name, field_type) VALUES "
-    for item in data:
-        sql = sql + item.get_string_values() + ',\n'
-    sql = sql[:-2] + ";"
-    return sql
+COMPLETE_JOB_QUERY = """
+    update clickhouse_backup.backup_jobs
+    set status = 'done', lease_until = null, error = null, updated = timezone('utc'::text, now())
+    where id = $1 and worker = $2 and status = 'running'
+    returning id;
+    """
 
+FAIL_JOB_QUERY = """
+    update clickhouse_backup.backup_jobs
+    set status = case when $4 then 'pending' else 'error' end, error = $3,
+    	lease_until = case when $4 then timezone('utc'::text, now()) + make_interval(secs => $5) end,
+    	updated = timezone('utc'::text, now())
+    where id = $1 and worker = $2 and status = 'running';
+    """
 
-def insert_backup_history_query(data: BackupHistoryEntity):
-    sql = """INSERT INTO clickhouse_backup.backup_history 
-            (backup_guid, table_name, partition_key, count, file_name, execution_time) VALUES
-          """
-    sql += data.get_string_values() + ";"
-    return sql
+RELEASE_JOB_QUERY = """
+    update clickhouse_backup.backup_jobs
+    set status = 'pending', worker = null, attempts = greatest(attempts - 1, 0), lease_until = null,
+    	updated = timezone('utc'::text, now())
+    where id = $1 and worker = $2 and status = 'running';
+    """
 
+EXPIRE_JOBS_QUERY = """
+    update clickhouse_backup.backup_jobs
+    set status = 'error', error = 'the lease has expired, no attempts left', updated = timezone('utc'::text, now())
+    where status = 'running' and lease_until < timezone('utc'::text, now()) and attempts >= $1;
+    """
 
-def insert_backup_log_query(data: BackupLogEntity):
-    sql = "INSERT INTO clickhouse_backup.backup_log (backup_guid, table_name, partition_key, event, level) VALUES "
-    sql += data.get_string_values() + ";"
-    return sql
+INSERT_BACKUP_HISTORY_QUERY = f"""
+    insert into clickhouse_backup.backup_history ({", ".join(BackupHistoryEntity.COLUMNS)})
+    values ({", ".join([f"${number + 1}" for number in range(len(BackupHistoryEntity.COLUMNS))])});
+    """
 
 
 class PsQLTable:
     
     def __init__(self,  psql_pool: Pool):
         self.psql_pool = psql_pool
+    
+    @asynccontextmanager
+    async def connection(self):
+        t_start = time.monotonic()
+        async with self.psql_pool.acquire() as conn:
+            POOL_WAIT.observe(time.monotonic() - t_start, pool="postgresql")
+            yield conn
+    
+    async def fetch(self, query: str, *args) -> List:
+        async with self.connection() as conn:
+            return await conn.fetch(query, *args)
+    
+    async def fetchrow(self, query: str, *args):
+        async with self.connection() as conn:
+            return await conn.fetchrow(query, *args)
+    
+    async def fetchval(self, query: str, *args):
+        async with self.connection() as conn:
+            return await conn.fetchval(query, *args)
+    
+    async def execute(self, query: str, *args):
+        async with self.connection() as conn:
+            return await conn.execute(query, *args)
+    
+    async def copy_records_to_table(self, table_name: str, **kwargs):
+        async with self.connection() as conn:
+            return await conn.copy_records_to_table(table_name, **kwargs)
+    
+    async def ping(self):
+        await self.fetchval("select 1")
         
-    async def get_last_backup_schema(self, table_name: str) -> Dict:
-        sql = get_last_backup_sqhema_query(table_name)
+    async def get_last_backup_schemas(self, table_names: List[str]) -> Dict[str, Dict]:
+        """Отпечатки схем последних бэкапов таблиц: {table_name: {last_hash, last_schema_guid}}"""
         try:
-            result = await self.psql_pool.fetchrow(sql)
-            schema = json.loads(result['schema']) if result["schema"] else []
+            result = await self.fetch(GET_LAST_BACKUP_SCHEMAS_QUERY, table_names)
         except Exception as e:
-            raise ErrorGettingBackupSchema(e.__str()) from e
-        result = {}
-        for item in schema:
-            result.update(item)
-        return result
+            raise ErrorGettingBackupSchema(e.__str__()) from e
+        return {item['table_name']: {key: item[key] for key in ('last_hash', 'last_schema_guid')} for item in result}
     
-    async def insert_schema_table(self, data: List[TablesShemaEntity]):
-        sql = insert_schema_table_query(data)
+    async def create_monthly_partitions(self):
         try:
-            await self.psql_pool.execute(sql)
+            await self.execute(CREATE_MONTHLY_PARTITIONS_QUERY)
         except Exception as e:
-            raise ErrorInsertingSchemaBackup(e.__str__()) from e
+            raise ErrorCreatingPartitions(e.__str__()) from e
     
-    async def get_count_records_in_last_backup(self, table_name: str) -> Dict:
-        sql = get_count_records_in_last_backup_query(table_name)
+    async def copy_records(self, table_name: str, columns: Sequence[str], records: List[tuple]):
         try:
-            result = await self.psql_pool.fetch(sql)
+            await self.copy_records_to_table(
+                table_name, records=records, columns=columns, schema_name=SCHEMA_NAME
+            )
+        except Exception as e:
+            raise ErrorCopyingRecords(e.__str__()) from e
+    
+    async def get_last_backup_state(self, table_name: str, shard: int = 0) -> Dict:
+        try:
+            result = await self.fetch(GET_LAST_BACKUP_STATE_QUERY, table_name, shard)
         except Exception as e:
             raise ErrorGettingDataCount(e.__str__()) from e
-        return {item['partition_key']: item['count'] for item in result}
+        return {item['partition_key']: dict(item) for item in result}
     
-    async def insert_backup_history(self, data: BackupHistoryEntity):
-        sql = insert_backup_history_query(data)
+    async def get_backup_files(self, backup_guid: UUID, table_name: str = None) -> List[BackupHistoryEntity]:
         try:
-            await self.psql_pool.execute(sql)
+            result = await self.fetch(GET_BACKUP_FILES_QUERY, UUID(str(backup_guid)), table_name)
         except Exception as e:
-            raise ErrorInsertingBackupHistory(e.__str__()) from e
-            
-    async def insert_backup_log(self, data: BackupLogEntity):
-        sql = insert_backup_log_query(data)
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+        return [BackupHistoryEntity(**dict(item)) for item in result]
+    
+    async def get_files_to_verify(
+        self, backup_guid: UUID = None, table_name: str = None, since: datetime = None
+    ) -> List[BackupHistoryEntity]:
+        try:
+            result = await self.fetch(GET_FILES_TO_VERIFY_QUERY, backup_guid, table_name, since)
+        except Exception as e:
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+        return [BackupHistoryEntity(**dict(item)) for item in result]
+    
+    async def save_manifest(
+        self, backup_guid: UUID, table_name: str, shard: int = 0, partitions: List[str] = None
+    ) -> List[Dict]:
+        """
+        Сохранение в backup_manifest цепочек файлов партиций таблицы (всех или только partitions)
+        по состоянию latest_partition_backup, возвращаются файлы цепочек
+        """
+        try:
+            result = await self.fetch(
+                SAVE_MANIFEST_QUERY, UUID(str(backup_guid)), table_name, shard, partitions
+            )
+        except Exception as e:
+            raise ErrorBackupManifest(e.__str__()) from e
+        return [dict(item) for item in result]
+    
+    async def get_manifest_files(self, backup_guid: UUID, table_name: str = None) -> List[BackupHistoryEntity]:
+        """Файлы, из которых восстанавливается состояние таблиц на момент бэкапа по его манифесту"""
+        try:
+            result = await self.fetch(GET_MANIFEST_FILES_QUERY, UUID(str(backup_guid)), table_name)
+        except Exception as e:
+            raise ErrorBackupManifest(e.__str__()) from e
+        return [BackupHistoryEntity(**dict(item)) for item in result]
+    
+    async def backup_exists(self, backup_guid: UUID) -> bool:
+        try:
+            return await self.fetchval(BACKUP_EXISTS_QUERY, UUID(str(backup_guid)))
+        except Exception as e:
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+    
+    async def get_backup_guids_at(self, at: datetime, table_name: str = None) -> Dict:
+        try:
+            result = await self.fetch(GET_BACKUP_GUIDS_AT_QUERY, at, table_name)
+        except Exception as e:
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+        return {item['table_name']: item['backup_guid'] for item in result}
+    
+    async def get_restore_files(
+        self, table_name: str, at: datetime
+    ) -> Tuple[List[BackupHistoryEntity], List[BackupHistoryEntity]]:
+        """
+        Файлы, из которых восстанавливается состояние таблицы на момент at: по каждой партиции
+        последняя полная выгрузка (все ее части) и delta после нее, из каких бы бэкапов они ни были.
+        Вторым списком - по одному файлу партиций, у которых до at нет полной выгрузки со всеми частями
+        """
+        try:
+            result = await self.fetch(GET_RESTORE_FILES_QUERY, table_name, at)
+        except Exception as e:
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+        records, missing = [], []
+        for item in result:
+            item = dict(item)
+            (records if item.pop('has_base') else missing).append(BackupHistoryEntity(**item))
+        return records, missing
+    
+    async def get_backup_schemas(self, table_name: str, backup_guids: List[UUID]) -> Dict[str, Dict]:
+        """Схемы таблицы в нескольких бэкапах одним запросом: {backup_guid: {поле: тип}}"""
+        try:
+            result = await self.fetch(
+                GET_BACKUP_SCHEMAS_QUERY, table_name, [UUID(str(backup_guid)) for backup_guid in backup_guids]
+            )
+        except Exception as e:
+            raise ErrorGettingBackupSchema(e.__str__()) from e
+        schemas = {}
+        for item in result:
+            schemas.setdefault(str(item['backup_guid']), {})[item['field_name']] = item['field_type']
+        return schemas
+    
+    async def get_unfinished_partitions(self, backup_guid: UUID, table_name: str = None) -> List[Dict]:
+        """
+        Партиции бэкапа backup_guid, которые были запланированы или завершились ошибкой
+        (есть в backup_log), но выгружены не полностью (нет всех частей в backup_history).
+        Партиции шардов кластера различаются по shard
+        """
+        try:
+            result = await self.fetch(GET_UNFINISHED_PARTITIONS_QUERY, UUID(str(backup_guid)), table_name)
+        except Exception as e:
+            raise ErrorGettingBackupFiles(e.__str__()) from e
+        return [dict(item) for item in result]
+    
+    async def get_throughput(self, table_names: List[str], days: int = 30) -> Dict:
+        """
+        Средняя скорость выгрузки (записей в секунду) по backup_history за days дней:
+        по каждой таблице и по всем таблицам вместе (ключ None)
+        """
+        try:
+            result = await self.fetch(GET_THROUGHPUT_QUERY, table_names, days)
+        except Exception as e:
+            raise ErrorGettingDataCount(e.__str__()) from e
+        throughput = {
+            item['table_name']: item['count'] / item['execution_time'] for item in result if item['execution_time']
+        }
+        total_time = sum([item['execution_time'] for item in result])
+        if total_time:
+            throughput[None] = sum([item['count'] for item in result]) / total_time
+        return throughput
+    
+    async def claim_job(self, worker: str, lease: int, max_attempts: int, backup_guid: UUID = None) -> Dict:
+        try:
+            result = await self.fetchrow(
+                CLAIM_JOB_QUERY, worker, lease, max_attempts, None if backup_guid is None else UUID(str(backup_guid))
+            )
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+        return None if result is None else dict(result)
+    
+    async def extend_job_lease(self, job_id: int, worker: str, lease: int) -> bool:
+        try:
+            result = await self.fetchval(EXTEND_JOB_LEASE_QUERY, job_id, worker, lease)
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+        return result is not None
+    
+    async def complete_job(self, job_id: int, worker: str, record: BackupHistoryEntity):
+        """Завершение задания и запись в backup_history одной транзакцией, если аренда еще у worker"""
+        try:
+            async with self.connection() as conn:
+                async with conn.transaction():
+                    if await conn.fetchval(COMPLETE_JOB_QUERY, job_id, worker) is not None:
+                        await conn.execute(INSERT_BACKUP_HISTORY_QUERY, *record.get_record())
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+        
+    async def fail_job(self, job_id: int, worker: str, error: str, retry: bool, delay: float = 0):
+        """Задание с retry возвращается в очередь, но берется не раньше чем через delay секунд"""
+        try:
+            await self.execute(FAIL_JOB_QUERY, job_id, worker, error, retry, float(delay))
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+        
+    async def release_job(self, job_id: int, worker: str):
+        """Возврат прерванного остановкой worker задания в очередь, попытка не учитывается"""
+        try:
+            await self.execute(RELEASE_JOB_QUERY, job_id, worker)
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+        
+    async def expire_jobs(self, max_attempts: int):
+        try:
+            await self.execute(EXPIRE_JOBS_QUERY, max_attempts)
+        except Exception as e:
+            raise ErrorBackupJobs(e.__str__()) from e
+    
+    async def get_backup_schema(self, backup_guid: UUID, table_name: str) -> Dict:
         try:
-            await self.psql_pool.execute(sql)
+            result = await self.fetch(GET_BACKUP_SCHEMA_QUERY, UUID(str(backup_guid)), table_name)
         except Exception as e:
-            raise ErrorInsertingBackupLog(e.__str__()) from e
-    
\ No newline at end of file
+            raise ErrorGettingBackupSchema(e.__str__()) from e
+        return {item['field_name']: item['field_type'] for item in result}
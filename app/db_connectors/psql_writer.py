@@ -0,0 +1,158 @@
+import os
+import json
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Union
+from asyncpg.pool import Pool
+
+from .postgresql_connector import PsQLTable
+from ..types import BackupHistoryEntity, BackupLogEntity, TablesShemaEntity, QueryStatsEntity, BackupJobEntity
+from ..types import BackupSchemaEntity, InfoMessages
+from settings.log import app_log
+
+
+Entity = Union[
+    BackupHistoryEntity, BackupLogEntity, TablesShemaEntity, BackupSchemaEntity, QueryStatsEntity, BackupJobEntity
+]
+ENTITIES = {
+    entity.TABLE_NAME: entity 
+    for entity in (
+        BackupHistoryEntity, BackupLogEntity, TablesShemaEntity, BackupSchemaEntity, QueryStatsEntity, BackupJobEntity
+    )
+}
+
+
+class PsQLWriter:
+    """
+    Буферизованная запись backup_history, backup_log, tables_schema, backup_schema, query_stats и backup_jobs.
+    Записи накапливаются в памяти и сбрасываются в postgresql одним COPY
+    при достижении batch_size или раз в flush_interval секунд.
+    Если postgresql недоступен, записи дописываются в локальный spool файл
+    и повторно отправляются при следующем запуске. Записи, которые не удалось записать
+    и после max_replays повторов (например, нарушение ограничения), переносятся
+    в файл {spool_path}.dead и больше не повторяются.
+    Каждый COPY выполняется отдельной задачей из _flush_tasks: flush и close дожидаются
+    всех начатых COPY, поэтому после flush все добавленные до него записи уже в postgresql
+    (или в spool файле).
+    """
+
+    def __init__(
+            self, psql_pool: Pool, batch_size: int, flush_interval: float, spool_path: str, max_replays: int = 5
+        ):
+        self.psql_table = PsQLTable(psql_pool=psql_pool)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.dead_letter_path = f"{spool_path}.dead"
+        self.max_replays = max_replays
+        self._buffers: Dict[str, List[Entity]] = defaultdict(list)
+        self._flush_tasks = set()
+        self._timer: asyncio.Task = None
+        self._closing = asyncio.Event()
+
+    async def start(self):
+        await self.replay_spool()
+        self._timer = asyncio.create_task(self._flush_periodically(), name="psql-writer")
+
+    async def close(self):
+        # таймер не отменяется: он завершает начатый сброс и выходит из цикла сам
+        self._closing.set()
+        if self._timer is not None:
+            await asyncio.gather(self._timer, return_exceptions=True)
+        await self.flush()
+
+    def add(self, entity: Entity):
+        buffer = self._buffers[entity.TABLE_NAME]
+        buffer.append(entity)
+        if len(buffer) >= self.batch_size:
+            # буфер забирается сразу, иначе до запуска задачи каждый add создавал бы новую
+            self._start_copy(entity.TABLE_NAME, self._buffers.pop(entity.TABLE_NAME))
+
+    async def flush(self):
+        """Запись всех накопленных записей и ожидание всех начатых COPY, в том числе начатых таймером"""
+        for table_name in list(self._buffers):
+            entities = self._buffers.pop(table_name)
+            if entities:
+                self._start_copy(table_name, entities)
+        while self._flush_tasks:
+            await asyncio.gather(*list(self._flush_tasks), return_exceptions=True)
+
+    async def _flush_periodically(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def _start_copy(self, table_name: str, entities: List[Entity], replays: int = 0) -> asyncio.Task:
+        task = asyncio.create_task(self._copy(table_name, entities, replays))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+        return task
+
+    async def _copy(self, table_name: str, entities: List[Entity], replays: int = 0):
+        """replays - сколько раз записи уже повторялись из spool файла"""
+        entity_type = ENTITIES[table_name]
+        try:
+            await self.psql_table.copy_records(
+                table_name, entity_type.COLUMNS, [entity.get_record() for entity in entities]
+            )
+        except asyncio.CancelledError:
+            # записи уже забраны из буфера: при отмене (остановка процесса) они сохраняются в spool,
+            # синхронно - цикл событий в этот момент может уже завершаться
+            self._write_spool(self.spool_path, table_name, entities, replays)
+            raise
+        except Exception:
+            app_log.warning(InfoMessages.PSQL_ERROR.value, exc_info=True)
+            await self._spool(table_name, entities, replays)
+
+    async def _spool(self, table_name: str, entities: List[Entity], replays: int = 0):
+        path = self.spool_path
+        if replays >= self.max_replays:
+            path = self.dead_letter_path
+        # запись файла не блокирует цикл событий
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write_spool, path, table_name, entities, replays
+        )
+        message = InfoMessages.SPOOL_RECORDS if path == self.spool_path else InfoMessages.SPOOL_DEAD_LETTER
+        app_log.warning(message.value.format(count=len(entities), table_name=table_name, path=path))
+
+    @staticmethod
+    def _write_spool(path: str, table_name: str, entities: List[Entity], replays: int = 0):
+        with open(path, "a") as f:
+            for entity in entities:
+                f.write(
+                    json.dumps(
+                        {"table_name": table_name, "replays": replays, "data": entity.extract_data()}, default=str
+                    ) + "\n"
+                )
+
+    async def replay_spool(self):
+        # spool файл общий для процессов на хосте: его забирает тот, кто первым переименует
+        replay_path = f"{self.spool_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spool_path, replay_path)
+        except FileNotFoundError:
+            return
+        entities = await asyncio.get_running_loop().run_in_executor(None, self._read_spool, replay_path)
+        # записи повторяются пачками с одинаковым числом повторов, чтобы считать их для каждой записи
+        for (table_name, replays), items in entities.items():
+            await self._start_copy(table_name, items, replays + 1)
+        app_log.info(
+            InfoMessages.SPOOL_REPLAYED.value.format(
+                count=sum([len(items) for items in entities.values()]), path=self.spool_path
+            )
+        )
+
+    @staticmethod
+    def _read_spool(path: str) -> Dict[tuple, List[Entity]]:
+        entities: Dict[tuple, List[Entity]] = defaultdict(list)
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    entities[(item["table_name"], item.get("replays", 0))].append(
+                        ENTITIES[item["table_name"]](**item["data"])
+                    )
+        os.remove(path)
+        return entities
@@ -0,0 +1,21 @@
+from .db_connectors.connection import create_psql_pool
+from settings.db import DbConfig
+from settings.log import setup_logging
+
+
+class Listing:
+    """
+    Список бэкапов читается только из postgresql: команда не загружает app.app,
+    драйвер clickhouse и планировщик (время запуска - benchmarks/cold_start.py)
+    """
+    
+    async def run(self, **kwargs):
+        setup_logging()
+        self.psql_pool = await create_psql_pool(**DbConfig.CONNECTION_SETTINGS)
+        try:
+            return await self._execute(**kwargs)
+        finally:
+            await self.psql_pool.close()
+    
+    async def _execute(self, table: str = None, gt: str = None):
+        print(table, gt)
@@ -0,0 +1,164 @@
+import os
+import asyncio
+from typing import Dict, List, Tuple, Optional
+
+from .types import InfoMessages
+from settings.log import app_log
+
+
+class Metric:
+    """Метрика в формате Prometheus: значения хранятся по набору значений меток"""
+    type_name = "untyped"
+    
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple([str(labels.get(label, "")) for label in self.labels])
+    
+    def _format_labels(self, key: Tuple[str, ...]) -> str:
+        if not self.labels:
+            return ""
+        items = []
+        for label, value in zip(self.labels, key):
+            value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+            items.append(f'{label}="{value}"')
+        return "{" + ",".join(items) + "}"
+    
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        return [(self.name, key, value) for key, value in self.values.items()]
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{self._format_labels(key)} {value}")
+        return "\n".join(lines)
+    
+    
+class Counter(Metric):
+    type_name = "counter"
+    
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+        
+        
+class Gauge(Metric):
+    type_name = "gauge"
+    
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+        
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+        
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+        
+        
+class Summary(Metric):
+    """Сумма и количество наблюдений (без квантилей)"""
+    type_name = "summary"
+    
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.counts: Dict[Tuple[str, ...], int] = {}
+        
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+        self.counts[key] = self.counts.get(key, 0) + 1
+        
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        result = []
+        for key, value in self.values.items():
+            result.append((f"{self.name}_sum", key, value))
+            result.append((f"{self.name}_count", key, self.counts[key]))
+        return result
+    
+    
+class Registry:
+    
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        return "\n".join([metric.render() for metric in self.metrics.values()]) + "\n"
+    
+    def write_textfile(self, path: str):
+        """Файл для textfile collector node_exporter, заменяется атомарно"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+    
+    
+class MetricsServer:
+    """Минимальный HTTP сервер, отдающий метрики реестра на любой GET запрос"""
+    
+    def __init__(self, registry: Registry, port: int, host: str = "0.0.0.0"):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._server: Optional[asyncio.AbstractServer] = None
+        
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        app_log.info(InfoMessages.METRICS_SERVER_STARTED.value.format(port=self.port))
+        
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+            
+            
+REGISTRY = Registry()
+INFLIGHT_PARTITIONS = REGISTRY.register(
+    Gauge("clickhouse_backup_inflight_jobs", "Jobs (partition exports or restores) running now", ("table",))
+)
+QUEUE_WAIT = REGISTRY.register(
+    Summary("clickhouse_backup_queue_wait_seconds", "Time jobs wait in the scheduler queue", ("table",))
+)
+POOL_WAIT = REGISTRY.register(
+    Summary(
+        "clickhouse_backup_pool_wait_seconds", 
+        "Time waiting for a pool connection (clickhouse metadata and export pools, postgresql)", 
+        ("pool",)
+    )
+)
+JOB_DURATION = REGISTRY.register(
+    Summary("clickhouse_backup_job_duration_seconds", "Duration of jobs", ("table",))
+)
+JOBS = REGISTRY.register(
+    Counter("clickhouse_backup_jobs_total", "Finished jobs by result", ("table", "status"))
+)
+ROWS = REGISTRY.register(
+    Counter("clickhouse_backup_rows_total", "Rows written by export and restore queries", ("table",))
+)
+BYTES = REGISTRY.register(
+    Counter("clickhouse_backup_bytes_total", "Bytes written by export queries (system.query_log)", ("table",))
+)
@@ -0,0 +1,30 @@
+import asyncio
+import random
+
+from settings.app import AppConfig
+
+
+def is_retryable(err: BaseException) -> bool:
+    """
+    Ошибка считается временной, если она сама или любая из ее причин (__cause__)
+    является таймаутом/ошибкой соединения или исключением clickhouse с кодом
+    из AppConfig.RETRYABLE_ERROR_CODES
+    """
+    while err is not None:
+        if isinstance(err, (asyncio.TimeoutError, ConnectionError)):
+            return True
+        code = getattr(err, "code", None)
+        if isinstance(code, int) and code in AppConfig.RETRYABLE_ERROR_CODES:
+            return True
+        err = err.__cause__
+    return False
+
+
+def can_retry(err: BaseException, attempt: int) -> bool:
+    return attempt < AppConfig.RETRY_ATTEMPTS and is_retryable(err)
+
+
+def get_retry_delay(attempt: int) -> float:
+    """Экспоненциальная задержка перед повтором attempt + 1 со случайным разбросом"""
+    delay = min(AppConfig.RETRY_BACKOFF * 2 ** (attempt - 1), AppConfig.RETRY_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1)
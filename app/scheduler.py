@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .metrics import INFLIGHT_PARTITIONS, QUEUE_WAIT, JOB_DURATION
+from .types import InfoMessages
+from settings.log import app_log, log_context
+
+
+@dataclass(order=True)
+class Job:
+    priority: int
+    order: int
+    table_name: str = field(compare=False)
+    action: Callable[[], Awaitable] = field(compare=False)
+    enqueued: float = field(default=0, compare=False)
+
+
+class Scheduler:
+    """
+    Общая очередь заданий (таблица, партиция) для всех таблиц.
+    Задания хранятся в очереди с приоритетом и выбираются в порядке убывания
+    оценки размера (count/bytes), фиксированное число воркеров забирает их из очереди.
+    Для таблицы можно ограничить число одновременно выполняемых заданий:
+    задания сверх лимита откладываются до завершения текущего задания этой таблицы.
+    Задание можно поставить в очередь с задержкой (повтор после ошибки), не занимая воркер.
+    Число одновременно выполняемых заданий (concurrency) можно менять во время работы
+    в пределах max_workers (см. ConcurrencyController).
+    """
+
+    def __init__(self, workers: int, table_limits: Optional[Dict[str, int]] = None, max_workers: int = None):
+        self.workers = max(workers, max_workers or 0)
+        self.concurrency = workers
+        self.table_limits = table_limits or {}
+        self.processed_rows = 0
+        self._active = 0
+        self._slots = asyncio.Condition()
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._deferred: Dict[str, List[Job]] = defaultdict(list)
+        self._running: Dict[str, int] = defaultdict(int)
+        self._counter = itertools.count()
+        self._pending = 0
+        self._done = asyncio.Event()
+        self._delayed: Dict[int, asyncio.TimerHandle] = {}
+        self.stopped = False
+
+    def put(self, table_name: str, weight: int, action: Callable[[], Awaitable], delay: float = 0):
+        if self.stopped:
+            return
+        job = Job(priority=-(weight or 0), order=next(self._counter), table_name=table_name, action=action)
+        self._pending += 1
+        self._done.clear()
+        if delay > 0:
+            self._delayed[job.order] = asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+        else:
+            self._enqueue(job)
+    
+    def _enqueue(self, job: Job):
+        self._delayed.pop(job.order, None)
+        job.enqueued = time.monotonic()
+        self._queue.put_nowait(job)
+    
+    def stop(self):
+        """Задания из очереди, отложенные и новые не запускаются, run завершается после выполняемых"""
+        self.stopped = True
+        dropped = len(self._delayed) + self.waiting
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+        self._deferred.clear()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._pending -= dropped
+        if self._pending == 0:
+            self._done.set()
+
+    def set_workers(self, workers: int):
+        """Изменение числа воркеров до запуска run"""
+        self.workers = max(self.workers, workers)
+        self.concurrency = workers
+    
+    async def set_concurrency(self, concurrency: int):
+        async with self._slots:
+            self.concurrency = min(concurrency, self.workers)
+            self._slots.notify_all()
+    
+    def add_processed_rows(self, rows: int):
+        """Учет выгруженных записей для оценки пропускной способности"""
+        self.processed_rows += rows or 0
+    
+    @property
+    def waiting(self) -> int:
+        return self._queue.qsize() + sum([len(jobs) for jobs in self._deferred.values()])
+    
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def set_table_limit(self, table_name: str, limit: Optional[int]):
+        if limit:
+            self.table_limits[table_name] = limit
+
+    def _is_table_limited(self, table_name: str) -> bool:
+        limit = self.table_limits.get(table_name)
+        return bool(limit) and self._running[table_name] >= limit
+
+    async def _acquire_slot(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._active < self.concurrency)
+            self._active += 1
+    
+    async def _release_slot(self):
+        async with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
+
+    async def _worker(self):
+        while True:
+            await self._acquire_slot()
+            try:
+                await self._process(await self._queue.get())
+            finally:
+                await self._release_slot()
+    
+    async def _process(self, job: Job):
+        if self._is_table_limited(job.table_name):
+            heapq.heappush(self._deferred[job.table_name], job)
+            return
+        self._running[job.table_name] += 1
+        INFLIGHT_PARTITIONS.inc(table=job.table_name)
+        t_start = time.monotonic()
+        QUEUE_WAIT.observe(t_start - job.enqueued, table=job.table_name)
+        try:
+            await job.action()
+        except Exception:
+            app_log.error(
+                InfoMessages.JOB_ERROR.value.format(table_name=job.table_name), 
+                exc_info=True, 
+                extra=log_context(table=job.table_name)
+            )
+        finally:
+            JOB_DURATION.observe(time.monotonic() - t_start, table=job.table_name)
+            INFLIGHT_PARTITIONS.dec(table=job.table_name)
+            self._running[job.table_name] -= 1
+            deferred = self._deferred.get(job.table_name)
+            if deferred:
+                self._queue.put_nowait(heapq.heappop(deferred))
+            self._pending -= 1
+            if self._pending == 0:
+                self._done.set()
+
+    async def run(self):
+        if self._pending == 0:
+            return
+        workers = [
+            asyncio.create_task(self._worker(), name=f"worker-{number}") for number in range(self.workers)
+        ]
+        try:
+            await self._done.wait()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
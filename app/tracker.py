@@ -0,0 +1,122 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from asynch.errors import ServerException
+
+from .db_connectors.clickhouse_connector import ClickhouseCatalog
+from .types import InfoMessages
+from settings.app import AppConfig
+from settings.log import app_log, log_context
+
+
+class QueryTracker:
+    """
+    Отслеживание запросов выгрузки на сервере clickhouse по их query_id.
+    Раз в interval секунд прогресс всех выполняемых выгрузок (прочитано записей и байт,
+    время выполнения) читается одним запросом к system.processes каждого сервера и пишется в лог.
+    Выгрузка, не завершившаяся за свой deadline, останавливается kill query.
+    Если запрос завершился ошибкой на стороне клиента (например, RECEIVE_TIMEOUT),
+    он останавливается и на сервере, чтобы повтор не выполнялся параллельно с ним.
+    cancel() останавливает все выполняемые выгрузки (SIGINT/SIGTERM).
+    """
+
+    def __init__(self, interval: float = AppConfig.EXPORT_PROGRESS_INTERVAL):
+        self.interval = interval
+        # query_id: {catalog, context}, catalog - соединение с сервером, на котором выполняется запрос
+        self.queries: Dict[str, Dict] = {}
+        self.killed = set()
+        self._task: Optional[asyncio.Task] = None
+        self._kill_tasks = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="query-tracker")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._kill_tasks:
+            await asyncio.gather(*list(self._kill_tasks), return_exceptions=True)
+
+    @asynccontextmanager
+    async def track(self, query_id: str, catalog: ClickhouseCatalog, deadline: float = None, **context):
+        """Регистрация запроса query_id на время его выполнения, context - поля для лога (log_context)"""
+        handle = None
+        if deadline:
+            handle = asyncio.get_running_loop().call_later(deadline, self._expire, query_id, deadline)
+        self.queries[query_id] = {'catalog': catalog, 'context': context}
+        try:
+            yield
+        except BaseException as err:
+            # ошибкой сервера запрос уже завершен, а при ошибке клиента он на сервере еще может выполняться
+            if query_id not in self.killed and not isinstance(err.__cause__ or err, ServerException):
+                await self.kill([query_id])
+            raise
+        finally:
+            if handle is not None:
+                handle.cancel()
+            self.queries.pop(query_id, None)
+            self.killed.discard(query_id)
+
+    def _expire(self, query_id: str, deadline: float):
+        item = self.queries.get(query_id)
+        if item is None:
+            return
+        context = item['context']
+        app_log.warning(
+            InfoMessages.EXPORT_DEADLINE.value.format(
+                table_name=context.get('table'), partition_value=context.get('partition'), deadline=round(deadline)
+            ),
+            extra=log_context(**context)
+        )
+        self._run_kill([query_id])
+
+    def _run_kill(self, query_ids: List[str]):
+        task = asyncio.create_task(self.kill(query_ids))
+        self._kill_tasks.add(task)
+        task.add_done_callback(self._kill_tasks.discard)
+
+    async def kill(self, query_ids: List[str]):
+        catalogs = {}
+        for query_id in query_ids:
+            item = self.queries.get(query_id)
+            if item is not None:
+                self.killed.add(query_id)
+                catalogs.setdefault(id(item['catalog']), (item['catalog'], []))[1].append(query_id)
+        for catalog, ids in catalogs.values():
+            try:
+                await catalog.kill_queries(ids)
+            except Exception:
+                app_log.error(InfoMessages.ERROR_KILL_QUERY.value.format(query_ids=", ".join(ids)), exc_info=True)
+
+    def cancel(self):
+        """Остановка на сервере всех выполняемых выгрузок, kill query выполняется в отдельной задаче"""
+        self._run_kill(list(self.queries))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception:
+                app_log.warning(InfoMessages.ERROR_EXPORT_PROGRESS.value, exc_info=True)
+
+    async def poll(self):
+        catalogs = {}
+        for query_id, item in list(self.queries.items()):
+            catalogs.setdefault(id(item['catalog']), (item['catalog'], []))[1].append(query_id)
+        for catalog, query_ids in catalogs.values():
+            progress = await catalog.get_queries_progress(query_ids)
+            for query_id, item in progress.items():
+                context = self.queries.get(query_id, {}).get('context', {})
+                app_log.info(
+                    InfoMessages.EXPORT_PROGRESS.value.format(
+                        table_name=context.get('table'),
+                        partition_value=context.get('partition'),
+                        read_rows=item['read_rows'],
+                        total_rows=item['total_rows_approx'],
+                        read_bytes=item['read_bytes'],
+                        elapsed=round(item['elapsed'])
+                    ),
+                    extra=log_context(**context, duration=round(item['elapsed'], 3))
+                )
@@ -1,64 +1,407 @@
+import re
 import copy
-from typing import Optional, Union
+import hashlib
+from datetime import datetime
+from typing import Optional, Union, Dict, List
 from uuid import UUID
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+
+class ChangeDetection(Enum):
+    COUNT = "count"
+    CHECKSUM = "checksum"
+    # номера блоков активных кусков system.parts: выгружаются только новые куски партиции
+    PARTS = "parts"
+
+
+class Discovery(Enum):
+    SCAN = "scan"
+    PARTS = "parts"
+
+
+class ExportMode(Enum):
+    PARTITION = "partition"
+    PARTITION_BY = "partition_by"
 
 
 class DBLevelLog(Enum):
+    INFO = "info"
     WARNING = "warning"
     ERROR = "error"
 
 
+def get_created(value: Union[datetime, str, None]) -> datetime:
+    """
+    Время создания записи (UTC, как default в postgresql) фиксируется при ее добавлении в буфер,
+    а не при записи: записи из spool файла сохраняют свое время. В spool оно хранится строкой
+    """
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
 @dataclass
 class BackupHistoryEntity:
+    TABLE_NAME = "backup_history"
+    COLUMNS = (
+        "backup_guid", "table_name", "partition_key", "count", "file_name", "execution_time",
+        "file_format", "compression", "checksum", "modification_time", "chunk", "chunks", "shard",
+        "base_block", "max_block", "mutation", "created"
+    )
+    
     backup_guid: UUID
     table_name: str
     partition_key: str
     count: str
     file_name: str
     execution_time: int = None
+    file_format: str = None
+    compression: str = None
+    checksum: str = None
+    modification_time: int = None
+    chunk: int = 0
+    chunks: int = 1
+    shard: int = 0
+    base_block: int = None
+    max_block: int = None
+    mutation: int = None
+    created: datetime = None
+    
+    def __post_init__(self):
+        self.created = get_created(self.created)
     
     def extract_data(self):
         if self.execution_time is None:
             raise KeyError("execution_time cannot be None")
         return self.__dict__
     
-    def get_string_values(self) -> str:
-        return f"""('{str(self.backup_guid)}', '{self.table_name}', '{self.partition_key}', 
-                    {self.count}, '{self.file_name}', {self.execution_time})"""
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.partition_key, int(self.count), self.file_name,
+            int(round(self.execution_time)), self.file_format, self.compression, self.checksum,
+            self.modification_time, self.chunk, self.chunks, self.shard, self.base_block, self.max_block,
+            self.mutation, self.created
+        )
     
     
 @dataclass
 class BackupLogEntity:
+    TABLE_NAME = "backup_log"
+    COLUMNS = ("backup_guid", "table_name", "partition_key", "event", "level", "shard", "created")
+    
     backup_guid: UUID
     table_name: str
     partition_key: str
     event: str
     level: DBLevelLog
+    shard: int = 0
+    created: datetime = None
+    
+    def __post_init__(self):
+        if isinstance(self.level, str):
+            self.level = DBLevelLog(self.level)
+        self.created = get_created(self.created)
     
     def extract_data(self):
         res = copy.copy(self.__dict__)
         res["level"] = res["level"].value
         return res
     
-    def get_string_values(self) -> str:
-        return f"""('{str(self.backup_guid)}', '{self.table_name}', '{self.partition_key}',
-                    '{self.event}', '{self.level.value}')"""
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.partition_key, self.event, self.level.value, 
+            self.shard, self.created
+        )
     
     
 @dataclass
 class TablesShemaEntity:
+    TABLE_NAME = "tables_schema"
+    COLUMNS = ("backup_guid", "table_name", "field_name", "field_type", "field_position", "created")
+    
     backup_guid: UUID
     table_name: str
     field_name: str
     field_type: str
+    field_position: int = 0
+    created: datetime = None
+    
+    def __post_init__(self):
+        self.created = get_created(self.created)
+    
+    def extract_data(self):
+        return self.__dict__
+    
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.field_name, self.field_type, self.field_position,
+            self.created
+        )
+    
+    
+@dataclass
+class BackupSchemaEntity:
+    TABLE_NAME = "backup_schema"
+    COLUMNS = ("backup_guid", "table_name", "schema_hash", "schema_guid", "created")
+    
+    backup_guid: UUID
+    table_name: str
+    schema_hash: str
+    schema_guid: UUID
+    created: datetime = None
+    
+    def __post_init__(self):
+        self.created = get_created(self.created)
+    
+    def extract_data(self):
+        return self.__dict__
+    
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.schema_hash, UUID(str(self.schema_guid)), self.created
+        )
+    
+    
+@dataclass
+class QueryStatsEntity:
+    TABLE_NAME = "query_stats"
+    COLUMNS = (
+        "backup_guid", "table_name", "partition_key", "chunk", "query_id", "read_rows", "read_bytes",
+        "written_rows", "written_bytes", "memory_usage", "duration_ms", "created"
+    )
+    
+    backup_guid: UUID
+    table_name: str
+    partition_key: str
+    chunk: int
+    query_id: str
+    read_rows: int = None
+    read_bytes: int = None
+    written_rows: int = None
+    written_bytes: int = None
+    memory_usage: int = None
+    duration_ms: int = None
+    created: datetime = None
+    
+    def __post_init__(self):
+        self.created = get_created(self.created)
     
     def extract_data(self):
         return self.__dict__
     
-    def get_string_values(self) -> str:
-        return f"('{str(self.backup_guid)}', '{self.table_name}', '{self.field_name}', '{self.field_type}')"
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.partition_key, self.chunk, self.query_id,
+            self.read_rows, self.read_bytes, self.written_rows, self.written_bytes, self.memory_usage,
+            self.duration_ms, self.created
+        )
+    
+    
+@dataclass
+class BackupJobEntity:
+    TABLE_NAME = "backup_jobs"
+    COLUMNS = (
+        "backup_guid", "table_name", "partition_key", "chunk", "chunks", "count", "bytes", "checksum",
+        "modification_time", "datetime_backup", "created"
+    )
+    
+    backup_guid: UUID
+    table_name: str
+    partition_key: str
+    chunk: int
+    chunks: int
+    count: int
+    datetime_backup: str
+    bytes: int = None
+    checksum: str = None
+    modification_time: int = None
+    created: datetime = None
+    
+    def __post_init__(self):
+        self.created = get_created(self.created)
+    
+    def extract_data(self):
+        return self.__dict__
+    
+    def get_record(self) -> tuple:
+        return (
+            UUID(str(self.backup_guid)), self.table_name, self.partition_key, self.chunk, self.chunks,
+            int(self.count), self.bytes, self.checksum, self.modification_time, self.datetime_backup, self.created
+        )
+    
+    
+@dataclass
+class BackupFileFormat:
+    """
+    Формат файла бэкапа и способ его сжатия.
+    Для колоночных форматов (Parquet, Arrow, ArrowStream) сжатие выполняется
+    внутри формата по колонкам, поэтому сам файл в s3 дополнительно не сжимается,
+    а уровень сжатия (output_format_compression_level) для них не задается.
+    """
+    format_file: str
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    
+    FILE_EXTENSIONS = {
+        "CSV": "csv",
+        "Native": "native",
+        "Parquet": "parquet",
+        "Arrow": "arrow",
+        "ArrowStream": "arrows",
+    }
+    COMPRESSION_EXTENSIONS = {"gzip": "gz", "zstd": "zst", "lz4": "lz4", "none": None}
+    COLUMNAR_COMPRESSION_SETTINGS = {
+        "Parquet": "output_format_parquet_compression_method",
+        "Arrow": "output_format_arrow_compression_method",
+        "ArrowStream": "output_format_arrow_compression_method",
+    }
+    # output_format_arrow_compression_method принимает только lz4_frame, zstd и none
+    FORMAT_COMPRESSIONS = {
+        "Arrow": ("lz4", "zstd", "none"),
+        "ArrowStream": ("lz4", "zstd", "none"),
+    }
+    
+    def __post_init__(self):
+        if self.compression is None:
+            self.compression = "none"
+        if self.format_file not in self.FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported backup format: {self.format_file}")
+        if self.compression not in self.COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unsupported backup compression: {self.compression}")
+        if self.compression not in self.FORMAT_COMPRESSIONS.get(self.format_file, self.COMPRESSION_EXTENSIONS):
+            raise ValueError(f"Unsupported backup compression {self.compression} of the {self.format_file} format")
+        if self.compression_level is not None and self.is_columnar:
+            raise ValueError(f"Compression level is not supported by the {self.format_file} format")
+        
+    @property
+    def is_columnar(self) -> bool:
+        return self.format_file in self.COLUMNAR_COMPRESSION_SETTINGS
+        
+    @property
+    def s3_compression(self) -> str:
+        return "none" if self.is_columnar else self.compression
+    
+    @property
+    def extension(self) -> str:
+        extension = self.FILE_EXTENSIONS[self.format_file]
+        suffix = self.COMPRESSION_EXTENSIONS[self.s3_compression]
+        return extension if suffix is None else f"{extension}.{suffix}"
+    
+    def get_output_settings(self) -> Dict:
+        if self.is_columnar:
+            method = self.compression
+            if method == "lz4" and self.format_file != "Parquet":
+                method = "lz4_frame"
+            return {self.COLUMNAR_COMPRESSION_SETTINGS[self.format_file]: method}
+        if self.compression_level is not None and self.compression != "none":
+            return {"output_format_compression_level": self.compression_level}
+        return {}
+    
+    
+@dataclass
+class TableConfig:
+    table_name: str
+    partition_key: Optional[str]
+    file_format: BackupFileFormat
+    max_threads: Optional[int] = None
+    change_detection: ChangeDetection = ChangeDetection.COUNT
+    discovery: Discovery = Discovery.PARTS
+    max_rows_per_file: Optional[int] = None
+    max_bytes_per_file: Optional[int] = None
+    split_key: Optional[str] = None
+    export_mode: ExportMode = ExportMode.PARTITION
+    local_table: Optional[str] = None
+    
+    @classmethod
+    def from_dict(cls, item: Dict, default_format: BackupFileFormat) -> "TableConfig":
+        if any(key in item for key in ("format", "compression", "compression_level")):
+            # уровень сжатия по умолчанию относится к формату и сжатию по умолчанию
+            inherit_level = "format" not in item and "compression" not in item
+            file_format = BackupFileFormat(
+                format_file=item.get("format", default_format.format_file),
+                compression=item.get("compression", default_format.compression),
+                compression_level=item.get(
+                    "compression_level", default_format.compression_level if inherit_level else None
+                )
+            )
+        else:
+            file_format = default_format
+        return cls(
+            table_name=item["table_name"],
+            partition_key=item.get("partition_key"),
+            file_format=file_format,
+            max_threads=item.get("max_threads"),
+            change_detection=ChangeDetection(item.get("change_detection", ChangeDetection.COUNT.value)),
+            discovery=Discovery(item.get("discovery", Discovery.PARTS.value)),
+            max_rows_per_file=item.get("max_rows_per_file"),
+            max_bytes_per_file=item.get("max_bytes_per_file"),
+            split_key=item.get("split_key"),
+            export_mode=ExportMode(item.get("export_mode", ExportMode.PARTITION.value)),
+            local_table=item.get("local_table")
+        )
+    
+    
+@dataclass
+class TableMetadata:
+    """
+    Метаданные таблицы из system.tables и активных кусков system.parts.
+    partitions - список {partition, count, bytes, modification_time} по партициям
+    """
+    engine: str
+    partition_key: str
+    primary_key: str = ""
+    sampling_key: str = ""
+    total_rows: Optional[int] = None
+    total_bytes: Optional[int] = None
+    partitions: List[Dict] = field(default_factory=list)
+    engine_full: str = ""
+    
+    @property
+    def distributed_table(self) -> Optional[str]:
+        """Локальная таблица Distributed таблицы: Distributed(cluster, database, table[, sharding_key])"""
+        if self.engine != "Distributed":
+            return None
+        match = re.match(r"Distributed\(\s*([^,]+),\s*([^,]+),\s*([^,)]+)", self.engine_full or "")
+        if match is None:
+            return None
+        return match.group(3).strip().strip("'`\"")
+    
+    @property
+    def bytes_per_row(self) -> Optional[float]:
+        if not self.total_rows or not self.total_bytes:
+            return None
+        return self.total_bytes / self.total_rows
+    
+    
+@dataclass
+class TableSchema:
+    """
+    Схема таблицы (поле: тип в порядке position) и схема ее последнего бэкапа:
+    last_hash - отпечаток схемы, last_schema_guid - бэкап, с которым поля схемы записаны в tables_schema
+    """
+    fields: Dict[str, str]
+    last_hash: Optional[str] = None
+    last_schema_guid: Optional[UUID] = None
+    
+    @staticmethod
+    def get_hash(fields: Dict[str, str]) -> str:
+        """md5 от "field_name field_type, ..." - так же считается в миграции backup_schema"""
+        return hashlib.md5(", ".join([f"{key} {value}" for key, value in fields.items()]).encode()).hexdigest()
+    
+    @property
+    def hash(self) -> str:
+        return self.get_hash(self.fields)
+    
+    @property
+    def is_relevant(self) -> bool:
+        return self.last_hash is not None and self.hash == self.last_hash
+    
+    def is_compatible(self, fields: Dict[str, str]) -> bool:
+        """Файл со схемой fields восстанавливается в таблицу: каждое его поле есть в схеме с тем же типом"""
+        return all([self.fields.get(key) == value for key, value in fields.items()])
     
     
 @dataclass
@@ -69,6 +412,7 @@ class S3FunctionParameters:
     format_file: str
     fields: str
     compression: Optional[str] = None
+    settings: Dict = field(default_factory=dict)
     
     def compile_param(self) -> tuple:
         return (
@@ -79,13 +423,109 @@ class S3FunctionParameters:
             self.fields, 
             '' if self.compression is None else self.compression
         )
+    
+    def compile_settings(self) -> str:
+        if not self.settings:
+            return ""
+        return " settings " + ", ".join([f"{key}={value!r}" for key, value in self.settings.items()])
 
 
 class InfoMessages(Enum):
     NOT_RELEVANTE_SCHEMA = "The schema of the {table_name} table is not relevant"
     START_TASK = "Task is started: {table_name} - {key_value}"
+    START_PARTITIONED_TASK = "Task is started: {table_name} - {count} partitions in one query"
     START_BACKUP = "The backup task is running, backup guid: {backup_guid}"
     COMPLETE_BACKUP = "The backup task is completed, backup guid: {backup_guid}"
     ERROR_BACKUP = "Backup task {backup_guid} stopped with an error"
+    STOP_BACKUP = (
+        "{signal} received: backup {backup_guid} is stopping, queued exports are dropped and running ones are killed"
+    )
+    STOPPED_BACKUP = "The backup task {backup_guid} is stopped, the rest can be exported with --resume {backup_guid}"
+    QUEUE_CLUSTER = (
+        "backup --queue is not supported with CLICK_CLUSTER: workers export from CLICK_HOST, not from the shards"
+    )
+    EXPORT_PROGRESS = (
+        "Export {table_name} : {partition_value} - {read_rows} of ~{total_rows} rows read, "
+        "{read_bytes} bytes, {elapsed} seconds"
+    )
+    EXPORT_DEADLINE = "Export {table_name} : {partition_value} exceeded the deadline of {deadline} seconds, killing it"
+    ERROR_EXPORT_PROGRESS = "Error getting the progress of running exports"
+    ERROR_KILL_QUERY = "Error killing the queries {query_ids}"
     TASK_ERROR = "The backup attempt {table_name} : {partition_value} failed with an error"
+    TASK_COMPLETE = "Partition {partition_value} of the {table_name} table exported to {file_name}"
+    RETRY_TASK = "Attempt {attempt} of {table_name} : {partition_value} failed, retry in {delay} seconds"
+    TASK_SCHEDULED = "Partition is scheduled for backup"
+    DELTA_INCOMPLETE = (
+        "The delta export of {table_name} : {partition_value} is incomplete ({written} records written, {expected} "
+        "expected): the new parts were merged with the old ones, {action}"
+    )
+    START_RESUME = "Resuming backup {backup_guid}: {count} partitions to backup"
+    START_PLAN_EXECUTION = "Executing the saved backup plan, backup guid: {backup_guid}"
+    PLAN_ALREADY_EXECUTED = (
+        "The plan of the backup {backup_guid} has already been executed, "
+        "use backup --resume {backup_guid} to export the rest"
+    )
+    BACKUP_QUEUED = "The backup {backup_guid} is queued: {count} jobs"
+    START_WORKER = "The backup worker {worker} is running"
+    JOB_LEASE_LOST = "The lease of the job {job_id} is lost by the worker {worker}, the export is cancelled"
+    STOP_WORKER = (
+        "{signal} received: the worker {worker} stops claiming jobs, running exports are killed "
+        "and their jobs are returned to the queue"
+    )
+    BACKUP_SCHEMA_NOT_FOUND = "The schema of {table_name} in the backup {backup_guid} is not written yet"
+    SHARD_REPLICA = "Shard {shard} is backed up from the replica {host}"
+    REPLICA_UNAVAILABLE = "The replica {host} of shard {shard} is unavailable"
+    NO_SHARD_REPLICA = "There are no available replicas of shard {shard}"
+    MANIFEST_SAVED = "The manifest of the backup {backup_guid} is saved: {count} partitions, {path}"
+    ERROR_MANIFEST = "Error saving the manifest of the backup {backup_guid}"
+    PLAN_OUTDATED = "The schema of the {table_name} table has changed since the plan was made, the table is skipped"
+    CONCURRENCY_CHANGED = (
+        "Concurrency {old} -> {new}: {reason} (throughput {throughput} rows/s, queries {queries}, "
+        "merges {merges}, memory {memory})"
+    )
+    ERROR_LOAD_METRICS = "Error getting load metrics from clickhouse, concurrency is not changed"
+    METRICS_SERVER_STARTED = "Prometheus metrics are available on port {port}"
+    ERROR_QUERY_STATS = "Error getting query statistics from system.query_log"
+    ERROR_METRICS_TEXTFILE = "Error writing prometheus metrics to {path}"
     PSQL_ERROR = "Error writing to the postgresql"
+    JOB_ERROR = "The job of the {table_name} table failed with an error"
+    SPOOL_RECORDS = "{count} records of the {table_name} table are saved to the spool file {path}"
+    SPOOL_REPLAYED = "{count} records are replayed from the spool file {path}"
+    SPOOL_DEAD_LETTER = (
+        "{count} records of the {table_name} table failed to be replayed too many times, they are moved to {path}"
+    )
+    ERROR_TABLES_SCHEMA = "Error getting the schemas of all tables at once, schemas will be requested for each table"
+    ERROR_METADATA = "Error getting tables metadata from system tables, partitions will be discovered by scanning"
+    PARTS_DISCOVERY_FALLBACK = "The partitions of the {table_name} table are discovered by scanning the table"
+    START_RESTORE = "The restore task is running, table: {table_name}, backup guid: {backup_guid}"
+    COMPLETE_RESTORE = "The restore task is completed, table: {table_name}, backup guid: {backup_guid}"
+    NO_BACKUP_FILES = "No backup files found to restore"
+    CONNECTIONS_READY = (
+        "Connections are ready: clickhouse metadata pool {metadata}, export pool {export}, postgresql pool {psql}"
+    )
+    CONNECTIONS_ERROR = "Clickhouse or postgresql is unavailable, the command is stopped"
+    NO_RESTORE_BASE = (
+        "Partition {partition_value} (shard {shard}) of the {table_name} table is not restored: "
+        "there is no complete full export of it at the specified time"
+    )
+    INCOMPATIBLE_SCHEMA = (
+        "The file {file_name} of the {table_name} table is skipped: its schema is incompatible with the backup "
+        "{backup_guid} schema"
+    )
+    START_RESTORE_TASK = "Restore task is started: {table_name} - {key_value}"
+    RESTORE_TASK_COMPLETE = "Partition {partition_value} of the {table_name} table restored from {file_name}"
+    RESTORE_TASK_ERROR = "The restore attempt {table_name} : {partition_value} failed with an error"
+    START_VERIFY = "Verification of {files} backup files is started"
+    VERIFY_FILE_ERROR = "The file {file_name} of the {table_name} table can not be read"
+    VERIFY_COUNT_MISMATCH = (
+        "Partition {partition_value} of the {table_name} table: {actual} records in the files, {expected} expected"
+    )
+    VERIFY_COUNT_GROWN = (
+        "Partition {partition_value} of the {table_name} table: {actual} records in the files, {expected} at discovery, "
+        "the export had no upper block bound and includes the rows inserted after the discovery"
+    )
+    VERIFY_CHECKSUM_MISMATCH = (
+        "Partition {partition_value} of the {table_name} table: the checksum of the files {actual} "
+        "does not match {expected}"
+    )
+    COMPLETE_VERIFY = "Verification is completed: {files} files of {partitions} partitions, {mismatches} mismatches"
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cold-start benchmark of the CLI. Every target is started in a fresh interpreter
+with `python -X importtime`, the import log is parsed from stderr:
+
+    python -m benchmarks.cold_start
+    python -m benchmarks.cold_start --runs 10 --top 15 --max-cli-ms 50 --max-command-ms 400
+
+Targets:
+  manage.py [command] --help  - the CLI itself, what every cron/k8s job pays
+  command <command>           - a command run to the end against the in-process
+                                stand-ins (benchmarks/fake_cli.py): the import
+                                path the command really takes
+  import <module>             - what a command loads lazily when it runs
+Reported per target (median of --runs):
+  wall       - process start to exit
+  imports    - sum of the cumulative import time of top level imports
+  modules    - number of imported modules
+and the slowest imports of the last run. With --max-cli-ms (--max-command-ms)
+the benchmark exits with status 1 when any manage.py (command) target imports
+longer than that.
+
+"""
+import os
+import sys
+import time
+import statistics
+import subprocess
+from typing import Dict, List
+
+import click
+
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+CLI_TARGETS = [
+    ["--help"], ["backup", "--help"], ["restore", "--help"], ["listing", "--help"], ["show-migrations", "--help"]
+]
+COMMAND_TARGETS = [["backup", "--plan"], ["listing"]]
+MODULE_TARGETS = ["migrations", "settings.db", "app.app", "app.listing"]
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """Строки "import time: self [us] | cumulative | imported package", level - глубина вложенности импорта"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append(
+            {
+                'name': name.strip(),
+                'level': (len(name) - len(name.lstrip()) - 1) // 2,
+                'self': int(self_us),
+                'cumulative': int(cumulative_us)
+            }
+        )
+    return imports
+
+
+def run_target(args: List[str]) -> Dict:
+    t_start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], cwd=BASE_PATH, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - t_start
+    if process.returncode != 0:
+        raise click.ClickException(f"{' '.join(args)} failed:\n{process.stderr[-2000:]}")
+    imports = parse_importtime(process.stderr)
+    return {
+        'wall': wall,
+        'imports': sum([item['cumulative'] for item in imports if item['level'] == 0]) / 1e6,
+        'modules': len(imports),
+        'log': imports
+    }
+
+
+def measure(args: List[str], runs: int) -> Dict:
+    results = [run_target(args) for _ in range(runs)]
+    return {
+        'wall': statistics.median([item['wall'] for item in results]),
+        'imports': statistics.median([item['imports'] for item in results]),
+        'modules': results[-1]['modules'],
+        'log': results[-1]['log']
+    }
+
+
+@click.command()
+@click.option('--runs', type=int, default=5, help="Runs of every target, the median is reported")
+@click.option('--top', type=int, default=5, help="Slowest imports shown for every target")
+@click.option('--max-cli-ms', type=float, default=None, help="Fail when a manage.py target imports longer")
+@click.option('--max-command-ms', type=float, default=None, help="Fail when a command target imports longer")
+def main(runs, top, max_cli_ms, max_command_ms):
+    targets = [(f"manage.py {' '.join(args)}", ["manage.py", *args], max_cli_ms) for args in CLI_TARGETS]
+    targets += [
+        (f"command {' '.join(args)}", ["-m", "benchmarks.fake_cli", *args], max_command_ms) for args in COMMAND_TARGETS
+    ]
+    targets += [(f"import {module}", ["-c", f"import {module}"], None) for module in MODULE_TARGETS]
+    regressions = []
+    click.echo(f"{'target':<36} {'wall':>9} {'imports':>9} {'modules':>8}")
+    for title, args, max_ms in targets:
+        result = measure(args, runs)
+        click.echo(
+            f"{title:<36} {result['wall'] * 1000:>7.1f}ms {result['imports'] * 1000:>7.1f}ms {result['modules']:>8}"
+        )
+        for item in sorted(result['log'], key=lambda item: item['self'], reverse=True)[:top]:
+            click.echo(f"    {item['self'] / 1000:>7.1f}ms  {item['name']}")
+        if max_ms is not None and result['imports'] * 1000 > max_ms:
+            regressions.append(f"{title} ({max_ms}ms)")
+    if regressions:
+        raise click.ClickException(f"Import time over the limit: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
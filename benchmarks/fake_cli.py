@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+manage.py with the connection factories replaced by the in-process stand-ins
+from benchmarks.fakes, so that cold_start can time the import path of a real
+command without clickhouse and postgresql:
+
+    python -m benchmarks.fake_cli backup --plan
+    python -m benchmarks.fake_cli listing
+
+The factories are replaced in their source modules before manage.py imports
+the command, so every command loads exactly what it loads in production.
+The clickhouse driver is patched only for the commands that need it.
+
+"""
+import os
+import sys
+import json
+import atexit
+import tempfile
+import importlib
+
+from .fakes import FakeClickhousePool, FakePsqlPool, FakeTable, FakePartition, PARTITION_KEY
+
+# команды, которые читают только postgresql: драйвер clickhouse для них не загружается
+PSQL_COMMANDS = ("listing",)
+
+
+def make_layout(tables: int = 2, partitions: int = 3):
+    return [
+        FakeTable(
+            name=f"bench_table_{table}",
+            partitions=[FakePartition(value=f"p{index:03d}", rows=1000, bytes=100_000) for index in range(partitions)]
+        ) for table in range(tables)
+    ]
+
+
+def write_schema(layout) -> str:
+    """schema.json для таблиц заменителя: команды читают его вместо app/schema.json"""
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump([{'table_name': table.name, 'partition_key': PARTITION_KEY} for table in layout], f)
+    atexit.register(os.remove, path)
+    return path
+
+
+def patch_connections(command: str):
+    from settings.app import AppConfig
+    
+    AppConfig.METRICS_PORT = None
+    AppConfig.METRICS_TEXTFILE = None
+    psql_pool = FakePsqlPool()
+    
+    async def create_psql_pool(**kwargs):
+        return psql_pool
+    
+    importlib.import_module("app.db_connectors.connection").create_psql_pool = create_psql_pool
+    if command in PSQL_COMMANDS:
+        return
+    layout = make_layout()
+    AppConfig.PATH_TO_TABLE = write_schema(layout)
+    click_pool = FakeClickhousePool(layout)
+    
+    async def create_pool(maxsize: int = 2, **kwargs):
+        return click_pool.make_pool(maxsize)
+    
+    importlib.import_module("asynch").create_pool = create_pool
+
+
+def main():
+    patch_connections(sys.argv[1] if len(sys.argv) > 1 else "")
+    from manage import cli
+    
+    cli(prog_name="manage.py")
+
+
+if __name__ == '__main__':
+    main()
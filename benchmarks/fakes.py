@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for the clickhouse (asynch) and postgresql (asyncpg)
+pools used by the orchestration benchmark. They answer the queries issued by
+ClickhouseTable, ClickhouseCatalog and PsQLTable from a synthetic table
+layout, with configurable latency and error injection. S3 is never touched:
+an export is an `insert into function s3` query that only sleeps.
+
+"""
+import re
+import random
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from app.db_connectors.postgresql_connector import GET_LAST_BACKUP_SCHEMAS_QUERY, GET_LAST_BACKUP_STATE_QUERY
+from app.db_connectors.postgresql_connector import SAVE_MANIFEST_QUERY
+
+
+PARTITION_KEY = "part_key"
+SCHEMA = [{'name': PARTITION_KEY, 'type': 'String'}, {'name': 'value', 'type': 'UInt64'}]
+
+
+@dataclass
+class FakePartition:
+    """Партиция из кусков parts: {name, min_block, max_block, mutation, count, bytes}, по умолчанию один кусок"""
+    value: str
+    rows: int
+    bytes: int
+    modification_time: int = 1_700_000_000
+    parts: List[Dict] = None
+
+    def __post_init__(self):
+        if self.parts is None:
+            self.parts = [
+                {
+                    'name': f"{self.value}_1_1_0", 'min_block': 1, 'max_block': 1, 'mutation': 0,
+                    'count': self.rows, 'bytes': self.bytes
+                }
+            ]
+
+    def append(self, rows: int, bytes: int):
+        """Вставка: новый кусок со следующим номером блока"""
+        block = max([part['max_block'] for part in self.parts], default=0) + 1
+        self.parts.append(
+            {
+                'name': f"{self.value}_{block}_{block}_0", 'min_block': block, 'max_block': block,
+                'mutation': 0, 'count': rows, 'bytes': bytes
+            }
+        )
+        self.rows += rows
+        self.bytes += bytes
+        self.modification_time += 1
+
+    def get_rows(self, base_block: int = None, max_block: int = None) -> int:
+        return sum(
+            [
+                part['count'] for part in self.parts
+                if (base_block is None or part['min_block'] > base_block)
+                and (max_block is None or part['min_block'] <= max_block)
+            ]
+        )
+
+
+@dataclass
+class FakeTable:
+    name: str
+    partitions: List[FakePartition] = field(default_factory=list)
+    engine: str = "MergeTree"
+
+    def __post_init__(self):
+        self.by_value = {part.value: part for part in self.partitions}
+
+    @property
+    def total_rows(self) -> int:
+        return sum([part.rows for part in self.partitions])
+
+    @property
+    def total_bytes(self) -> int:
+        return sum([part.bytes for part in self.partitions])
+
+
+@dataclass
+class Latency:
+    """Задержка запроса: base секунд плюс rows / rows_per_second, со случайным разбросом jitter"""
+    base: float = 0
+    rows_per_second: float = 0
+    jitter: float = 0
+
+    def get(self, rows: int = 0) -> float:
+        delay = self.base + (rows / self.rows_per_second if self.rows_per_second else 0)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(delay, 0)
+
+
+@dataclass
+class FakeProgress:
+    written_rows: int = 0
+
+
+@dataclass
+class FakeQueryInfo:
+    """Как asynch.proto.result.QueryInfo: прогресс последнего запроса соединения"""
+    progress: FakeProgress = field(default_factory=FakeProgress)
+
+
+class FakeClickhouseCursor:
+
+    def __init__(self, server: "FakeClickhousePool", connection: "FakeClickhouseConnection"):
+        self.server = server
+        self.connection = connection
+        self.query_id = ""
+        self._result: List[Dict] = []
+
+    def set_query_id(self, query_id: str = ""):
+        self.query_id = query_id
+
+    async def execute(self, query: str, args=None, context=None):
+        self.connection.last_query = FakeQueryInfo()
+        self._result = await self.server.run_query(query, self.query_id, self.connection.last_query.progress)
+
+    async def fetchall(self) -> List[Dict]:
+        return self._result
+
+    async def fetchone(self) -> Optional[Dict]:
+        return self._result[0] if self._result else None
+
+
+class FakeClickhouseConnection:
+
+    def __init__(self, server: "FakeClickhousePool"):
+        self.server = server
+        # asynch.connection.Connection хранит протокольное соединение в _connection
+        self._connection = self
+        self.last_query: Optional[FakeQueryInfo] = None
+
+    @asynccontextmanager
+    async def cursor(self, cursor=None):
+        yield FakeClickhouseCursor(self.server, self)
+
+
+class FakeClickhousePool:
+    """
+    Заменитель asynch.pool.Pool: maxsize соединений, запросы к системным таблицам
+    и выгрузки в s3 отвечаются по синтетической раскладке tables
+    """
+
+    def __init__(
+            self,
+            tables: List[FakeTable],
+            maxsize: int = 2,
+            query_latency: Latency = None,
+            export_latency: Latency = None,
+            error_rate: float = 0,
+            error_code: int = 159
+        ):
+        self.tables = {table.name: table for table in tables}
+        self.maxsize = maxsize
+        self.query_latency = query_latency or Latency()
+        self.export_latency = export_latency or Latency()
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self._connections = asyncio.Semaphore(maxsize)
+        self.exports = 0
+        self.failed_exports = 0
+        self.exported_rows = 0
+        self.export_seconds = 0.0
+        self.killed_exports = 0
+        self.files: List[str] = []
+        # выполняемые выгрузки: query_id: {start, rows, killed}
+        self.running: Dict[str, Dict] = {}
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._connections:
+            yield FakeClickhouseConnection(self)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def make_pool(self, maxsize: int) -> "FakeClickhousePoolView":
+        return FakeClickhousePoolView(self, maxsize)
+
+    def _find_table(self, query: str) -> FakeTable:
+        match = re.search(r"\bfrom\s+(\w+)", query)
+        return self.tables[match.group(1)]
+
+    def _filter_partitions(self, table: FakeTable, query: str) -> List[FakePartition]:
+        values = re.findall(rf"{PARTITION_KEY} (?:=|in) \(?([^)]*?)\)?(?: and|$| settings)", query)
+        if not values:
+            return table.partitions
+        selected = [value.strip().strip("'") for value in values[0].split(",")]
+        return [table.by_value[value] for value in selected if value in table.by_value]
+
+    async def run_query(self, query: str, query_id: str = "", progress: FakeProgress = None) -> List[Dict]:
+        query = " ".join(query.split())
+        if query.startswith("insert into function s3"):
+            return await self._export(query, query_id, progress or FakeProgress())
+        await asyncio.sleep(self.query_latency.get())
+        if query.startswith("describe table"):
+            return list(SCHEMA)
+        if "from system.columns" in query:
+            return [{'table': name, **field} for name in self.tables for field in SCHEMA if f"'{name}'" in query]
+        if "from system.tables" in query:
+            return [
+                {
+                    'name': table.name, 'engine': table.engine, 'engine_full': table.engine,
+                    'partition_key': PARTITION_KEY,
+                    'primary_key': 'value', 'sampling_key': '', 'total_rows': table.total_rows,
+                    'total_bytes': table.total_bytes
+                } for table in self.tables.values()
+            ]
+        if "from system.parts" in query and "min_block_number" in query:
+            table = self.tables[re.search(r"table = '(\w+)'", query).group(1)]
+            return [{'partition': part.value, **block} for part in table.partitions for block in part.parts]
+        if "from system.parts" in query:
+            return [
+                {
+                    'table': table.name, 'partition': part.value, 'count': part.rows, 'bytes': part.bytes,
+                    'modification_time': part.modification_time
+                } for table in self.tables.values() for part in table.partitions
+            ]
+        if "from system.metrics" in query:
+            return [{'metric': 'Query', 'value': 1}, {'metric': 'Merge', 'value': 0}]
+        if "from system.query_log" in query:
+            return [
+                {
+                    'query_id': query_id, 'read_rows': 0, 'read_bytes': 0, 'written_rows': 0,
+                    'written_bytes': 0, 'memory_usage': 0, 'duration_ms': 0
+                } for query_id in re.findall(r"'([0-9a-f-]{36})'", query)
+            ]
+        if "from system.processes" in query:
+            now = time.monotonic()
+            return [
+                {
+                    'query_id': query_id, 'read_rows': 0, 'read_bytes': 0, 'written_rows': 0, 'written_bytes': 0,
+                    'total_rows_approx': self.running[query_id]['rows'],
+                    'elapsed': now - self.running[query_id]['start']
+                } for query_id in re.findall(r"'([^']+)'", query) if query_id in self.running
+            ]
+        if query.startswith("kill query"):
+            for query_id in re.findall(r"'([^']+)'", query):
+                if query_id in self.running:
+                    self.running[query_id]['killed'].set()
+            return []
+        if query.startswith("system "):
+            return []
+        if query == "select 1":
+            return [{'1': 1}]
+        table = self._find_table(query)
+        if "group by" in query:
+            return [
+                {PARTITION_KEY: part.value, 'count': part.rows, 'checksum': str(part.rows)}
+                for part in table.partitions
+            ]
+        parts = self._filter_partitions(table, query)
+        rows = sum([part.rows for part in parts])
+        return [{'count': rows, 'checksum': str(rows)}]
+
+    async def _export(self, query: str, query_id: str, progress: FakeProgress) -> List[Dict]:
+        # драйвер clickhouse загружается только выгрузкой: заменитель postgresql нужен и без него (cold_start)
+        from asynch.errors import ServerException
+
+        if "'RawBLOB'" in query:
+            self.files.append(query)
+            return []
+        table = self._find_table(query)
+        base_block = re.search(r"\) > (\d+)", query)
+        max_block = re.search(r"\) <= (\d+)", query)
+        rows = sum(
+            [
+                part.get_rows(
+                    None if base_block is None else int(base_block.group(1)),
+                    None if max_block is None else int(max_block.group(1))
+                ) for part in self._filter_partitions(table, query)
+            ]
+        )
+        chunks = re.search(r"% (\d+) = \d+", query)
+        if chunks:
+            rows //= int(chunks.group(1))
+        delay = self.export_latency.get(rows)
+        killed = asyncio.Event()
+        query_id = query_id or str(id(killed))
+        self.running[query_id] = {'start': time.monotonic(), 'rows': rows, 'killed': killed}
+        try:
+            await asyncio.wait_for(killed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            del self.running[query_id]
+        if killed.is_set():
+            self.killed_exports += 1
+            raise ServerException("Query was cancelled", code=394)
+        self.export_seconds += delay
+        if self.error_rate and random.random() < self.error_rate:
+            self.failed_exports += 1
+            raise ServerException("Simulated export error", code=self.error_code)
+        self.exports += 1
+        self.exported_rows += rows
+        progress.written_rows = rows
+        return []
+
+
+class FakeClickhousePoolView:
+    """Еще один пул к тому же серверу (например, пул выгрузок) со своим числом соединений"""
+
+    def __init__(self, server: FakeClickhousePool, maxsize: int):
+        self.server = server
+        self.maxsize = maxsize
+        self._connections = asyncio.Semaphore(maxsize)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._connections:
+            yield FakeClickhouseConnection(self.server)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakePsqlPool:
+    """
+    Заменитель asyncpg.pool.Pool: COPY складывает записи в память,
+    состояние последнего бэкапа ведется так же, как триггер update_latest_backup
+    """
+
+    def __init__(self, latency: Latency = None, error_rate: float = 0):
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.records: Dict[str, List[Dict]] = {}
+        self.latest_backup: Dict[str, str] = {}
+        self.latest_partition_backup: Dict[tuple, Dict] = {}
+
+    async def close(self):
+        pass
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    async def execute(self, query: str, *args):
+        await asyncio.sleep(self.latency.get())
+
+    async def fetchval(self, query: str, *args):
+        await asyncio.sleep(self.latency.get())
+        return 1 if query == "select 1" else None
+
+    async def fetchrow(self, query: str, *args) -> Optional[Dict]:
+        await asyncio.sleep(self.latency.get())
+        return None
+
+    async def fetch(self, query: str, *args) -> List[Dict]:
+        await asyncio.sleep(self.latency.get())
+        if query == GET_LAST_BACKUP_SCHEMAS_QUERY:
+            return [
+                {'table_name': item['table_name'], 'last_hash': item['schema_hash'], 'last_schema_guid': item['schema_guid']}
+                for item in self.records.get("backup_schema", [])
+                if item['table_name'] in args[0] and self.latest_backup.get(item['table_name']) == item['backup_guid']
+            ]
+        if query == GET_LAST_BACKUP_STATE_QUERY:
+            return [
+                {
+                    key: item[key]
+                    for key in ('partition_key', 'count', 'checksum', 'modification_time', 'max_block', 'mutation')
+                } for (table_name, shard, _), item in self.latest_partition_backup.items()
+                if table_name == args[0] and shard == args[1]
+            ]
+        if query == SAVE_MANIFEST_QUERY:
+            return [
+                {key: row[key] for key in ('partition_key', 'backup_guid', 'file_name', 'count', 'chunk', 'base_block')}
+                for (table_name, shard, partition_key), item in self.latest_partition_backup.items()
+                if table_name == args[1] and shard == args[2] and (args[3] is None or partition_key in args[3])
+                for row in self.records.get("backup_history", [])
+                if row['backup_guid'] in item['chain'] and row['table_name'] == table_name
+                and row['shard'] == shard and row['partition_key'] == partition_key
+            ]
+        return []
+
+    async def copy_records_to_table(self, table_name: str, records: List[tuple], columns, schema_name: str = None):
+        await asyncio.sleep(self.latency.get(len(records)))
+        if self.error_rate and random.random() < self.error_rate:
+            raise ConnectionError("Simulated postgresql error")
+        rows = [dict(zip(columns, record)) for record in records]
+        self.records.setdefault(table_name, []).extend(rows)
+        if table_name == "backup_history":
+            for row in rows:
+                self._update_latest(row)
+
+    def _update_latest(self, row: Dict):
+        self.latest_backup[row['table_name']] = row['backup_guid']
+        key = (row['table_name'], row['shard'], row['partition_key'])
+        latest = self.latest_partition_backup.get(key)
+        delta = row['base_block'] is not None
+        if latest is not None and (latest['backup_guid'] == row['backup_guid'] or delta):
+            if latest['backup_guid'] != row['backup_guid']:
+                latest['chain'] = latest['chain'] + [row['backup_guid']]
+            latest['count'] += row['count']
+            latest['max_block'] = None if latest['max_block'] is None else row['max_block']
+            latest.update(backup_guid=row['backup_guid'], mutation=row['mutation'])
+        else:
+            self.latest_partition_backup[key] = {**row, 'chain': [row['backup_guid']]}
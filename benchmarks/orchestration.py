@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the backup orchestration (Backup/Table/Scheduler/PsQLWriter)
+against in-process fake clickhouse and postgresql pools (benchmarks/fakes.py).
+No network, clickhouse, postgresql or s3 is needed:
+
+    python -m benchmarks.orchestration --tables 10 --partitions 10000 --workers 8
+    python -m benchmarks.orchestration --partitions 1000 --export-latency 0.01 --error-rate 0.05
+
+Each run does a full backup and then an incremental one. Without --appended
+there are no data changes and nothing should be exported; with --appended a
+share of partitions gets a new part of 1% of its rows before the incremental run
+(compare --change-detection count, which re-exports those partitions, with
+parts, which exports only the new parts). Reported per run:
+  rows       - exported rows
+  wall       - end-to-end time of Backup._execute
+  ideal      - simulated export time divided by the number of workers
+  overhead   - (wall - ideal) per exported partition file
+  peak mem   - tracemalloc peak (with --trace-memory) and process max RSS
+and the total time spent waiting for a connection of every pool (metadata,
+export and postgresql) over both runs.
+
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import resource
+import tempfile
+import tracemalloc
+
+import click
+
+from app.app import Backup
+from app.metrics import POOL_WAIT
+from app.db_connectors.psql_writer import PsQLWriter
+from app.scheduler import Scheduler
+from settings.app import AppConfig
+from settings.db import DbConfig
+from settings.log import app_log, setup_logging
+from .fakes import FakeClickhousePool, FakePsqlPool, FakeTable, FakePartition, Latency, PARTITION_KEY
+
+
+def make_layout(tables: int, partitions: int, rows: int, skew: float, bytes_per_row: int):
+    """
+    tables таблиц по partitions партиций, в партиции rows записей;
+    при skew > 0 размер партиций убывает по закону Ципфа (rows / (i + 1) ** skew)
+    """
+    layout = []
+    for number in range(tables):
+        parts = []
+        for index in range(partitions):
+            part_rows = max(int(rows / (index + 1) ** skew), 1)
+            parts.append(FakePartition(value=f"p{index:06d}", rows=part_rows, bytes=part_rows * bytes_per_row))
+        random.shuffle(parts)
+        layout.append(FakeTable(name=f"bench_table_{number}", partitions=parts))
+    return layout
+
+
+class BenchBackup(Backup):
+
+    def __init__(
+            self,
+            layout,
+            click_pool: FakeClickhousePool,
+            psql_pool: FakePsqlPool,
+            workers: int,
+            export_mode: str,
+            max_rows_per_file: int,
+            spool_path: str,
+            change_detection: str = "count",
+            export_pool_size: int = None
+        ):
+        super().__init__()
+        self.tables_for_backup = [
+            {
+                'table_name': table.name,
+                'partition_key': PARTITION_KEY,
+                'export_mode': export_mode,
+                'max_rows_per_file': max_rows_per_file,
+                'change_detection': change_detection
+            } for table in layout
+        ]
+        self.scheduler = Scheduler(workers=workers)
+        self.fake_click_pool = click_pool
+        self.fake_export_pool = click_pool.make_pool(export_pool_size or workers)
+        self.fake_psql_pool = psql_pool
+        self.spool_path = spool_path
+
+    async def _init(self):
+        self.psql_pool = self.fake_psql_pool
+        self.click_connect = self.fake_click_pool
+        self.export_connect = self.fake_export_pool
+        self.psql_writer = PsQLWriter(
+            psql_pool=self.psql_pool,
+            batch_size=DbConfig.WRITER_BATCH_SIZE,
+            flush_interval=DbConfig.WRITER_FLUSH_INTERVAL,
+            spool_path=self.spool_path
+        )
+        await self.psql_writer.start()
+        self.tracker.start()
+
+
+async def run_backup(app: BenchBackup, force: bool) -> float:
+    await app._init()
+    t_start = time.perf_counter()
+    await app._execute(force=force)
+    wall = time.perf_counter() - t_start
+    await app._close()
+    return wall
+
+
+def append_rows(layout, share: float):
+    """Новый кусок в 1% записей в share партиций каждой таблицы"""
+    for table in layout:
+        for part in random.sample(table.partitions, int(len(table.partitions) * share)):
+            rows = max(part.rows // 100, 1)
+            part.append(rows, rows * part.bytes // max(part.rows, 1))
+
+
+async def run_all(layout, click_pool: FakeClickhousePool, psql_pool: FakePsqlPool, workers: int, export_mode: str,
+                  max_rows_per_file: int, spool_path: str, trace_memory: bool, change_detection: str = "count",
+                  appended: float = 0, export_pool_size: int = None):
+    for name, force in (("full", True), ("incremental", False)):
+        if not force and appended:
+            append_rows(layout, appended)
+        app = BenchBackup(
+            layout, click_pool, psql_pool, workers, export_mode, max_rows_per_file, spool_path, change_detection,
+            export_pool_size
+        )
+        exports_before = click_pool.exports + click_pool.failed_exports
+        rows_before = click_pool.exported_rows
+        export_seconds = click_pool.export_seconds
+        if trace_memory:
+            tracemalloc.reset_peak()
+        wall = await run_backup(app, force)
+        report(
+            name, wall, click_pool, exports_before, click_pool.exported_rows - rows_before,
+            click_pool.export_seconds - export_seconds, workers, trace_memory
+        )
+
+
+def report(name: str, wall: float, click_pool: FakeClickhousePool, exports_before: int, rows: int,
+           export_seconds: float, workers: int, trace_memory: bool):
+    exports = click_pool.exports + click_pool.failed_exports - exports_before
+    ideal = export_seconds / workers
+    overhead = (wall - ideal) / exports * 1_000_000 if exports else 0
+    peak = f"{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f} MiB" if trace_memory else "-"
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    click.echo(
+        f"{name:<12} {exports:>9} {rows:>14} {wall:>10.2f} {ideal:>10.2f} {overhead:>14.1f} {peak:>12} {max_rss:>10.1f} MiB"
+    )
+
+
+@click.command()
+@click.option('--tables', type=int, default=10, help="Number of tables")
+@click.option('--partitions', type=int, default=1000, help="Partitions per table")
+@click.option('--rows', type=int, default=1_000_000, help="Rows of the largest partition")
+@click.option('--skew', type=float, default=0.0, help="Zipf exponent of partition sizes, 0 - equal partitions")
+@click.option('--bytes-per-row', type=int, default=100)
+@click.option('--workers', type=int, default=8, help="Scheduler workers (COUNT_THREADS)")
+@click.option('--pool-size', type=int, default=2, help="Fake clickhouse metadata pool size (POOL_MAXSIZE)")
+@click.option('--export-pool-size', type=int, default=None, help="Fake export pool size, --workers by default")
+@click.option('--query-latency', type=float, default=0.001, help="Latency of metadata queries, seconds")
+@click.option('--export-latency', type=float, default=0.0, help="Base latency of an export query, seconds")
+@click.option('--export-rows-per-second', type=float, default=0, help="Export speed, 0 - only base latency")
+@click.option('--psql-latency', type=float, default=0.001, help="Latency of postgresql calls, seconds")
+@click.option('--error-rate', type=float, default=0.0, help="Share of failed export queries")
+@click.option('--psql-error-rate', type=float, default=0.0, help="Share of failed postgresql COPY calls")
+@click.option('--error-code', type=int, default=159, help="Clickhouse error code of failed exports")
+@click.option('--export-deadline', type=float, default=0, help="EXPORT_DEADLINE, exports running longer are killed")
+@click.option('--export-mode', type=click.Choice(["partition", "partition_by"]), default="partition")
+@click.option('--max-rows-per-file', type=int, default=0, help="Split partitions into files of this many rows")
+@click.option('--change-detection', type=click.Choice(["count", "parts"]), default="count")
+@click.option('--appended', type=float, default=0.0, help="Share of partitions appended to before the incremental run")
+@click.option('--trace-memory', is_flag=True, help="Measure python heap peak with tracemalloc (slower)")
+@click.option('--log-level', default="WARNING", help="Level of the application log during the benchmark")
+@click.option('--seed', type=int, default=0)
+def main(tables, partitions, rows, skew, bytes_per_row, workers, pool_size, export_pool_size, query_latency,
+         export_latency, export_rows_per_second, psql_latency, error_rate, psql_error_rate, error_code, export_deadline,
+         export_mode, max_rows_per_file, change_detection, appended, trace_memory, log_level, seed):
+    random.seed(seed)
+    setup_logging()
+    app_log.setLevel(logging.getLevelName(log_level))
+    AppConfig.RETRY_BACKOFF = min(AppConfig.RETRY_BACKOFF, export_latency or 0.01)
+    AppConfig.METRICS_PORT = None
+    AppConfig.METRICS_TEXTFILE = None
+    AppConfig.EXPORT_DEADLINE = export_deadline
+    layout = make_layout(tables, partitions, rows, skew, bytes_per_row)
+    click_pool = FakeClickhousePool(
+        layout,
+        maxsize=pool_size,
+        query_latency=Latency(base=query_latency),
+        export_latency=Latency(base=export_latency, rows_per_second=export_rows_per_second, jitter=0.2),
+        error_rate=error_rate,
+        error_code=error_code
+    )
+    psql_pool = FakePsqlPool(latency=Latency(base=psql_latency), error_rate=psql_error_rate)
+    if trace_memory:
+        tracemalloc.start()
+    click.echo(
+        f"{tables} tables x {partitions} partitions, {workers} workers, export mode {export_mode}, "
+        f"change detection {change_detection}"
+    )
+    click.echo(
+        f"{'run':<12} {'exports':>9} {'rows':>14} {'wall, s':>10} {'ideal, s':>10} {'overhead, us':>14} "
+        f"{'peak heap':>12} {'max rss':>14}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(
+            run_all(
+                layout, click_pool, psql_pool, workers, export_mode, max_rows_per_file,
+                os.path.join(tmp_dir, "spool.jsonl"), trace_memory, change_detection, appended, export_pool_size
+            )
+        )
+    history = len(psql_pool.records.get("backup_history", []))
+    errors = len([item for item in psql_pool.records.get("backup_log", []) if item['level'] == "error"])
+    click.echo(
+        f"backup_history rows: {history}, failed exports: {click_pool.failed_exports}, "
+        f"killed exports: {click_pool.killed_exports}, error rows: {errors}"
+    )
+    waits = {key[0]: value for key, value in POOL_WAIT.values.items()}
+    click.echo(
+        "pool wait: " + ", ".join([f"{pool} {waits.get(pool, 0):.2f}s" for pool in ("metadata", "export", "postgresql")])
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the postgresql query path: SQL with inlined values
+versus fixed parameterized statements (asyncpg statement cache) and
+explicitly prepared statements, for lookups and history inserts.
+
+Runs against a local postgresql (DB_URL), data lives in temporary tables:
+
+    python -m benchmarks.psql_statements --iterations 2000
+
+"""
+import asyncio
+import statistics
+import time
+import uuid
+from typing import Awaitable, Callable, List
+
+import asyncpg
+import click
+
+from settings.db import DbConfig
+
+
+SETUP_SQL = """
+create temporary table bench_history
+(
+	id				serial			primary key,
+	backup_guid		uuid			not null,
+	table_name		varchar(60)		not null,
+	partition_key	varchar(36)		not null,
+	count			int				not null,
+	file_name		varchar(255)	not null,
+	execution_time	int				not null
+);
+insert into bench_history (backup_guid, table_name, partition_key, count, file_name, execution_time)
+select gen_random_uuid(), 'table_' || (i % 300), (i % 1000)::text, i, 'file_' || i, 1
+from generate_series(1, 100000) as i;
+create index on bench_history (table_name, partition_key);
+analyze bench_history;
+"""
+
+LOOKUP_QUERY = "select partition_key, count from bench_history where table_name = $1 and partition_key = $2"
+INSERT_QUERY = """insert into bench_history (backup_guid, table_name, partition_key, count, file_name, execution_time)
+                  values ($1, $2, $3, $4, $5, $6)"""
+
+
+def inline_lookup_query(table_name: str, partition_key: str) -> str:
+    return f"""select partition_key, count from bench_history
+               where table_name = '{table_name}' and partition_key = '{partition_key}'"""
+
+
+def inline_insert_query(values: tuple) -> str:
+    return f"""insert into bench_history (backup_guid, table_name, partition_key, count, file_name, execution_time)
+               values ('{values[0]}', '{values[1]}', '{values[2]}', {values[3]}, '{values[4]}', {values[5]})"""
+
+
+def make_values(number: int) -> tuple:
+    return (uuid.uuid4(), f"table_{number % 300}", str(number % 1000), number, f"file_{number}", 1)
+
+
+async def measure(name: str, iterations: int, call: Callable[[int], Awaitable]) -> List[float]:
+    timings = []
+    for number in range(iterations):
+        t_start = time.perf_counter()
+        await call(number)
+        timings.append((time.perf_counter() - t_start) * 1_000_000)
+    timings.sort()
+    click.echo(
+        f"{name:<32} {statistics.mean(timings):>10.1f} {timings[len(timings) // 2]:>10.1f} "
+        f"{timings[int(len(timings) * 0.95)]:>10.1f}"
+    )
+    return timings
+
+
+async def run(iterations: int):
+    conn = await asyncpg.connect(
+        DbConfig.CONNECTION_SETTINGS['dsn'],
+        statement_cache_size=DbConfig.CONNECTION_SETTINGS['statement_cache_size']
+    )
+    try:
+        await conn.execute(SETUP_SQL)
+        click.echo(f"{'per call, us':<32} {'mean':>10} {'p50':>10} {'p95':>10}")
+
+        await measure(
+            "lookup: inlined values", iterations,
+            lambda n: conn.fetch(inline_lookup_query(f"table_{n % 300}", str(n % 1000)))
+        )
+        await measure(
+            "lookup: parameterized", iterations,
+            lambda n: conn.fetch(LOOKUP_QUERY, f"table_{n % 300}", str(n % 1000))
+        )
+        lookup = await conn.prepare(LOOKUP_QUERY)
+        await measure(
+            "lookup: prepared", iterations,
+            lambda n: lookup.fetch(f"table_{n % 300}", str(n % 1000))
+        )
+
+        await measure(
+            "insert: inlined values", iterations,
+            lambda n: conn.execute(inline_insert_query(make_values(n)))
+        )
+        await measure(
+            "insert: parameterized", iterations,
+            lambda n: conn.execute(INSERT_QUERY, *make_values(n))
+        )
+        batch_size = DbConfig.WRITER_BATCH_SIZE
+        columns = ("backup_guid", "table_name", "partition_key", "count", "file_name", "execution_time")
+        timings = await measure(
+            f"insert: copy of {batch_size} rows", max(iterations // batch_size, 1),
+            lambda n: conn.copy_records_to_table(
+                "bench_history", records=[make_values(n * batch_size + i) for i in range(batch_size)], columns=columns
+            )
+        )
+        click.echo(f"{'insert: copy, per row':<32} {statistics.mean(timings) / batch_size:>10.1f}")
+    finally:
+        await conn.close()
+
+
+@click.command()
+@click.option('--iterations', type=int, default=2000, help="Number of calls of each kind")
+def main(iterations: int):
+    asyncio.run(run(iterations))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,24 @@
+import json
 import click
-import asyncio
+from datetime import datetime
 from uuid import UUID
 
-import migrations
-from app.app import Backup, Restore, Listing
-from settings.db import DbConfig
+
+# драйверы, yoyo и настройки импортируются в самих командах: каждая команда загружает только то,
+# что ей нужно, а --help не загружает ничего (время запуска - benchmarks/cold_start.py)
+def get_migrator():
+    import migrations
+    from settings.db import DbConfig
+    from settings.log import setup_logging
+    
+    setup_logging()
+    return migrations.Migrator(dsn=DbConfig.CONNECTION_SETTINGS['dsn'], migration_path=DbConfig.PATH_TO_MIGRATIONS)
+
+
+def run_app(app, **kwargs):
+    import asyncio
+    
+    return asyncio.run(app.run(**kwargs))
 
 
 @click.group()
@@ -15,23 +29,23 @@ def cli():
 @cli.command(help='apply migrations')
 @click.option('--stop_on', type=str)
 def migrate(stop_on):
-    migrator = migrations.Migrator(dsn=DbConfig.CONNECTION_SETTINGS['dsn'], migration_path=DbConfig.PATH_TO_MIGRATIONS)
-    migrator.apply(stop_on)
+    get_migrator().apply(stop_on)
 
 
 @cli.command(short_help='rollback migrations')
 @click.option('--stop_on', type=str)
 def rollback(stop_on):
     """Rollback to specified version."""
-    migrator = migrations.Migrator(dsn=DbConfig.CONNECTION_SETTINGS['dsn'], migration_path=DbConfig.PATH_TO_MIGRATIONS)
-    migrator.rollback(stop_on)
+    get_migrator().rollback(stop_on)
 
 
 @cli.command(short_help='show not applied migrations')
 def show_migrations():
     """Print to console not applied migrations."""
-    migrator = migrations.Migrator(dsn=DbConfig.CONNECTION_SETTINGS['dsn'], migration_path=DbConfig.PATH_TO_MIGRATIONS)
-    migrations_to_apply = migrator.get_migration_list(action=migrations.MigrationActions.apply)
+    from migrations import MigrationActions
+    
+    migrator = get_migrator()
+    migrations_to_apply = migrator.get_migration_list(action=MigrationActions.apply)
     click.echo('Migrations to apply:')
     if migrations_to_apply:
         click.echo('\n'.join([f'\t{migration.path}' for migration in migrations_to_apply]))
@@ -42,25 +56,112 @@ def show_migrations():
 @cli.command(short_help='Create a new backup')
 @click.option('--table', type=str, help="Create a new backup of the specified table")
 @click.option("--force", type=bool, help="Create a new backup without checking for the existence of a similar record")
-def backup(table: str = None, force: bool = None):
+@click.option("--resume", type=UUID, help="Backup only the partitions of the specified backup that were not completed")
+@click.option("--plan", is_flag=True, help="Do not backup, show what would be exported and estimates")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="Save the plan to a JSON file")
+@click.option("--from-plan", type=click.File("r"), help="Execute a plan saved with --plan --output")
+@click.option("--queue", is_flag=True, help="Only put the partitions into the backup_jobs queue for workers")
+def backup(
+    table: str = None, 
+    force: bool = None, 
+    resume: UUID = None, 
+    plan: bool = False, 
+    output: str = None, 
+    from_plan=None, 
+    queue: bool = False
+):
+    from app.app import Backup, BackupPlan
+    from app.types import InfoMessages
+    from settings.clickhouse import ClHouseConfig
+    
+    if queue and ClHouseConfig.CLUSTER:
+        raise click.UsageError(InfoMessages.QUEUE_CLUSTER.value)
+    if plan:
+        result = run_app(BackupPlan(), table=table, force=force)
+        if output:
+            with open(output, "w") as f:
+                json.dump(result, f, indent=2, default=str)
+        echo_plan(result)
+        return
     app = Backup()
-    asyncio.run(app.run(table=table, force=force))
+    saved_plan = None if from_plan is None else json.load(from_plan)
+    try:
+        run_app(app, table=table, force=force, resume=resume, plan=saved_plan, queue=queue)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    if app.stopped:
+        raise SystemExit(128 + app.stopped)
+
+
+@cli.command(short_help='Run exports from the backup_jobs queue')
+@click.option('--workers', type=int, help="Number of parallel exports, COUNT_THREADS by default")
+@click.option("--backup_guid", type=UUID, help="Run only the jobs of the specified backup")
+@click.option("--exit-when-empty", is_flag=True, help="Stop when there are no jobs instead of waiting for new ones")
+def worker(workers: int = None, backup_guid: UUID = None, exit_when_empty: bool = False):
+    from app.app import Worker
+    
+    app = Worker()
+    run_app(app, workers=workers, backup_guid=backup_guid, exit_when_empty=exit_when_empty)
+
+
+def echo_plan(plan: dict):
+    def estimate(seconds):
+        return "-" if not seconds else f"{seconds:.0f}s"
+    
+    click.echo(f"Backup plan {plan['backup_guid']}")
+    for table in plan['tables']:
+        click.echo(
+            f"{table['table_name']}: {len(table['partitions'])} partitions, {table['count']} rows, "
+            f"{table['bytes']} bytes, ~{estimate(table['estimated_seconds'])}"
+        )
+        for part in table['partitions']:
+            click.echo(
+                f"    {part['partition']}: {part['count']} rows, {part['bytes'] or '-'} bytes, "
+                f"{part['chunks']} files, ~{estimate(part['estimated_seconds'])}"
+            )
+    click.echo(
+        f"Total: {plan['count']} rows, {plan['bytes']} bytes, "
+        f"~{estimate(plan['estimated_wall_seconds'])} with the current concurrency"
+    )
     
     
 @cli.command(short_help='Restore a backup')
 @click.option('--table', type=str, help="Restore a backup to the specified table")
 @click.option("--backup_guid", type=UUID, help="Restore a backup to the specified backup_guid")
-def restore(table: str = None, backup_guid: UUID = None):
+@click.option(
+    "--at", type=click.DateTime(),
+    help="Restore the tables as of the specified time (UTC): the latest files of each partition with their increments"
+)
+def restore(table: str = None, backup_guid: UUID = None, at: datetime = None):
+    from app.app import Restore
+    
     app = Restore()
-    asyncio.run(app.run(table=table, backup_guid=backup_guid))
+    run_app(app, table=table, backup_guid=backup_guid, at=at)
+    
+    
+@cli.command(short_help='Verify backup files')
+@click.option('--table', type=str, help="Verify the files of the specified table")
+@click.option("--backup_guid", type=UUID, help="Verify the files of the specified backup")
+@click.option("--days", type=int, default=7, help="Verify the backups made in the last days, if no backup is specified")
+@click.option("--checksum", is_flag=True, help="Compare the checksum of the files too, reads all columns")
+def verify(table: str = None, backup_guid: UUID = None, days: int = 7, checksum: bool = False):
+    from app.app import Verify
+    
+    app = Verify()
+    result = run_app(app, table=table, backup_guid=backup_guid, days=days, with_checksum=checksum)
+    click.echo(f"{result['files']} files of {result['partitions']} partitions, {result['mismatches']} mismatches")
+    if result['mismatches']:
+        raise SystemExit(1)
     
     
 @cli.command(short_help='Return the list of backups')
 @click.option('--table', type=str, help="Return a list of backups for the specified table")
 @click.option("--gt", type=str, help="Return a list of backups made after the specified date")
 def listing(table: str = None, gt: str = None):
+    from app.listing import Listing
+    
     app = Listing()
-    asyncio.run(app.run(table=table, gt=gt))
+    run_app(app, table=table, gt=gt)
     
 
 
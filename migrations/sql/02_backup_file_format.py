@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Format and compression of backup files
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists file_format	varchar(32)		not null default 'CSV',
+        	add column if not exists compression	varchar(16)		not null default 'gzip';
+        ''',
+        '''
+        alter table clickhouse_backup.backup_history
+        	drop column if exists file_format,
+        	drop column if exists compression;
+        '''
+    )
+]
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Order of fields in the saved table schema
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.tables_schema
+        	add column if not exists field_position	int		not null default 0;
+
+        -- поля схемы записывались одной вставкой в порядке describe table, а tables_schema
+        -- только дополняется, поэтому порядок строк (ctid) в схеме бэкапа - порядок полей
+        update clickhouse_backup.tables_schema ts
+        set field_position = p.position
+        from (
+        	select ctid, row_number() over (partition by backup_guid, table_name order by ctid) - 1 as position
+        	from clickhouse_backup.tables_schema
+        ) p
+        where ts.ctid = p.ctid and p.position <> 0;
+        ''',
+        '''
+        alter table clickhouse_backup.tables_schema
+        	drop column if exists field_position;
+        '''
+    )
+]
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content fingerprint of the backed up partition
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists checksum	varchar(20);
+        ''',
+        '''
+        alter table clickhouse_backup.backup_history
+        	drop column if exists checksum;
+        '''
+    )
+]
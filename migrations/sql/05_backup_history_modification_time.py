@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Last modification time of the partition parts at the moment of backup
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists modification_time	bigint;
+        ''',
+        '''
+        alter table clickhouse_backup.backup_history
+        	drop column if exists modification_time;
+        '''
+    )
+]
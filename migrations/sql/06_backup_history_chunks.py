@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Partitions split into several backup files
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists chunk		int		not null default 0,
+        	add column if not exists chunks		int		not null default 1;
+        ''',
+        '''
+        alter table clickhouse_backup.backup_history
+        	drop column if exists chunk,
+        	drop column if exists chunks;
+        '''
+    )
+]
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Latest backup of each table and partition, maintained on write,
+and monthly partitioning of backup_history and backup_log
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        create or replace function clickhouse_backup.create_monthly_partitions(date_from timestamp, date_to timestamp)
+        returns void as $$
+        declare
+        	month_start		timestamp := date_trunc('month', date_from);
+        	parent			text;
+        begin
+        	while month_start <= date_to loop
+        		foreach parent in array array['backup_history', 'backup_log'] loop
+        			begin
+        				execute format(
+        					'create table if not exists clickhouse_backup.%I partition of clickhouse_backup.%I '
+        					'for values from (%L) to (%L)',
+        					parent || '_' || to_char(month_start, 'YYYYMM'), parent,
+        					month_start, month_start + interval '1 month'
+        				);
+        			exception when others then
+        				-- записи этого месяца уже попали в default партицию
+        				raise notice 'partition of % for % is not created: %', parent, month_start, sqlerrm;
+        			end;
+        		end loop;
+        		month_start := month_start + interval '1 month';
+        	end loop;
+        end;
+        $$ language plpgsql;
+        ''',
+        '''drop function if exists clickhouse_backup.create_monthly_partitions(timestamp, timestamp);'''
+    ),
+    step(
+        '''
+        alter table clickhouse_backup.backup_history rename to backup_history_unpartitioned;
+        alter index clickhouse_backup.backup_guid_index rename to backup_guid_index_unpartitioned;
+        alter index clickhouse_backup.backup_guid_table_index rename to backup_guid_table_index_unpartitioned;
+
+        create table clickhouse_backup.backup_history
+        (
+        	id					serial,
+        	backup_guid			uuid					not null,
+        	table_name			varchar(60)				not null,
+        	partition_key		varchar(36)				not null,
+        	count				int						not null,
+        	created				timestamp				not null default timezone('utc'::text, now()),
+        	file_name			varchar(255)			not null,
+        	execution_time		int						not null,
+        	file_format			varchar(32)				not null default 'CSV',
+        	compression			varchar(16)				not null default 'gzip',
+        	checksum			varchar(20),
+        	modification_time	bigint,
+        	chunk				int						not null default 0,
+        	chunks				int						not null default 1,
+        	primary key (id, created)
+        ) partition by range (created);
+        create table clickhouse_backup.backup_history_default partition of clickhouse_backup.backup_history default;
+
+        alter table clickhouse_backup.backup_log rename to backup_log_unpartitioned;
+        create table clickhouse_backup.backup_log
+        (
+        	backup_guid		uuid					not null,
+        	table_name		varchar(60)				not null,
+        	partition_key	varchar(36)				not null,
+        	event			text					not null,
+        	level			varchar(12)				not null,
+        	created			timestamp				not null default timezone('utc'::text, now())
+        ) partition by range (created);
+        create table clickhouse_backup.backup_log_default partition of clickhouse_backup.backup_log default;
+
+        select clickhouse_backup.create_monthly_partitions(
+        	coalesce(
+        		least(
+        			(select min(created) from clickhouse_backup.backup_history_unpartitioned),
+        			(select min(created) from clickhouse_backup.backup_log_unpartitioned)
+        		),
+        		timezone('utc'::text, now())
+        	),
+        	timezone('utc'::text, now()) + interval '2 months'
+        );
+
+        insert into clickhouse_backup.backup_history
+        	(id, backup_guid, table_name, partition_key, count, created, file_name, execution_time,
+        	 file_format, compression, checksum, modification_time, chunk, chunks)
+        select id, backup_guid, table_name, partition_key, count, coalesce(created, timezone('utc'::text, now())),
+        	file_name, execution_time, file_format, compression, checksum, modification_time, chunk, chunks
+        from clickhouse_backup.backup_history_unpartitioned;
+        select setval(
+        	pg_get_serial_sequence('clickhouse_backup.backup_history', 'id'),
+        	coalesce((select max(id) from clickhouse_backup.backup_history), 0) + 1,
+        	false
+        );
+        insert into clickhouse_backup.backup_log (backup_guid, table_name, partition_key, event, level, created)
+        select backup_guid, table_name, partition_key, event, level, coalesce(created, timezone('utc'::text, now()))
+        from clickhouse_backup.backup_log_unpartitioned;
+
+        drop table clickhouse_backup.backup_history_unpartitioned;
+        drop table clickhouse_backup.backup_log_unpartitioned;
+
+        create index if not exists backup_guid_index on clickhouse_backup.backup_history (backup_guid);
+        create index if not exists backup_guid_table_index on clickhouse_backup.backup_history (backup_guid, table_name);
+        create index if not exists backup_history_table_created_index
+        	on clickhouse_backup.backup_history (table_name, created desc);
+        create index if not exists backup_log_guid_index on clickhouse_backup.backup_log (backup_guid, table_name);
+        create index if not exists tables_schema_guid_table_index
+        	on clickhouse_backup.tables_schema (backup_guid, table_name);
+        ''',
+        '''
+        drop index if exists clickhouse_backup.tables_schema_guid_table_index;
+
+        create table clickhouse_backup.backup_history_unpartitioned
+        (
+        	id					serial					primary key,
+        	backup_guid			uuid					not null,
+        	table_name			varchar(60)				not null,
+        	partition_key		varchar(36)				not null,
+        	count				int						not null,
+        	created				timestamp default timezone('utc'::text, now()),
+        	file_name			varchar(255)			not null,
+        	execution_time		int						not null,
+        	file_format			varchar(32)				not null default 'CSV',
+        	compression			varchar(16)				not null default 'gzip',
+        	checksum			varchar(20),
+        	modification_time	bigint,
+        	chunk				int						not null default 0,
+        	chunks				int						not null default 1
+        );
+        insert into clickhouse_backup.backup_history_unpartitioned select * from clickhouse_backup.backup_history;
+        select setval(
+        	pg_get_serial_sequence('clickhouse_backup.backup_history_unpartitioned', 'id'),
+        	coalesce((select max(id) from clickhouse_backup.backup_history_unpartitioned), 0) + 1,
+        	false
+        );
+        drop table clickhouse_backup.backup_history;
+        alter table clickhouse_backup.backup_history_unpartitioned rename to backup_history;
+        create index if not exists backup_guid_index on clickhouse_backup.backup_history (backup_guid);
+        create index if not exists backup_guid_table_index on clickhouse_backup.backup_history (backup_guid, table_name);
+
+        create table clickhouse_backup.backup_log_unpartitioned
+        (
+        	backup_guid		uuid					not null,
+        	table_name		varchar(60)				not null,
+        	partition_key	varchar(36)				not null,
+        	event			text					not null,
+        	level			varchar(12)				not null,
+        	created			timestamp default timezone('utc'::text, now())
+        );
+        insert into clickhouse_backup.backup_log_unpartitioned select * from clickhouse_backup.backup_log;
+        drop table clickhouse_backup.backup_log;
+        alter table clickhouse_backup.backup_log_unpartitioned rename to backup_log;
+        '''
+    ),
+    step(
+        '''
+        create table if not exists clickhouse_backup.latest_backup
+        (
+        	table_name		varchar(60)				primary key,
+        	backup_guid		uuid					not null,
+        	created			timestamp				not null
+        );
+
+        create table if not exists clickhouse_backup.latest_partition_backup
+        (
+        	table_name			varchar(60)			not null,
+        	partition_key		varchar(36)			not null,
+        	backup_guid			uuid				not null,
+        	count				bigint				not null,
+        	checksum			varchar(20),
+        	modification_time	bigint,
+        	created				timestamp			not null,
+        	primary key (table_name, partition_key)
+        );
+
+        create or replace function clickhouse_backup.update_latest_backup() returns trigger as $$
+        begin
+        	insert into clickhouse_backup.latest_backup as lb (table_name, backup_guid, created)
+        	select distinct on (table_name) table_name, backup_guid, created
+        	from new_rows
+        	order by table_name, created desc
+        	on conflict (table_name) do update
+        		set backup_guid = excluded.backup_guid, created = excluded.created
+        		where lb.created <= excluded.created;
+
+        	-- части (chunk) одной партиции одного бэкапа суммируются
+        	insert into clickhouse_backup.latest_partition_backup as lpb
+        		(table_name, partition_key, backup_guid, count, checksum, modification_time, created)
+        	select distinct on (table_name, partition_key)
+        		table_name, partition_key, backup_guid, count, checksum, modification_time, created
+        	from (
+        		select table_name, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        			max(modification_time) as modification_time, max(created) as created
+        		from new_rows
+        		group by table_name, partition_key, backup_guid
+        	) batch
+        	order by table_name, partition_key, created desc
+        	on conflict (table_name, partition_key) do update
+        		set backup_guid = excluded.backup_guid,
+        			count = case when lpb.backup_guid = excluded.backup_guid
+        				then lpb.count + excluded.count else excluded.count end,
+        			checksum = excluded.checksum,
+        			modification_time = excluded.modification_time,
+        			created = excluded.created
+        		where lpb.backup_guid = excluded.backup_guid or lpb.created <= excluded.created;
+        	return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger backup_history_latest_backup
+        	after insert on clickhouse_backup.backup_history
+        	referencing new table as new_rows
+        	for each statement execute function clickhouse_backup.update_latest_backup();
+
+        insert into clickhouse_backup.latest_backup (table_name, backup_guid, created)
+        select distinct on (table_name) table_name, backup_guid, created
+        from clickhouse_backup.backup_history
+        order by table_name, created desc;
+
+        insert into clickhouse_backup.latest_partition_backup
+        	(table_name, partition_key, backup_guid, count, checksum, modification_time, created)
+        select distinct on (table_name, partition_key)
+        	table_name, partition_key, backup_guid, count, checksum, modification_time, created
+        from (
+        	select table_name, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        		max(modification_time) as modification_time, max(created) as created
+        	from clickhouse_backup.backup_history
+        	group by table_name, partition_key, backup_guid
+        ) history
+        order by table_name, partition_key, created desc;
+        ''',
+        '''
+        drop trigger if exists backup_history_latest_backup on clickhouse_backup.backup_history;
+        drop function if exists clickhouse_backup.update_latest_backup();
+        drop table if exists clickhouse_backup.latest_partition_backup;
+        drop table if exists clickhouse_backup.latest_backup;
+        '''
+    ),
+]
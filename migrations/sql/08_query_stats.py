@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Statistics of export queries from system.query_log
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        create table if not exists clickhouse_backup.query_stats
+        (
+        	id				serial					primary key,
+        	backup_guid		uuid					not null,
+        	table_name		varchar(60)				not null,
+        	partition_key	varchar(36)				not null,
+        	chunk			int						not null default 0,
+        	query_id		varchar(64)				not null,
+        	read_rows		bigint,
+        	read_bytes		bigint,
+        	written_rows	bigint,
+        	written_bytes	bigint,
+        	memory_usage	bigint,
+        	duration_ms		bigint,
+        	created			timestamp				not null default timezone('utc'::text, now())
+        );
+        create index if not exists query_stats_guid_table_index
+        	on clickhouse_backup.query_stats (backup_guid, table_name);
+        ''',
+        '''drop table if exists clickhouse_backup.query_stats;'''
+    )
+]
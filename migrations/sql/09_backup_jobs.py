@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Queue of partition export jobs for backup workers
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        create table if not exists clickhouse_backup.backup_jobs
+        (
+        	id					bigserial				primary key,
+        	backup_guid			uuid					not null,
+        	table_name			varchar(60)				not null,
+        	partition_key		varchar(36)				not null,
+        	chunk				int						not null default 0,
+        	chunks				int						not null default 1,
+        	count				bigint					not null,
+        	bytes				bigint,
+        	checksum			varchar(20),
+        	modification_time	bigint,
+        	datetime_backup		varchar(14)				not null,
+        	status				varchar(12)				not null default 'pending',
+        	attempts			int						not null default 0,
+        	worker				varchar(255),
+        	lease_until			timestamp,
+        	error				text,
+        	created				timestamp				not null default timezone('utc'::text, now()),
+        	updated				timestamp
+        );
+        create index if not exists backup_jobs_active_index
+        	on clickhouse_backup.backup_jobs ((coalesce(bytes, count)) desc)
+        	where status in ('pending', 'running');
+        create index if not exists backup_jobs_guid_index on clickhouse_backup.backup_jobs (backup_guid);
+        ''',
+        '''drop table if exists clickhouse_backup.backup_jobs;'''
+    )
+]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shard of the cluster in backup_history and the latest partition backup
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists shard		int		not null default 0;
+
+        alter table clickhouse_backup.latest_partition_backup
+        	add column if not exists shard		int		not null default 0;
+        alter table clickhouse_backup.latest_partition_backup drop constraint latest_partition_backup_pkey;
+        alter table clickhouse_backup.latest_partition_backup add primary key (table_name, shard, partition_key);
+
+        create or replace function clickhouse_backup.update_latest_backup() returns trigger as $$
+        begin
+        	insert into clickhouse_backup.latest_backup as lb (table_name, backup_guid, created)
+        	select distinct on (table_name) table_name, backup_guid, created
+        	from new_rows
+        	order by table_name, created desc
+        	on conflict (table_name) do update
+        		set backup_guid = excluded.backup_guid, created = excluded.created
+        		where lb.created <= excluded.created;
+
+        	-- части (chunk) одной партиции одного шарда одного бэкапа суммируются
+        	insert into clickhouse_backup.latest_partition_backup as lpb
+        		(table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created)
+        	select distinct on (table_name, shard, partition_key)
+        		table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created
+        	from (
+        		select table_name, shard, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        			max(modification_time) as modification_time, max(created) as created
+        		from new_rows
+        		group by table_name, shard, partition_key, backup_guid
+        	) batch
+        	order by table_name, shard, partition_key, created desc
+        	on conflict (table_name, shard, partition_key) do update
+        		set backup_guid = excluded.backup_guid,
+        			count = case when lpb.backup_guid = excluded.backup_guid
+        				then lpb.count + excluded.count else excluded.count end,
+        			checksum = excluded.checksum,
+        			modification_time = excluded.modification_time,
+        			created = excluded.created
+        		where lpb.backup_guid = excluded.backup_guid or lpb.created <= excluded.created;
+        	return null;
+        end;
+        $$ language plpgsql;
+        ''',
+        '''
+        create or replace function clickhouse_backup.update_latest_backup() returns trigger as $$
+        begin
+        	insert into clickhouse_backup.latest_backup as lb (table_name, backup_guid, created)
+        	select distinct on (table_name) table_name, backup_guid, created
+        	from new_rows
+        	order by table_name, created desc
+        	on conflict (table_name) do update
+        		set backup_guid = excluded.backup_guid, created = excluded.created
+        		where lb.created <= excluded.created;
+
+        	-- части (chunk) одной партиции одного бэкапа суммируются
+        	insert into clickhouse_backup.latest_partition_backup as lpb
+        		(table_name, partition_key, backup_guid, count, checksum, modification_time, created)
+        	select distinct on (table_name, partition_key)
+        		table_name, partition_key, backup_guid, count, checksum, modification_time, created
+        	from (
+        		select table_name, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        			max(modification_time) as modification_time, max(created) as created
+        		from new_rows
+        		group by table_name, partition_key, backup_guid
+        	) batch
+        	order by table_name, partition_key, created desc
+        	on conflict (table_name, partition_key) do update
+        		set backup_guid = excluded.backup_guid,
+        			count = case when lpb.backup_guid = excluded.backup_guid
+        				then lpb.count + excluded.count else excluded.count end,
+        			checksum = excluded.checksum,
+        			modification_time = excluded.modification_time,
+        			created = excluded.created
+        		where lpb.backup_guid = excluded.backup_guid or lpb.created <= excluded.created;
+        	return null;
+        end;
+        $$ language plpgsql;
+
+        delete from clickhouse_backup.latest_partition_backup where shard <> 0;
+        alter table clickhouse_backup.latest_partition_backup drop constraint latest_partition_backup_pkey;
+        alter table clickhouse_backup.latest_partition_backup add primary key (table_name, partition_key);
+        alter table clickhouse_backup.latest_partition_backup drop column if exists shard;
+
+        alter table clickhouse_backup.backup_history drop column if exists shard;
+        '''
+    )
+]
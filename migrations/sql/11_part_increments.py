@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Block ranges of exported parts, chains of full and delta files, backup manifest
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_history
+        	add column if not exists base_block		bigint,
+        	add column if not exists max_block		bigint,
+        	add column if not exists mutation		bigint;
+
+        alter table clickhouse_backup.latest_partition_backup
+        	add column if not exists max_block		bigint,
+        	add column if not exists mutation		bigint,
+        	add column if not exists delta			boolean		not null default false,
+        	add column if not exists chain			uuid[];
+        update clickhouse_backup.latest_partition_backup set chain = array[backup_guid] where chain is null;
+        alter table clickhouse_backup.latest_partition_backup alter column chain set not null;
+        ''',
+        '''
+        alter table clickhouse_backup.latest_partition_backup
+        	drop column if exists max_block,
+        	drop column if exists mutation,
+        	drop column if exists delta,
+        	drop column if exists chain;
+
+        alter table clickhouse_backup.backup_history
+        	drop column if exists base_block,
+        	drop column if exists max_block,
+        	drop column if exists mutation;
+        '''
+    ),
+    step(
+        '''
+        create table if not exists clickhouse_backup.backup_manifest
+        (
+        	backup_guid		uuid					not null,
+        	table_name		varchar(60)				not null,
+        	shard			int						not null default 0,
+        	partition_key	varchar(36)				not null,
+        	chain			uuid[]					not null,
+        	created			timestamp				not null default timezone('utc'::text, now()),
+        	primary key (backup_guid, table_name, shard, partition_key)
+        );
+        ''',
+        '''drop table if exists clickhouse_backup.backup_manifest;'''
+    ),
+    step(
+        '''
+        create or replace function clickhouse_backup.update_latest_backup() returns trigger as $$
+        begin
+        	insert into clickhouse_backup.latest_backup as lb (table_name, backup_guid, created)
+        	select distinct on (table_name) table_name, backup_guid, created
+        	from new_rows
+        	order by table_name, created desc
+        	on conflict (table_name) do update
+        		set backup_guid = excluded.backup_guid, created = excluded.created
+        		where lb.created <= excluded.created;
+
+        	-- части (chunk) одной партиции одного шарда одного бэкапа суммируются;
+        	-- delta (base_block is not null) дописывается к цепочке файлов партиции,
+        	-- полная выгрузка начинает новую цепочку.
+        	-- max_block неизвестен (null), если хотя бы одна часть выгружена без границы блоков
+        	insert into clickhouse_backup.latest_partition_backup as lpb
+        		(table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created,
+        		max_block, mutation, delta, chain)
+        	select distinct on (table_name, shard, partition_key)
+        		table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created,
+        		max_block, mutation, delta, array[backup_guid]
+        	from (
+        		select table_name, shard, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        			max(modification_time) as modification_time, max(created) as created,
+        			bool_or(base_block is not null) as delta,
+        			case when bool_and(max_block is not null) then max(max_block) end as max_block,
+        			max(mutation) as mutation
+        		from new_rows
+        		group by table_name, shard, partition_key, backup_guid
+        	) batch
+        	order by table_name, shard, partition_key, created desc
+        	on conflict (table_name, shard, partition_key) do update
+        		set backup_guid = excluded.backup_guid,
+        			count = case when lpb.backup_guid = excluded.backup_guid or excluded.delta
+        				then lpb.count + excluded.count else excluded.count end,
+        			checksum = excluded.checksum,
+        			modification_time = excluded.modification_time,
+        			created = excluded.created,
+        			max_block = case when (lpb.backup_guid = excluded.backup_guid or excluded.delta)
+        				and lpb.max_block is null then null else excluded.max_block end,
+        			mutation = excluded.mutation,
+        			delta = case when lpb.backup_guid = excluded.backup_guid
+        				then lpb.delta or excluded.delta else excluded.delta end,
+        			chain = case when lpb.backup_guid = excluded.backup_guid then lpb.chain
+        				when excluded.delta then lpb.chain || excluded.backup_guid else excluded.chain end
+        		where lpb.backup_guid = excluded.backup_guid or lpb.created <= excluded.created;
+        	return null;
+        end;
+        $$ language plpgsql;
+        ''',
+        '''
+        create or replace function clickhouse_backup.update_latest_backup() returns trigger as $$
+        begin
+        	insert into clickhouse_backup.latest_backup as lb (table_name, backup_guid, created)
+        	select distinct on (table_name) table_name, backup_guid, created
+        	from new_rows
+        	order by table_name, created desc
+        	on conflict (table_name) do update
+        		set backup_guid = excluded.backup_guid, created = excluded.created
+        		where lb.created <= excluded.created;
+
+        	-- части (chunk) одной партиции одного шарда одного бэкапа суммируются
+        	insert into clickhouse_backup.latest_partition_backup as lpb
+        		(table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created)
+        	select distinct on (table_name, shard, partition_key)
+        		table_name, shard, partition_key, backup_guid, count, checksum, modification_time, created
+        	from (
+        		select table_name, shard, partition_key, backup_guid, sum(count) as count, max(checksum) as checksum,
+        			max(modification_time) as modification_time, max(created) as created
+        		from new_rows
+        		group by table_name, shard, partition_key, backup_guid
+        	) batch
+        	order by table_name, shard, partition_key, created desc
+        	on conflict (table_name, shard, partition_key) do update
+        		set backup_guid = excluded.backup_guid,
+        			count = case when lpb.backup_guid = excluded.backup_guid
+        				then lpb.count + excluded.count else excluded.count end,
+        			checksum = excluded.checksum,
+        			modification_time = excluded.modification_time,
+        			created = excluded.created
+        		where lpb.backup_guid = excluded.backup_guid or lpb.created <= excluded.created;
+        	return null;
+        end;
+        $$ language plpgsql;
+        '''
+    )
+]
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Schema fingerprints of backed up tables, the fields of an unchanged schema are stored once
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        create table if not exists clickhouse_backup.backup_schema
+        (
+        	backup_guid		uuid					not null,
+        	table_name		varchar(60)				not null,
+        	schema_hash		varchar(32)				not null,
+        	schema_guid		uuid					not null,
+        	created			timestamp				not null default timezone('utc'::text, now()),
+        	primary key (backup_guid, table_name)
+        );
+
+        -- schema_hash - md5 от "field_name field_type, ..." в порядке field_position,
+        -- schema_guid - бэкап, с которым поля схемы записаны в tables_schema
+        insert into clickhouse_backup.backup_schema (backup_guid, table_name, schema_hash, schema_guid)
+        select backup_guid, table_name,
+        	md5(string_agg(field_name || ' ' || field_type, ', ' order by field_position)), backup_guid
+        from clickhouse_backup.tables_schema
+        group by backup_guid, table_name
+        on conflict do nothing;
+        ''',
+        '''drop table if exists clickhouse_backup.backup_schema;'''
+    )
+]
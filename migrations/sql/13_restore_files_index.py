@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index for resolving the files of a table at a point in time partition by partition
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        -- строки таблицы до момента восстановления читаются по индексу
+        -- уже упорядоченными для окон по (shard, partition_key)
+        create index if not exists backup_history_restore_index
+        	on clickhouse_backup.backup_history (table_name, shard, partition_key, created desc);
+        ''',
+        '''drop index if exists clickhouse_backup.backup_history_restore_index;'''
+    )
+]
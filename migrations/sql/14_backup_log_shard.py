@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shard of the cluster in backup_log, so that a cluster backup can be resumed shard by shard
+
+"""
+
+
+from yoyo import step
+
+
+
+steps = [
+    step(
+        '''
+        alter table clickhouse_backup.backup_log
+        	add column if not exists shard		int		not null default 0;
+        ''',
+        '''
+        alter table clickhouse_backup.backup_log drop column if exists shard;
+        '''
+    )
+]
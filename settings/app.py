@@ -6,4 +6,41 @@ from .base import env, BASE_PATH
 class AppConfig:
     PATH_TO_TABLE = os.path.join(BASE_PATH, 'app/schema.json')
     COUNT_THREADS = env.int("COUNT_THREADS", default=2)
+    MAX_ROWS_PER_FILE = env.int("MAX_ROWS_PER_FILE", default=0)
+    MAX_BYTES_PER_FILE = env.int("MAX_BYTES_PER_FILE", default=0)
+    RETRY_ATTEMPTS = env.int("RETRY_ATTEMPTS", default=3)
+    RETRY_BACKOFF = env.float("RETRY_BACKOFF", default=5)
+    RETRY_BACKOFF_MAX = env.float("RETRY_BACKOFF_MAX", default=300)
+    # TIMEOUT_EXCEEDED, TOO_MANY_SIMULTANEOUS_QUERIES, SOCKET_TIMEOUT, NETWORK_ERROR, CANNOT_READ_FROM_SOCKET,
+    # CANNOT_WRITE_TO_SOCKET, MEMORY_LIMIT_EXCEEDED, TABLE_IS_READ_ONLY, ALL_CONNECTION_TRIES_FAILED,
+    # S3_ERROR, POCO_EXCEPTION
+    RETRYABLE_ERROR_CODES = env.list(
+        "RETRYABLE_ERROR_CODES", subcast=int, default=[159, 202, 209, 210, 95, 96, 241, 242, 279, 499, 1000]
+    )
+    # адаптивное число параллельных выгрузок, COUNT_THREADS - начальное значение
+    ADAPTIVE_CONCURRENCY = env.bool("ADAPTIVE_CONCURRENCY", default=False)
+    CONCURRENCY_MIN = env.int("CONCURRENCY_MIN", default=1)
+    CONCURRENCY_MAX = env.int("CONCURRENCY_MAX", default=8)
+    CONCURRENCY_INTERVAL = env.float("CONCURRENCY_INTERVAL", default=30)
+    # пороги нагрузки clickhouse, при превышении которых число выгрузок уменьшается вдвое
+    CONCURRENCY_MAX_QUERIES = env.int("CONCURRENCY_MAX_QUERIES", default=20)
+    CONCURRENCY_MAX_MERGES = env.int("CONCURRENCY_MAX_MERGES", default=16)
+    CONCURRENCY_MAX_MEMORY = env.int("CONCURRENCY_MAX_MEMORY", default=0)
+    # доля падения rows/s после увеличения, при которой увеличение откатывается
+    CONCURRENCY_THROUGHPUT_DROP = env.float("CONCURRENCY_THROUGHPUT_DROP", default=0.2)
+    # метрики prometheus: файл для textfile collector и/или порт http сервера
+    METRICS_TEXTFILE = env.str("METRICS_TEXTFILE", default=None)
+    METRICS_PORT = env.int("METRICS_PORT", default=None)
+    # сохранять статистику запросов выгрузки из system.query_log в query_stats
+    QUERY_STATS = env.bool("QUERY_STATS", default=True)
+    # очередь заданий backup_jobs: аренда задания, ее продление и опрос очереди, секунды
+    JOB_LEASE = env.int("JOB_LEASE", default=300)
+    JOB_HEARTBEAT = env.float("JOB_HEARTBEAT", default=60)
+    JOB_POLL_INTERVAL = env.float("JOB_POLL_INTERVAL", default=10)
+    # прогресс выгрузок читается из system.processes раз в EXPORT_PROGRESS_INTERVAL секунд;
+    # выгрузка дольше EXPORT_DEADLINE секунд (плюс секунда на каждые EXPORT_DEADLINE_ROWS_PER_SECOND
+    # записей файла) останавливается kill query, 0 - без ограничения
+    EXPORT_PROGRESS_INTERVAL = env.float("EXPORT_PROGRESS_INTERVAL", default=60)
+    EXPORT_DEADLINE = env.float("EXPORT_DEADLINE", default=0)
+    EXPORT_DEADLINE_ROWS_PER_SECOND = env.float("EXPORT_DEADLINE_ROWS_PER_SECOND", default=0)
     
\ No newline at end of file
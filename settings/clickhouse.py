@@ -10,16 +10,30 @@ class ClHouseConfig:
     USER = env.str('CLICK_USERNAME', default='default')
     PASSWORD = env.str('CLICK_PASSWORD', default='')
     RECEIVE_TIMEOUT = env.int("CLICK_TIMEOUT", default=1000)
-    FORMAT_BACKUP_FILE = "CSV"
-    COMPRESSION_BACKUP = "gzip"
+    # формат и сжатие по умолчанию - прежние CSV и gzip, другие задаются явно (или в schema.json)
+    FORMAT_BACKUP_FILE = env.str("FORMAT_BACKUP_FILE", default="CSV")
+    COMPRESSION_BACKUP = env.str("COMPRESSION_BACKUP", default="gzip")
+    COMPRESSION_LEVEL_BACKUP = env.int("COMPRESSION_LEVEL_BACKUP", default=None)
+    # пул быстрых запросов метаданных; пул выгрузок по умолчанию равен наибольшему числу параллельных выгрузок
     POOL_MAXSIZE = env.int("POOL_MAXSIZE", default=2)
+    EXPORT_POOL_MAXSIZE = env.int("EXPORT_POOL_MAXSIZE", default=None)
+    # кластер из system.clusters: бэкап локальных таблиц с одной реплики каждого шарда
+    CLUSTER = env.str("CLICK_CLUSTER", default=None)
+    RESTORE_SETTINGS = {
+        'max_insert_threads': env.int("RESTORE_INSERT_THREADS", default=4),
+    }
+    # проверка файлов бэкапа идет в фоне и не должна мешать рабочим запросам
+    VERIFY_SETTINGS = {
+        'priority': env.int("VERIFY_PRIORITY", default=10),
+        'max_threads': env.int("VERIFY_MAX_THREADS", default=1),
+    }
     
     @classmethod
-    def get_path_to_s3_function(cls, file_name: str):
+    def get_path_to_s3_function(cls, file_name: str, extension: str):
         return os.path.join(
             S3Config.HOST, 
             S3Config.BUCKET_NAME,
-            f"{file_name}.{cls.FORMAT_BACKUP_FILE.lower()}.gz"
+            f"{file_name}.{extension}"
         )
     
     @classmethod
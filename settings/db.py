@@ -21,4 +21,9 @@ class DbConfig:
     }
     DEFAULT_LIMIT = env.int('DB_DEFAULT_LIMIT', default=100)
     PATH_TO_MIGRATIONS = os.path.join(BASE_PATH, 'migrations/sql')
+    WRITER_BATCH_SIZE = env.int('DB_WRITER_BATCH_SIZE', default=500)
+    WRITER_FLUSH_INTERVAL = env.float('DB_WRITER_FLUSH_INTERVAL', default=5)
+    SPOOL_PATH = env.str('DB_SPOOL_PATH', default=os.path.join(BASE_PATH, 'psql_spool.jsonl'))
+    # записи, не записанные и после стольких повторов из spool, переносятся в {DB_SPOOL_PATH}.dead
+    SPOOL_MAX_REPLAYS = env.int('DB_SPOOL_MAX_REPLAYS', default=5)
 
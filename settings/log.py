@@ -1,7 +1,87 @@
+import json
+import queue
+import atexit
 import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict
 
+from .base import env
 
-logging.basicConfig(level=logging.INFO, filename="log.log", format="%(asctime)s [%(levelname)s] %(message)s")
+
+class LogConfig:
+    PATH = env.str("LOG_PATH", default="log.log")
+    # json - одна json строка на запись, text - прежний текстовый формат
+    FORMAT = env.str("LOG_FORMAT", default="json")
+    MAX_BYTES = env.int("LOG_MAX_BYTES", default=100 * 1024 * 1024)
+    BACKUP_COUNT = env.int("LOG_BACKUP_COUNT", default=5)
+
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+# поля контекста, которые передаются в extra записи лога (см. log_context)
+CONTEXT_FIELDS = ("backup_guid", "table", "partition", "chunk", "attempt", "duration")
 
 app_log = logging.getLogger(__name__)
 app_log.setLevel(logging.INFO)
+
+_listener: QueueListener = None
+
+
+def log_context(backup_guid=None, table: str = None, partition=None, **fields) -> Dict:
+    """extra для записи лога: app_log.info(message, extra=log_context(backup_guid, table_name, partition_key))"""
+    context = {'backup_guid': backup_guid, 'table': table, 'partition': partition, **fields}
+    return {key: value for key, value in context.items() if value is not None}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class LoopQueueHandler(QueueHandler):
+    """
+    Запись только кладется в очередь, форматирование (в том числе traceback) и запись в файл
+    выполняются в потоке QueueListener. Очередь в памяти процесса, поэтому запись не копируется
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # аргументы сообщения подставляются сразу, пока объекты не изменились
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    """
+    Лог пишется в LogConfig.PATH с ротацией по размеру. Обработчики логгеров только кладут записи
+    в очередь, файл пишет отдельный поток, поэтому запись лога не блокирует event loop.
+    Настраивается при запуске команды, а не при импорте модуля
+    """
+    global _listener
+    if _listener is not None:
+        return
+    handler = RotatingFileHandler(
+        LogConfig.PATH, maxBytes=LogConfig.MAX_BYTES, backupCount=LogConfig.BACKUP_COUNT, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter() if LogConfig.FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(LoopQueueHandler(log_queue))
+    _listener.start()
+    # при выходе listener дописывает оставшиеся в очереди записи
+    atexit.register(_listener.stop)